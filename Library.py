@@ -4,25 +4,233 @@
 # Description: This file emulates a library simulator with LibraryItem, Patron, and Library classes.
 # LibraryItem has three subclasses: Book, Album, and Movie.
 
-class LibraryItem:
+import bisect
+import heapq
+import itertools
+import re
+import threading
+from abc import ABCMeta
+from array import array
+from collections import deque
+from collections.abc import Mapping
+
+DAILY_FINE_CENTS = 10  # fine charged for each day a library item is overdue, unless a LoanPolicy says otherwise
+DEFAULT_PATRON_CLASS = "standard"  # class of a patron created without one, LoanPolicy rules may differ by class
+
+# LibraryItem locations are stored as integer codes, LOCATIONS[code] is the name get_location() returns
+LOCATIONS = ("ON_SHELF", "ON_HOLD_SHELF", "CHECKED_OUT")
+LOCATION_CODES = {location: code for code, location in enumerate(LOCATIONS)}
+
+# Library.process_batch reports each result as an integer code, RESULTS[code] is the string the single call returns
+RESULTS = ("check out successful", "return successful", "request successful", "patron not found", "item not found",
+           "item already checked out", "item on hold by other patron", "item already in library",
+           "item already on hold", "unknown operation", "loan limit reached")
+RESULT_CODES = {result: code for code, result in enumerate(RESULTS)}
+
+
+_SLOT_NAMES = {}  # class -> names of the slots of its instances, see _copy_slots
+
+
+def _copy_slots(record):
+    """
+    returns a shallow copy of an object whose fields are all in __slots__, such as a LibraryItem or Patron
+    :param record: the object
+    :return: a new object of the same class with the same fields
+    """
+    record_type = type(record)
+    names = _SLOT_NAMES.get(record_type)
+    if names is None:
+        names = _SLOT_NAMES[record_type] = [name for cls in record_type.__mro__
+                                            for name in cls.__dict__.get("__slots__", ())]
+    record_copy = object.__new__(record_type)
+    for name in names:
+        setattr(record_copy, name, getattr(record, name))
+    return record_copy
+
+
+class HoldHandle:
+    """
+    A patron's place in the HoldQueue of a library item, returned when the hold is placed and used to cancel it or to
+    ask for its position.
+    """
+
+    __slots__ = ("_patron", "_ticket", "_active")
+
+    def __init__(self, patron, ticket):
+        self._patron = patron
+        self._ticket = ticket
+        self._active = True
+
+    def get_patron(self):
+        """
+        returns the patron waiting
+        :return: a Patron object
+        """
+        return self._patron
+
+    def is_active(self):
+        """
+        returns whether the patron is still waiting, holds stop being active when cancelled or filled
+        :return: a boolean
+        """
+        return self._active
+
+
+class HoldQueue:
+    """
+    A first-in first-out queue of the patrons waiting for a library item.
+
+    Each hold gets a ticket number in the order it was placed and its HoldHandle is kept in a deque, so adding a hold
+    and taking the next one are constant time. Cancelling marks the handle inactive, leaves it in the deque to be
+    skipped when it reaches the front and adds its ticket to a set of cancelled tickets, also in constant time. A
+    position is the distance from the front ticket less the cancelled tickets ahead of it, counted by bisecting a
+    sorted copy of the set that is made on the first position asked after a cancellation. Tickets leave the set as
+    their handles leave the front; the sorted copy keeps them, since they are behind every ticket still waiting.
+    """
+
+    __slots__ = ("_handles", "_next_ticket", "_cancelled", "_cancelled_order")
+
+    def __init__(self):
+        self._handles = deque()
+        self._next_ticket = 0
+        self._cancelled = set()  # tickets of cancelled holds still in _handles
+        self._cancelled_order = None  # sorted list of the cancelled tickets, None until a position is asked
+
+    def __len__(self):
+        return len(self._handles) - len(self._cancelled)
+
+    def __iter__(self):
+        for handle in self._handles:
+            if handle._active:
+                yield handle._patron
+
+    def _drop_cancelled(self):
+        """
+        removes cancelled holds from the front of the queue
+        :return: None
+        """
+        while self._handles and not self._handles[0]._active:
+            self._cancelled.discard(self._handles.popleft()._ticket)
+
+    def add(self, patron):
+        """
+        places a hold for a patron at the back of the queue
+        :param patron: Patron object
+        :return: the HoldHandle of the hold
+        """
+        handle = HoldHandle(patron, self._next_ticket)
+        self._next_ticket += 1
+        self._handles.append(handle)
+        return handle
+
+    def peek(self):
+        """
+        returns the patron at the front of the queue
+        :return: a Patron object, or None if no one is waiting
+        """
+        self._drop_cancelled()
+        return self._handles[0]._patron if self._handles else None
+
+    def pop(self):
+        """
+        removes the hold at the front of the queue, as when it is filled
+        :return: the HoldHandle of the hold, or None if no one is waiting
+        """
+        self._drop_cancelled()
+        if not self._handles:
+            return None
+        handle = self._handles.popleft()
+        handle._active = False
+        return handle
+
+    def cancel(self, handle):
+        """
+        cancels a hold in the queue, in constant time
+        :param handle: HoldHandle of the hold
+        :return: True if the hold was cancelled, False if it was no longer active
+        """
+        if not handle._active:
+            return False
+        handle._active = False
+        self._cancelled.add(handle._ticket)
+        self._cancelled_order = None
+        self._drop_cancelled()
+        return True
+
+    def cancel_all(self):
+        """
+        cancels every hold in the queue
+        :return: a list of the HoldHandles of the holds cancelled, in the order they were placed
+        """
+        handles = [handle for handle in self._handles if handle._active]
+        for handle in handles:
+            handle._active = False
+        self._handles.clear()
+        self._cancelled.clear()
+        self._cancelled_order = None
+        return handles
+
+    def get_position(self, handle):
+        """
+        returns how far a hold is from the front of the queue
+        :param handle: HoldHandle of the hold
+        :return: 1 for the front of the queue, or None if the hold is no longer active
+        """
+        if not handle._active:
+            return None
+        front_ticket = self._handles[0]._ticket
+        cancelled_ahead = 0
+        if self._cancelled:
+            if self._cancelled_order is None:
+                self._cancelled_order = sorted(self._cancelled)
+            cancelled_ahead = (bisect.bisect_left(self._cancelled_order, handle._ticket)
+                               - bisect.bisect_left(self._cancelled_order, front_ticket))
+        return handle._ticket - front_ticket - cancelled_ahead + 1
+
+    def copy(self, records):
+        """
+        returns a copy of the queue with a copy of each hold, for a forked Library (see Library.fork)
+        :param records: a dictionary of the Patrons copied to their copies, a hold's copy waits for the patron's copy
+        when there is one. Each HoldHandle is added to it with its copy.
+        :return: a HoldQueue
+        """
+        hold_queue = HoldQueue()
+        hold_queue._next_ticket = self._next_ticket
+        hold_queue._cancelled = set(self._cancelled)
+        for handle in self._handles:
+            handle_copy = records[handle] = HoldHandle(records.get(handle._patron, handle._patron), handle._ticket)
+            handle_copy._active = handle._active
+            hold_queue._handles.append(handle_copy)
+        return hold_queue
+
+
+class LibraryItem(metaclass=ABCMeta):
     """
     A class for LibraryItem objects that patrons may check out from the library.
 
     We have six data members:
-    * library_item_id, unique identifier (unenforced)
+    * library_item_id, unique identifier (enforced by Library.add_library_item)
     * title, may not be unique
     * location, can be "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
     * checked_out_by, refers to relevant patron object, if applicable
-    * requested_by, refers to the Patron that has requested it
+    * requested_by, refers to the Patron that has requested it, the front of the item's hold queue
     * date_checked_out, will be set to current_date of Library when checked out
+
+    The location is kept as an index into LOCATIONS, and __slots__ keeps instances free of a per-instance __dict__.
+    LibraryItem is an abstract base class only so the ItemStore views, which keep none of these data members, can be
+    registered as Books, Albums and Movies.
+    Any number of patrons may request an item; they wait in a HoldQueue that is only created once the item is first
+    requested.
     """
 
+    __slots__ = ("_library_item_id", "_title", "_location", "_checked_out_by", "_hold_queue", "_date_checked_out")
+
     def __init__(self, library_item_id, title):
         self._library_item_id = library_item_id
         self._title = title
-        self._location = "ON_SHELF"
+        self._location = 0  # ON_SHELF
         self._checked_out_by = None
-        self._requested_by = None
+        self._hold_queue = None
         self._date_checked_out = None
 
     def get_library_item_id(self):
@@ -44,6 +252,13 @@ class LibraryItem:
         A method to return the LibraryItem object's current location
         :return: A string, can be "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
         """
+        return LOCATIONS[self._location]
+
+    def get_location_code(self):
+        """
+        A method to return the LibraryItem object's current location as its index in LOCATIONS
+        :return: An integer, 0 for "ON_SHELF", 1 for "ON_HOLD_SHELF", or 2 for "CHECKED_OUT"
+        """
         return self._location
 
     def set_location(self, location):
@@ -52,7 +267,7 @@ class LibraryItem:
         or "CHECKED_OUT"
         :return: None
         """
-        self._location = location
+        self._location = LOCATION_CODES[location]
 
     def get_checked_out_by(self):
         """
@@ -69,20 +284,56 @@ class LibraryItem:
         """
         self._checked_out_by = checked_out_by
 
+    def get_hold_queue(self):
+        """
+        A method to return the queue of patrons waiting for the LibraryItem object
+        :return: None or the HoldQueue, None if the object has never been requested
+        """
+        return self._hold_queue
+
+    def set_hold_queue(self, hold_queue):
+        """
+        A method to change the queue of patrons waiting for the LibraryItem object
+        :return: None
+        """
+        self._hold_queue = hold_queue
+
+    def add_hold(self, patron):
+        """
+        A method to place a hold for a patron at the back of the LibraryItem object's hold queue
+        :param patron: Patron object requesting the object
+        :return: the HoldHandle of the hold
+        """
+        hold_queue = self.get_hold_queue()
+        if hold_queue is None:
+            hold_queue = HoldQueue()
+            self.set_hold_queue(hold_queue)
+        return hold_queue.add(patron)
+
     def get_requested_by(self):
         """
-        A method to return the patron that has requested the LibraryItem object
+        A method to return the patron that has requested the LibraryItem object, the front of its hold queue
         :return: None or the patron object that has requested the object
         """
-        return self._requested_by
+        hold_queue = self.get_hold_queue()
+        return None if hold_queue is None else hold_queue.peek()
 
     def set_requested_by(self, requested_by):
         """
-        A method to change the data member representing the patron that has requested the LibraryItem object
-        by passing parameter
+        A method to replace the LibraryItem object's hold queue with a single request by the patron passed, or to clear
+        it when passed None. The holds replaced are cancelled through their handles and dropped from their patrons'
+        holds. The Library places and fills holds through add_hold and the hold queue instead.
+        :param requested_by: None or the Patron object requesting the object
         :return: None
         """
-        self._requested_by = requested_by
+        hold_queue = self.get_hold_queue()
+        if hold_queue is not None:
+            for hold_handle in hold_queue.cancel_all():
+                patron = hold_handle.get_patron()
+                if patron.get_hold(self) is hold_handle:
+                    patron.remove_hold(self)
+        if requested_by is not None:
+            requested_by.add_hold(self, self.add_hold(requested_by))
 
     def get_date_checked_out(self):
         """
@@ -98,13 +349,34 @@ class LibraryItem:
         """
         self._date_checked_out = date_checked_out
 
+    def copy(self, records):
+        """
+        A method to return a copy of the LibraryItem object for a forked Library (see Library.fork), with a copy of its
+        hold queue. The copy is checked out by the copy of the patron the object is checked out by.
+        :param records: a dictionary of the Patrons copied to their copies, the copied HoldHandles are added to it
+        :return: a LibraryItem object of the same type
+        """
+        library_item = _copy_slots(self)
+        checked_out_by = self.get_checked_out_by()
+        if checked_out_by is not None:
+            library_item.set_checked_out_by(records.get(checked_out_by, checked_out_by))
+        hold_queue = self.get_hold_queue()
+        if hold_queue is not None:
+            library_item.set_hold_queue(hold_queue.copy(records))
+        return library_item
+
 
 class Book(LibraryItem):
     """
     A class representing a book type of LibraryItem that patrons may check out, inherits from LibraryItem.
-    Books have authors and a check-out length of 21 days.
+    Books have authors and a default check-out length of 21 days, a library's LoanPolicy may lend them for longer
+    or shorter.
     """
 
+    CHECK_OUT_LENGTH = 21
+
+    __slots__ = ("_author",)
+
     def __init__(self, library_item_id, title, author):
         super().__init__(library_item_id, title)
         self._author = author
@@ -116,20 +388,32 @@ class Book(LibraryItem):
         """
         return self._author
 
+    def get_creator(self):
+        """
+        returns the author for the Book object, so all library items can be searched and stored alike
+        :return: a string, the author
+        """
+        return self.get_author()
+
     def get_check_out_length(self):
         """
-        returns the check-out length for the Book object
+        returns the default check-out length for the Book object
         :return: an integer, 21
         """
-        return 21
+        return self.CHECK_OUT_LENGTH
 
 
 class Album(LibraryItem):
     """
     A class representing an album type of LibraryItem that patrons may check out, inherits from LibraryItem.
-    Albums have artists and a check-out length of 14 days.
+    Albums have artists and a default check-out length of 14 days, a library's LoanPolicy may lend them for longer
+    or shorter.
     """
 
+    CHECK_OUT_LENGTH = 14
+
+    __slots__ = ("_artist",)
+
     def __init__(self, library_item_id, title, artist):
         super().__init__(library_item_id, title)
         self._artist = artist
@@ -141,20 +425,32 @@ class Album(LibraryItem):
         """
         return self._artist
 
+    def get_creator(self):
+        """
+        returns the artist for the Album object, so all library items can be searched and stored alike
+        :return: a string, the artist
+        """
+        return self.get_artist()
+
     def get_check_out_length(self):
         """
-        returns the check-out length for the Album object
+        returns the default check-out length for the Album object
         :return: an integer, 14
         """
-        return 14
+        return self.CHECK_OUT_LENGTH
 
 
 class Movie(LibraryItem):
     """
     A class representing a movie type of LibraryItem that patrons may check out, inherits from LibraryItem.
-    Movies have directors and a check-out length of 7 days.
+    Movies have directors and a default check-out length of 7 days, a library's LoanPolicy may lend them for longer
+    or shorter.
     """
 
+    CHECK_OUT_LENGTH = 7
+
+    __slots__ = ("_director",)
+
     def __init__(self, library_item_id, title, director):
         super().__init__(library_item_id, title)
         self._director = director
@@ -166,262 +462,2901 @@ class Movie(LibraryItem):
         """
         return self._director
 
+    def get_creator(self):
+        """
+        returns the director for the Movie object, so all library items can be searched and stored alike
+        :return: a string, the director
+        """
+        return self.get_director()
+
     def get_check_out_length(self):
         """
-        returns the check-out length for the Movie object
+        returns the default check-out length for the Movie object
         :return: an integer, 7
         """
-        return 7
+        return self.CHECK_OUT_LENGTH
 
 
-class Patron:
+ITEM_TYPES = (Book, Album, Movie)  # an item's type code is its index in ITEM_TYPES
+
+
+def get_item_type(library_item):
     """
-    A class representing a patron of the library. The patron may check out items from the library and
-    accrue fees for keeping items past the return date.
+    returns which of Book, Album or Movie a library item is, ItemStore views report the type they are a view of
+    :param library_item: a Book, Album or Movie object
+    :return: Book, Album or Movie
+    """
+    for item_type in ITEM_TYPES:
+        if isinstance(library_item, item_type):
+            return item_type
+    return None
 
-    We have 4 data members:
-    * patron_id, a unique identifier (assumed unique)
-    * name, (of patron) cannot be assumed unique
-    * check_out_items, collection of LibraryItems that a Patron currently has checked out
-    * fine_amount, how much patron owes in fines, may be negative
+
+_ITEM_TYPE_CODES = {}  # class of a library item -> its type code, filled in by get_item_type_code
+
+
+def get_item_type_code(library_item):
     """
+    returns the type code of a library item, its type's index in ITEM_TYPES. The code is looked up by the item's class
+    after the first item of each class.
+    :param library_item: a Book, Album or Movie object
+    :return: an integer, 0 for a Book, 1 for an Album or 2 for a Movie
+    """
+    type_code = _ITEM_TYPE_CODES.get(type(library_item))
+    if type_code is None:
+        type_code = _ITEM_TYPE_CODES[type(library_item)] = ITEM_TYPES.index(get_item_type(library_item))
+    return type_code
 
-    def __init__(self, patron_id, name):
-        self._patron_id = patron_id
-        self._name = name
-        self._checked_out_items = []
-        self._fine_amount = 0
 
-    def amend_fine(self, amount):
-        """
-        receives as an argument a negative or positive value and changes the fine_amount data member by that amount
-        :return: None
-        """
-        new_amount = self._fine_amount + amount
-        self._fine_amount = new_amount
+class ItemStore:
+    """
+    A columnar store of library items, for catalogs too large to keep one LibraryItem object per item.
 
-    def get_fine_amount(self):
-        """
-        returns the current fine amount owed by the patron to the library
-        :return: fine amount
-        """
-        return self._fine_amount
+    Each item is a row. ids, titles and creators (author, artist or director) are lists, the type code, location code
+    and date checked out are typed arrays, and checked_out_by/hold_queues are sparse dictionaries of row to Patron and
+    HoldQueue since most items are on the shelf and unrequested. get() hands out a
+    lightweight view (StoredBook, StoredAlbum or StoredMovie) that reads and writes its row through the usual getters
+    and setters, so a view can be added to a Library like any other LibraryItem. Views of the same row compare equal.
 
-    def get_patron_id(self):
-        """
-        returns the unique patron_id for the patron
-        :return: patron_id
-        """
-        return self._patron_id
+    A forked store (see fork) shares the ids, titles, creators and types with the store it was forked from until
+    either adds an item.
+    """
 
-    def get_name(self):
-        """
-        returns the name of the library patron
-        :return: a string, patron's name
-        """
-        return self._name
+    __slots__ = ("_ids", "_titles", "_creators", "_types", "_locations", "_dates", "_checked_out_by",
+                 "_hold_queues", "_rows", "_shared")
 
-    def set_name(self, new_name):
+    def __init__(self):
+        self._ids = []
+        self._titles = []
+        self._creators = []
+        self._types = array("b")
+        self._locations = array("b")
+        self._dates = array("i")  # -1 when the item has never been checked out
+        self._checked_out_by = {}
+        self._hold_queues = {}
+        self._rows = {}  # library_item_id -> row
+        self._shared = False  # whether the columns that are only appended to are shared with a forked store
+
+    def __len__(self):
+        return len(self._ids)
+
+    def fork(self, records):
+        """
+        returns a store with the same items for a forked Library (see Library.fork). The ids, titles, creators and
+        types are shared until either store adds an item; the locations and dates are copied, as are the hold queues,
+        and the items checked out by a copied patron are checked out by its copy.
+        :param records: a dictionary of the Patrons copied to their copies, the copied HoldHandles are added to it
+        :return: an ItemStore
+        """
+        store = ItemStore()
+        store._ids, store._titles, store._creators = self._ids, self._titles, self._creators
+        store._types, store._rows = self._types, self._rows
+        store._shared = self._shared = True
+        store._locations = array("b", self._locations)
+        store._dates = array("i", self._dates)
+        store._checked_out_by = {row: records.get(patron, patron) for row, patron in self._checked_out_by.items()}
+        store._hold_queues = {row: hold_queue.copy(records) for row, hold_queue in self._hold_queues.items()}
+        return store
+
+    def _unshare(self):
         """
-        changes the name of a current library patron
+        copies the columns shared with a forked store before an item is added
         :return: None
         """
-        self._name = new_name
+        if self._shared:
+            self._ids, self._titles, self._creators = list(self._ids), list(self._titles), list(self._creators)
+            self._types, self._rows = array("b", self._types), dict(self._rows)
+            self._shared = False
 
-    def get_checked_out_items(self):
+    def add(self, item_type, library_item_id, title, creator):
+        """
+        adds a new item on the shelf to the store
+        :param item_type: Book, Album or Movie
+        :param library_item_id: unique identifier of the item
+        :param title: title of the item
+        :param creator: the author, artist or director of the item
+        :return: A string about the result of the add attempt
+        """
+        if library_item_id in self._rows:
+            return "item id already in store"
+        self._unshare()
+        self._rows[library_item_id] = len(self._ids)
+        self._ids.append(library_item_id)
+        self._titles.append(title)
+        self._creators.append(creator)
+        self._types.append(ITEM_TYPES.index(item_type))
+        self._locations.append(0)
+        self._dates.append(-1)
+        return "add successful"
+
+    def extend(self, type_codes, library_item_ids, titles, creators):
+        """
+        Adds many new items on the shelf to the store, given as columns. When no id is repeated the columns are
+        appended whole; otherwise the items are added one at a time and the repeated ids are rejected.
+        :param type_codes: a sequence of item type codes, indexes into ITEM_TYPES
+        :param library_item_ids: a sequence of unique identifiers
+        :param titles: a sequence of titles
+        :param creators: a sequence of authors, artists and directors
+        :return: a list of the positions of the items rejected because their id was already in the store
+        """
+        start = len(self._ids)
+        count = len(library_item_ids)
+        new_rows = dict(zip(library_item_ids, range(start, start + count)))
+        if len(new_rows) != count or not self._rows.keys().isdisjoint(new_rows):
+            return [position for position in range(count)
+                    if self.add(ITEM_TYPES[type_codes[position]], library_item_ids[position], titles[position],
+                                creators[position]) != "add successful"]
+        self._unshare()
+        self._rows.update(new_rows)
+        self._ids.extend(library_item_ids)
+        self._titles.extend(titles)
+        self._creators.extend(creators)
+        self._types.frombytes(bytes(type_codes))
+        self._locations.frombytes(bytes(count))
+        self._dates.extend(array("i", [-1]) * count)
+        return []
+
+    def add_library_item(self, library_item):
+        """
+        copies the state of a Book, Album or Movie object into a new row of the store
+        :param library_item: a Book, Album or Movie object
+        :return: A string about the result of the add attempt
+        """
+        result = self.add(get_item_type(library_item), library_item.get_library_item_id(), library_item.get_title(),
+                          library_item.get_creator())
+        if result == "add successful":
+            view = self.get_row(len(self._ids) - 1)
+            view.set_location(library_item.get_location())
+            view.set_checked_out_by(library_item.get_checked_out_by())
+            view.set_hold_queue(library_item.get_hold_queue())
+            view.set_date_checked_out(library_item.get_date_checked_out())
+        return result
+
+    def __iter__(self):
+        for row in range(len(self._ids)):
+            yield self.get_row(row)
+
+    def get(self, library_item_id):
         """
-        returns the collection of checked_out_items in the form of a list
-        :return: a list of checked out items
+        returns a view of the item with a matching id
+        :param library_item_id: the id of the desired item
+        :return: a StoredBook, StoredAlbum or StoredMovie view, or None if no such item is in the store
         """
-        return self._checked_out_items
+        row = self._rows.get(library_item_id)
+        if row is None:
+            return None
+        return self.get_row(row)
 
-    def add_library_item(self, library_item_being_checked_out):
+    def get_row(self, row):
         """
-        adds the specified item (passed as parameter) to the list of checked_out_items
-        :param library_item_being_checked_out: a LibraryItem object or a subclass object (Book, Album, Movie objects)
-        :return: None
+        returns a view of the item in a row
+        :param row: an integer, the row number
+        :return: a StoredBook, StoredAlbum or StoredMovie view
         """
-        self._checked_out_items.append(library_item_being_checked_out)
+        return STORED_ITEM_TYPES[self._types[row]](self, row)
 
-    def remove_library_item(self, library_item_being_returned):
+    def get_rows(self, start=0):
         """
-        removes the specified item (passed as parameter) from the list of checked out items
-        :param library_item_being_returned: a LibraryItem object or a subclass object (Book, Album, Movie objects)
-        :return: none
+        returns the items from a row on as rows of their columns, without making a view of each, for indexing
+        :param start: the first row
+        :return: an iterator of (library_item_id, type_code, location_code, title, creator) tuples
         """
-        self._checked_out_items.remove(library_item_being_returned)
+        return zip(self._ids[start:], self._types[start:], self._locations[start:], self._titles[start:],
+                   self._creators[start:])
 
 
-class Library:
+class _StoredItem:
     """
-    A class representing a library with a holding of LibraryItem objects that Patrons may check out and return to the
-    Library. Fines will be issued when checked out items go beyond their return date, which is assigned at check out.
-
-    We have three data members:
-    * holdings, a list of LibraryItem objects
-    * members, a list of Patron objects
-    * current_date, an integer representing days since Library object was created
+    Getters and setters shared by the ItemStore views, each reads or writes one column of the view's row. A view keeps
+    only its store and row, so it is registered as a Book, Album or Movie rather than inheriting their data members.
     """
 
-    def __init__(self):
-        self._holdings = []
-        self._members = []
-        self._current_date = 0
+    __slots__ = ("_store", "_row")
 
-    def add_library_item(self, new_library_item):
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __eq__(self, other):
+        return isinstance(other, _StoredItem) and self._store is other._store and self._row == other._row
+
+    def __hash__(self):
+        return hash((id(self._store), self._row))
+
+    def get_library_item_id(self):
         """
-        passes a new library object as a parameter and then adds it to the holdings data member collection
-        :param new_library_item: LibraryItem object
-        :return: None
+        returns the id of the item in the view's row
+        :return: the library item id, unique identifier
         """
-        self._holdings.append(new_library_item)
+        return self._store._ids[self._row]
 
-    def add_patron(self, new_patron):
+    def get_title(self):
         """
-        passes a new patron object as a parameter and then adds it to the 'member' data member collection
-        :param new_patron: Patron object
-        :return: None
+        returns the title of the item in the view's row
+        :return: a string, title
         """
-        self._members.append(new_patron)
+        return self._store._titles[self._row]
 
-    def lookup_library_item_from_id(self, id_request):
+    def get_creator(self):
         """
-        looks through the library's holdings to find and return the LibraryItem object with a library_item_id matching
-        the id_request. Library._holdings looks like: [LibraryItem1, LibraryItem2]
-        :param id_request: the id that the desired Library item object has
-        :return: the Library item object with matching id
+        returns the author, artist or director of the item in the view's row
+        :return: a string, the creator
         """
-        for library_item in self._holdings:
-            if library_item.get_library_item_id() == id_request:
-                return library_item
+        return self._store._creators[self._row]
 
-        return None
+    def get_check_out_length(self):
+        """
+        returns the default check-out length of the item's type
+        :return: an integer, days
+        """
+        return self.CHECK_OUT_LENGTH
 
-    def lookup_patron_from_id(self, id_request):
+    def get_location(self):
         """
-        looks through the library's members to find and return the Patron object with a patron_id matching
-        the id_request. Library._members looks like: [Patron1, Patron2]
-        :param id_request: the id that the desired Patron has
-        :return: the Patron object with matching id
+        returns the current location of the item in the view's row
+        :return: A string, can be "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
         """
-        for patron in self._members:
-            if patron.get_patron_id() == id_request:
-                return patron
+        return LOCATIONS[self._store._locations[self._row]]
 
-        return None
+    def get_location_code(self):
+        """
+        returns the current location of the item in the view's row as its index in LOCATIONS
+        :return: An integer, 0 for "ON_SHELF", 1 for "ON_HOLD_SHELF", or 2 for "CHECKED_OUT"
+        """
+        return self._store._locations[self._row]
 
-    def check_out_library_item(self, patron_id, library_item_id):
+    def set_location(self, location):
         """
-        takes two parameters for the id of the patron checking out the library item, and for the id of the library item
-        being checked out. Checks if the patron is a member and if the library item is in holdings. Then checks to see
-        if the library item is already checked out or on hold for another patron. If none of the above conditions
-        prevent the book from being checked out, then the library item's checked_out_by, date_checked_out, and location,
-        are updated. If the library_item was on hold for this patron, then this hold is updated. Also updates the
-        patron's checked out items.
-        :param patron_id: id of patron checking out
-        :param library_item_id: id of item being checked out
-        :return: A string about the result of the check-out attempt, either the problem encountered or a success message
+        changes the current location of the item in the view's row
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: None
         """
-        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
-        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item is the LibraryItem object
-        if patron == None:
-            return "patron not found"
-        elif library_item == None:
-            return "item not found"
-        else:
-            item_location = library_item.get_location()
-            holding_patron = library_item.get_requested_by()
-            if item_location == "CHECKED_OUT":
-                return "item already checked out"
-            # True if requested by another patron
-            elif item_location == "ON_HOLD_SHELF" and holding_patron.get_patron_id() != patron_id:
-                return "item on hold by other patron"
-            # True if requested by same patron
-            elif item_location == "ON_HOLD_SHELF" and holding_patron.get_patron_id() == patron_id:
-                library_item.set_requested_by(None)
-                library_item.set_checked_out_by(patron)
-                library_item.set_date_checked_out(self._current_date)
-                library_item.set_location("CHECKED_OUT")
-                patron.add_library_item(library_item)
-                return "check out successful"
-            else:  # Runs whenever book is available (not checked out or requested)
-                library_item.set_checked_out_by(patron)
-                library_item.set_date_checked_out(self._current_date)
-                library_item.set_location("CHECKED_OUT")
-                patron.add_library_item(library_item)
-                return "check out successful"
+        self._store._locations[self._row] = LOCATION_CODES[location]
 
-    def return_library_item(self, library_item_id):
+    def get_checked_out_by(self):
         """
-        Takes a parameter for the id of the library item being returned. Checks to see if the item belongs to the
-        library. Ensures that the item was checked out. If all is in order, returns the book and updates the patron's
-        checked out items, the library item's location, and the library item's checked_out_by data member.
-        :param library_item_id: id of the library item being returned
-        :return: A string about the result of the return attempt
+        returns the patron that has checked out the item in the view's row
+        :return: None or the patron object that has checked out the item
         """
-        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item refers to LibraryItem object
-        if library_item == None:
-            return "item not found"
-        elif library_item.get_location() != "CHECKED_OUT":  # True if library item on hold or on shelf already
-            return "item already in library"
+        return self._store._checked_out_by.get(self._row)
+
+    def set_checked_out_by(self, checked_out_by):
+        """
+        changes the patron that has checked out the item in the view's row
+        :param checked_out_by: None or a Patron object
+        :return: None
+        """
+        if checked_out_by is None:
+            self._store._checked_out_by.pop(self._row, None)
         else:
-            patron = library_item.get_checked_out_by()  # patron refers to Patron object
-            patron.remove_library_item(library_item)
-            library_item.set_checked_out_by(None)
-            if library_item.get_requested_by() == None:  # Runs when item does not have a request
-                library_item.set_location("ON_SHELF")
-                return "return successful"
-            else:  # Runs when item has a request
-                library_item.set_location("ON_HOLD_SHELF")
-                return "return successful"
+            self._store._checked_out_by[self._row] = checked_out_by
 
-    def request_library_item(self, patron_id, library_item_id):
+    def get_hold_queue(self):
         """
-        Takes the id of the patron and id of the library item as parameters. Checks if the patron is a member of the
-        library and if the library item is in the library's holdings. Checks if the library item is already on hold.
-        Otherwise, updates the item's requested_by data member and moves it to "ON_HOLD_SHELF".
-        :param patron_id: id of patron requesting item
-        :param library_item_id: id of library item being requested
-        :return: a string about the result of request
+        returns the queue of patrons waiting for the item in the view's row
+        :return: None or the HoldQueue, None if the item has never been requested
         """
-        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
-        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item is the LibraryItem object
-        if patron == None:
-            return "patron not found"
-        elif library_item == None:
-            return "item not found"
-        # Runs if library item is already requested, either is on hold or will be placed on hold when returned
-        elif library_item.get_requested_by() != None:
-            return "item already on hold"
-        else:  # Runs when item and patron are valid and item is not already requested
-            library_item.set_requested_by(patron)
-            if library_item.get_location == "ON_SHELF":
-                library_item.set_location("ON_HOLD_SHELF")
-            return "request successful"
+        return self._store._hold_queues.get(self._row)
 
-    def pay_fine(self, patron_id, payment_amount):
+    def set_hold_queue(self, hold_queue):
         """
-        Takes the patron id and the amount they are paying as parameters. Checks if the patron is a member of the
-        library. If they are a member, the amend_fine() function is used to lower the patron's fine by the amount paid.
-        :param patron_id: id of patron paying
-        :param payment_amount: the amount being paid, in dollars (float or int)
-        :return: A string about the result of payment
+        changes the queue of patrons waiting for the item in the view's row
+        :param hold_queue: None or a HoldQueue
+        :return: None
         """
-        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
-        if patron == None:
-            return "patron not found"
+        if hold_queue is None:
+            self._store._hold_queues.pop(self._row, None)
         else:
-            patron.amend_fine(-payment_amount)  # Passes a negative value for payment amount so fine is decreased
-            return "payment successful"
+            self._store._hold_queues[self._row] = hold_queue
 
-    def increment_current_date(self):
+    def get_date_checked_out(self):
+        """
+        returns the date the item in the view's row was last checked out
+        :return: None or the date the item was last checked out
+        """
+        date_checked_out = self._store._dates[self._row]
+        return None if date_checked_out == -1 else date_checked_out
+
+    def set_date_checked_out(self, date_checked_out):
         """
-        Increments the current day by one and charges 0.1 dollars to each patron for each library item they have overdue
+        changes the date the item in the view's row was last checked out
+        :param date_checked_out: None or the date
         :return: None
         """
-        self._current_date += 1
-        for member in self._members:
-            for item in member.get_checked_out_items():
-                if item.get_date_checked_out() + item.get_check_out_length() < self._current_date:
-                    member.amend_fine(.1) # adds 10 cents to fine for each book a patron has overdue
+        self._store._dates[self._row] = -1 if date_checked_out is None else date_checked_out
+
+    add_hold = LibraryItem.add_hold
+    get_requested_by = LibraryItem.get_requested_by
+    set_requested_by = LibraryItem.set_requested_by
+
+
+class StoredBook(_StoredItem):
+    """
+    A view of a Book row in an ItemStore.
+    """
+
+    __slots__ = ()
+
+    CHECK_OUT_LENGTH = Book.CHECK_OUT_LENGTH
+
+    get_author = _StoredItem.get_creator
+
+
+class StoredAlbum(_StoredItem):
+    """
+    A view of an Album row in an ItemStore.
+    """
+
+    __slots__ = ()
+
+    CHECK_OUT_LENGTH = Album.CHECK_OUT_LENGTH
 
+    get_artist = _StoredItem.get_creator
+
+
+class StoredMovie(_StoredItem):
+    """
+    A view of a Movie row in an ItemStore.
+    """
+
+    __slots__ = ()
+
+    CHECK_OUT_LENGTH = Movie.CHECK_OUT_LENGTH
+
+    get_director = _StoredItem.get_creator
+
+
+Book.register(StoredBook)
+Album.register(StoredAlbum)
+Movie.register(StoredMovie)
+STORED_ITEM_TYPES = (StoredBook, StoredAlbum, StoredMovie)
+
+
+class SearchIndex:
+    """
+    An inverted index over the titles and creators (author, artist or director) of library items.
+
+    Titles and creators are split into lowercase word tokens. Every indexed item gets a document number, and each
+    field keeps a dictionary of token to the array of document numbers containing it, appended in increasing order as
+    items are added. A sorted vocabulary of every token serves prefix terms. Per document the index keeps the item id,
+    the type code and the number of tokens, which is used to rank shorter (closer) matches first.
+
+    A forked index (see fork) reads the documents of the index it was forked from as its base and keeps only the
+    documents added since, numbered after the base's.
+    """
+
+    __slots__ = ("_item_ids", "_types", "_lengths", "_postings", "_vocabulary", "_base")
+
+    FIELDS = ("title", "creator")
+
+    def __init__(self):
+        self._item_ids = []
+        self._types = array("b")
+        self._lengths = array("H")
+        self._postings = {"title": {}, "creator": {}}
+        self._vocabulary = []
+        self._base = None  # SearchIndex shared with the indexes forked from the same one, see fork
+
+    def __len__(self):
+        return len(self._item_ids) + (0 if self._base is None else len(self._base))
+
+    def fork(self):
+        """
+        returns an index of the same documents that shares them rather than copying them. Forking an index that was
+        never forked shares all of its documents, so it must not be added to afterwards: a library forking its index
+        replaces it with a second fork. Forking a forked index shares its base and copies the documents added since.
+        :return: a SearchIndex
+        """
+        index = SearchIndex()
+        if self._base is None:
+            index._base = self
+        else:
+            index._base = self._base
+            index._item_ids = list(self._item_ids)
+            index._types = array("b", self._types)
+            index._lengths = array("H", self._lengths)
+            index._postings = {field: {token: array("i", documents) for token, documents in postings.items()}
+                               for field, postings in self._postings.items()}
+            index._vocabulary = list(self._vocabulary)
+        return index
+
+    def _columns(self):
+        """
+        returns the item ids, type codes and lengths of the documents, indexed by document number
+        :return: a tuple of three sequences
+        """
+        if self._base is None:
+            return self._item_ids, self._types, self._lengths
+        base = self._base
+        return (_JoinedColumn(base._item_ids, self._item_ids), _JoinedColumn(base._types, self._types),
+                _JoinedColumn(base._lengths, self._lengths))
+
+    @staticmethod
+    def tokenize(text):
+        """
+        splits text into lowercase word tokens
+        :param text: a string
+        :return: a list of tokens
+        """
+        return re.findall(r"\w+", text.lower())
+
+    def add_library_item(self, library_item):
+        """
+        indexes the title and creator of a library item
+        :param library_item: a Book, Album or Movie object
+        :return: None
+        """
+        new_tokens = []
+        self._add_document(library_item.get_library_item_id(), get_item_type_code(library_item),
+                           library_item.get_title(), library_item.get_creator(), new_tokens)
+        for token in new_tokens:
+            bisect.insort(self._vocabulary, token)
+
+    def add_library_items(self, library_items):
+        """
+        indexes the titles and creators of many library items, sorting the new tokens into the vocabulary once at the
+        end rather than one at a time
+        :param library_items: an iterable of Book, Album and Movie objects
+        :return: None
+        """
+        self.add_rows((library_item.get_library_item_id(), get_item_type_code(library_item), library_item.get_title(),
+                       library_item.get_creator()) for library_item in library_items)
+
+    def add_rows(self, rows):
+        """
+        indexes many items given as rows rather than as library items, as read from an item store, sorting the new
+        tokens into the vocabulary once at the end
+        :param rows: an iterable of (library_item_id, type_code, title, creator) tuples
+        :return: None
+        """
+        new_tokens = []
+        for library_item_id, type_code, title, creator in rows:
+            self._add_document(library_item_id, type_code, title, creator, new_tokens)
+        if new_tokens:
+            self._vocabulary.extend(new_tokens)
+            self._vocabulary.sort()
+
+    def _add_document(self, library_item_id, type_code, title, creator, new_tokens):
+        """
+        adds an item's tokens to the postings
+        :param library_item_id: id of the item
+        :param type_code: the item's type code
+        :param title: the item's title
+        :param creator: the item's author, artist or director
+        :param new_tokens: a list the tokens not yet in the vocabulary are appended to
+        :return: None
+        """
+        document = len(self)
+        self._item_ids.append(library_item_id)
+        self._types.append(type_code)
+        length = 0
+        for field, text in (("title", title), ("creator", creator)):
+            postings = self._postings[field]
+            for token in set(self.tokenize(text)):
+                documents = postings.get(token)
+                if documents is None:
+                    documents = postings[token] = array("i")
+                    if token not in self._postings["title" if field == "creator" else "creator"]:
+                        new_tokens.append(token)
+                documents.append(document)
+                length += 1
+        self._lengths.append(min(length, 65535))
+
+    def _documents_for(self, term, fields):
+        """
+        returns the documents matching one query term, a term ending in "*" matches every token it is a prefix of
+        :param term: a lowercase token, optionally ending in "*"
+        :param fields: the fields to look in
+        :return: a set of document numbers
+        """
+        documents = set() if self._base is None else self._base._documents_for(term, fields)
+        if term.endswith("*"):
+            prefix = term[:-1]
+            position = bisect.bisect_left(self._vocabulary, prefix)
+            tokens = []
+            while position < len(self._vocabulary) and self._vocabulary[position].startswith(prefix):
+                tokens.append(self._vocabulary[position])
+                position += 1
+        else:
+            tokens = [term]
+        for field in fields:
+            postings = self._postings[field]
+            for token in tokens:
+                documents.update(postings.get(token, ()))
+        return documents
+
+    def search(self, query, item_type=None, field=None, limit=None, item_ids=None):
+        """
+        Finds the items matching every term of a query. Terms ending in "*" are prefix terms.
+        :param query: a string such as "harry potter" or "miya*"
+        :param item_type: None for any item, or Book, Album or Movie to only return items of that type
+        :param field: None to match terms in titles or creators, or "title" or "creator" to match in only one
+        :param limit: None for every match, or the greatest number of item ids to return
+        :param item_ids: None, or a collection of item ids supporting "in" that matches must also be in
+        :return: a list of matching item ids, items with fewer indexed words first, then in the order they were added
+        """
+        fields = self.FIELDS if field is None else (field,)
+        terms = re.findall(r"\w+\*?", query.lower())
+        if not terms:
+            return []
+        matches = None
+        for documents in sorted((self._documents_for(term, fields) for term in terms), key=len):
+            matches = documents if matches is None else matches & documents
+            if not matches:
+                return []
+        document_item_ids, types, lengths = self._columns()
+        if item_type is not None:
+            type_code = ITEM_TYPES.index(item_type)
+            matches = [document for document in matches if types[document] == type_code]
+        if item_ids is not None:
+            matches = [document for document in matches if document_item_ids[document] in item_ids]
+        if limit is None:
+            ranked = sorted(matches, key=lambda document: (lengths[document], document))
+        else:
+            ranked = heapq.nsmallest(limit, matches, key=lambda document: (lengths[document], document))
+        return [document_item_ids[document] for document in ranked]
+
+
+class _JoinedColumn:
+    """
+    A column of a forked SearchIndex, the base index's column followed by the forked index's own.
+    """
+
+    __slots__ = ("_base", "_own", "_offset")
+
+    def __init__(self, base, own):
+        self._base = base
+        self._own = own
+        self._offset = len(base)
+
+    def __getitem__(self, document):
+        return self._base[document] if document < self._offset else self._own[document - self._offset]
+
+
+class AvailabilityIndex:
+    """
+    An index of which library items are at each location, partitioned by item type.
+
+    For every item type and location there is an insertion-ordered dictionary used as a set of item ids. Counting the
+    items at a location is the length of one to three dictionaries, listing them iterates only those dictionaries, and
+    checking one item is a dictionary lookup, which makes intersecting with search results cheap.
+
+    A forked index (see fork) shares the partitions of the index it was forked from as its base. Its own partitions
+    hold only the items added or moved since, and an item that moved away from its base partition is hidden there.
+    """
+
+    __slots__ = ("_states", "_base", "_hidden")
+
+    def __init__(self):
+        self._states = [[{} for location in LOCATIONS] for item_type in ITEM_TYPES]
+        self._base = None  # partitions shared with the indexes forked from the same one, see fork
+        self._hidden = None  # per type and location, the ids in the base partition that have moved away
+
+    def fork(self):
+        """
+        returns an index of the same items that shares their partitions rather than copying them. Forking an index
+        that was never forked shares all of its partitions, so it must not be changed afterwards: a library forking its
+        index replaces it with a second fork. Forking a forked index shares its base and copies the changes since.
+        :return: an AvailabilityIndex
+        """
+        index = AvailabilityIndex()
+        if self._base is None:
+            index._base = self._states
+            index._hidden = [[{} for location in LOCATIONS] for item_type in ITEM_TYPES]
+        else:
+            index._base = self._base
+            index._states = [[dict(partition) for partition in states] for states in self._states]
+            index._hidden = [[dict(partition) for partition in hidden] for hidden in self._hidden]
+        return index
+
+    def add(self, library_item_id, type_code, location_code):
+        """
+        files an item under its location
+        :param library_item_id: id of the item
+        :param type_code: the item's type code
+        :param location_code: the item's location code
+        :return: None
+        """
+        self._states[type_code][location_code][library_item_id] = None
+
+    def move(self, library_item_id, type_code, old_location_code, new_location_code):
+        """
+        moves an item from one location to another, an item not yet filed is filed under its new location
+        :param library_item_id: id of the item
+        :param type_code: the item's type code
+        :param old_location_code: location code the item is leaving
+        :param new_location_code: location code the item is moving to
+        :return: None
+        """
+        states = self._states[type_code]
+        if self._base is None:
+            states[old_location_code].pop(library_item_id, None)
+            states[new_location_code][library_item_id] = None
+            return
+        base, hidden = self._base[type_code], self._hidden[type_code]
+        if library_item_id in base[old_location_code] and library_item_id not in hidden[old_location_code]:
+            hidden[old_location_code][library_item_id] = None
+        else:
+            states[old_location_code].pop(library_item_id, None)
+        if library_item_id in hidden[new_location_code]:
+            del hidden[new_location_code][library_item_id]  # back where the base has it
+        else:
+            states[new_location_code][library_item_id] = None
+
+    def _partitions(self, location_code, type_code):
+        """
+        returns the dictionaries holding the items at a location
+        :param location_code: a location code
+        :param type_code: None for every type, or a type code
+        :return: a list of dictionaries
+        """
+        if type_code is None:
+            return [states[location_code] for states in self._states]
+        return [self._states[type_code][location_code]]
+
+    def _base_partitions(self, location_code, type_code):
+        """
+        returns the base dictionaries holding the items at a location, with the ids hidden in each
+        :param location_code: a location code
+        :param type_code: None for every type, or a type code
+        :return: a list of (dictionary, hidden ids) tuples, empty if the index was not forked
+        """
+        if self._base is None:
+            return []
+        type_codes = range(len(ITEM_TYPES)) if type_code is None else (type_code,)
+        return [(self._base[code][location_code], self._hidden[code][location_code]) for code in type_codes]
+
+    def count(self, location_code, type_code=None):
+        """
+        returns the number of items at a location
+        :param location_code: a location code
+        :param type_code: None for every type, or a type code
+        :return: an integer
+        """
+        return (sum(len(partition) for partition in self._partitions(location_code, type_code))
+                + sum(len(partition) - len(hidden) for partition, hidden in
+                      self._base_partitions(location_code, type_code)))
+
+    def get_item_ids(self, location_code, type_code=None):
+        """
+        returns the ids of the items at a location
+        :param location_code: a location code
+        :param type_code: None for every type, or a type code
+        :return: an iterator of item ids
+        """
+        for partition, hidden in self._base_partitions(location_code, type_code):
+            if hidden:
+                yield from (library_item_id for library_item_id in partition if library_item_id not in hidden)
+            else:
+                yield from partition
+        for partition in self._partitions(location_code, type_code):
+            yield from partition
+
+    def contains(self, library_item_id, location_code, type_code=None):
+        """
+        returns whether an item is at a location
+        :param library_item_id: id of the item
+        :param location_code: a location code
+        :param type_code: None for every type, or a type code
+        :return: a boolean
+        """
+        return (any(library_item_id in partition for partition in self._partitions(location_code, type_code))
+                or any(library_item_id in partition and library_item_id not in hidden
+                       for partition, hidden in self._base_partitions(location_code, type_code)))
+
+
+class _ItemsAt:
+    """
+    The ids of the items at one location, as a container for SearchIndex.search to intersect with.
+    """
+
+    __slots__ = ("_index", "_location_code", "_type_code")
+
+    def __init__(self, index, location_code, type_code):
+        self._index = index
+        self._location_code = location_code
+        self._type_code = type_code
+
+    def __contains__(self, library_item_id):
+        return self._index.contains(library_item_id, self._location_code, self._type_code)
+
+
+# settings a LoanPolicy rule may give; a loan's terms are the first four, in this order, see LoanPolicy.get_table
+LOAN_SETTINGS = ("loan_days", "daily_fine_cents", "fine_cap_cents", "grace_days", "max_loans")
+
+
+class LoanPolicy:
+    """
+    The rules a library lends by. For each item type and patron class there is a loan length in days, a fine per day
+    overdue in cents, a cap on the fine for one loan in cents (None for no cap) and a number of grace days after the
+    due date before the item is overdue; for each patron class there is a limit on the items checked out at once (None
+    for no limit). Without rules, items are lent for their type's get_check_out_length and fined DAILY_FINE_CENTS a
+    day.
+
+    A rule is set for an item type, a patron class, both or neither, and gives some of the settings. A more specific
+    rule overrides a more general one for the settings it gives: a rule for both an item type and a patron class beats
+    one for the patron class, which beats one for the item type, which beats one for neither. Among rules as specific,
+    the later wins.
+
+    The rules are not read on each loan. get_table compiles the rules for a patron class into a lookup table by item
+    type code the first time the class is seen, and setting a rule drops the tables so they are compiled again.
+    """
+
+    def __init__(self):
+        self._rules = []  # (item_type, patron_class, settings) in the order they were set
+        self._tables = {}  # patron class -> compiled table, see get_table
+
+    def set_rule(self, item_type=None, patron_class=None, **settings):
+        """
+        Adds a rule, for example set_rule(Movie, "child", loan_days=3, fine_cap_cents=200) or
+        set_rule(patron_class="staff", max_loans=None).
+        :param item_type: None for every item, or Book, Album or Movie
+        :param patron_class: None for every patron, or a patron class
+        :param settings: values of any of the LOAN_SETTINGS, max_loans only in a rule for every item type
+        :return: None
+        """
+        unknown = sorted(set(settings).difference(LOAN_SETTINGS))
+        if unknown:
+            raise ValueError("unknown loan setting " + ", ".join(unknown))
+        if item_type is not None and item_type not in ITEM_TYPES:
+            raise ValueError("unknown item type " + repr(item_type))
+        if item_type is not None and "max_loans" in settings:
+            raise ValueError("max_loans is set for every item type, not for one")
+        self._rules.append((item_type, patron_class, dict(settings)))
+        self._tables = {}
+
+    def copy(self):
+        """
+        returns a policy with the same rules, which may be changed without changing this one
+        :return: a LoanPolicy object
+        """
+        loan_policy = LoanPolicy()
+        loan_policy._rules = list(self._rules)
+        loan_policy._tables = dict(self._tables)
+        return loan_policy
+
+    def get_rules(self):
+        """
+        returns the rules in the order they were set
+        :return: a list of (item_type, patron_class, settings) tuples
+        """
+        return [(item_type, patron_class, dict(settings)) for item_type, patron_class, settings in self._rules]
+
+    def get_table(self, patron_class):
+        """
+        returns the compiled rules for a patron class, compiling them the first time the class is seen
+        :param patron_class: a patron class
+        :return: a tuple of the loan limit (None for no limit) and a tuple, indexed by item type code, of each type's
+        (loan_days, daily_fine_cents, fine_cap_cents, grace_days)
+        """
+        table = self._tables.get(patron_class)
+        if table is None:
+            table = self._tables[patron_class] = self._compile(patron_class)
+        return table
+
+    def _compile(self, patron_class):
+        """
+        merges the rules that apply to a patron class, from the most general to the most specific
+        :param patron_class: a patron class
+        :return: the table, see get_table
+        """
+        rules = sorted((rule for rule in self._rules if rule[1] is None or rule[1] == patron_class),
+                       key=lambda rule: (rule[1] is not None, rule[0] is not None))
+        max_loans = None
+        for item_type, rule_class, settings in rules:
+            if item_type is None:
+                max_loans = settings.get("max_loans", max_loans)
+        terms = []
+        for item_type in ITEM_TYPES:
+            merged = {"loan_days": item_type.CHECK_OUT_LENGTH, "daily_fine_cents": DAILY_FINE_CENTS,
+                      "fine_cap_cents": None, "grace_days": 0}
+            for rule_type, rule_class, settings in rules:
+                if rule_type is None or rule_type is item_type:
+                    merged.update(settings)
+            terms.append(tuple(merged[setting] for setting in LOAN_SETTINGS[:4]))
+        return max_loans, tuple(terms)
+
+    def get_terms(self, item_type, patron_class=DEFAULT_PATRON_CLASS):
+        """
+        returns the terms an item type is lent on to a patron class
+        :param item_type: Book, Album or Movie
+        :param patron_class: a patron class
+        :return: a dictionary of each of the LOAN_SETTINGS to its value
+        """
+        max_loans, terms = self.get_table(patron_class)
+        return dict(zip(LOAN_SETTINGS, terms[ITEM_TYPES.index(item_type)] + (max_loans,)))
+
+
+class FineReport:
+    """
+    Running totals of the fines owed and the items overdue in a library, kept up to date by the library as fines are
+    amended and items become overdue or are returned, so they can be read without visiting every patron.
+
+    A patron's fine grows each day by the daily fines of its overdue items, so at any date it is the line
+    intercept + daily_fine_cents * date, where the intercept is the fine the patron would have owed on date 0 (see
+    Patron.get_fine_cents). Summing the lines gives the total owed on any date from the sums of the intercepts and of
+    the daily fines. Patrons who owe or may come to owe a fine are kept in a heap per daily fine ordered by intercept;
+    within a heap the order by intercept is the order by fine on every date, so the top debtors on a date are found
+    among the tops of the heaps. A patron's entry is replaced rather than updated
+    when its fine changes, and replaced entries are dropped as they reach the top or when they outnumber live ones.
+    """
+
+    def __init__(self):
+        self._intercept_total = 0  # sum of the patrons' intercepts, in cents
+        self._daily_total = 0  # sum of the patrons' daily fines, in cents
+        self._overdue_total = 0
+        self._overdue_counts = [0 for item_type in ITEM_TYPES]  # overdue items by type code
+        self._debtor_heaps = {}  # daily fine -> heap of (-intercept, sequence, patron)
+        self._sequences = {}  # patron -> sequence of its live heap entry
+        self._sequence = 0
+        self._entry_count = 0
+
+    def copy(self, records):
+        """
+        returns a copy of the report for a forked Library (see Library.fork)
+        :param records: a dictionary of the Patrons copied to their copies, the copy reports on the copies
+        :return: a FineReport object
+        """
+        fine_report = FineReport()
+        fine_report._intercept_total = self._intercept_total
+        fine_report._daily_total = self._daily_total
+        fine_report._overdue_total = self._overdue_total
+        fine_report._overdue_counts = list(self._overdue_counts)
+        fine_report._debtor_heaps = {daily_fine_cents: [(intercept, sequence, records.get(patron, patron))
+                                                        for intercept, sequence, patron in heap]
+                                     for daily_fine_cents, heap in self._debtor_heaps.items()}
+        fine_report._sequences = {records.get(patron, patron): sequence for patron, sequence in self._sequences.items()}
+        fine_report._sequence = self._sequence
+        fine_report._entry_count = self._entry_count
+        return fine_report
+
+    def get_debtors(self):
+        """
+        returns the patrons who owe a fine or have an item overdue
+        :return: a read-only view of Patron objects
+        """
+        return self._sequences.keys()
+
+    def add_patron(self, patron):
+        """
+        adds the fine and overdue items of a patron who joined the library
+        :param patron: Patron object
+        :return: None
+        """
+        self._intercept_total += patron.get_fine_cents(0)
+        self._daily_total += patron.get_daily_fine_cents()
+        self._overdue_total += patron.get_overdue_count()
+        self._file_debtor(patron)
+
+    def amend_fine(self, patron, cents):
+        """
+        records a change made to a patron's fine, as by a payment, after the change is made
+        :param patron: Patron object
+        :param cents: the change in cents
+        :return: None
+        """
+        self._intercept_total += cents
+        self._file_debtor(patron)
+
+    def mark_item_overdue(self, patron, type_code, last_date_not_overdue, daily_fine_cents=DAILY_FINE_CENTS):
+        """
+        records that an item became overdue, after Patron.mark_item_overdue
+        :param patron: the Patron the item is checked out by
+        :param type_code: the item's type code
+        :param last_date_not_overdue: the last date on which the item was not overdue
+        :param daily_fine_cents: the item's fine per day overdue
+        :return: None
+        """
+        self._intercept_total -= daily_fine_cents * last_date_not_overdue
+        self._daily_total += daily_fine_cents
+        self._overdue_total += 1
+        self._overdue_counts[type_code] += 1
+        self._file_debtor(patron)
+
+    def clear_item_overdue(self, patron, type_code, current_date, daily_fine_cents=DAILY_FINE_CENTS):
+        """
+        records that an overdue item was returned, after Patron.clear_item_overdue
+        :param patron: the Patron returning the item
+        :param type_code: the item's type code
+        :param current_date: the date the item was returned
+        :param daily_fine_cents: the item's fine per day overdue, 0 if its fine already reached its cap
+        :return: None
+        """
+        self._intercept_total += daily_fine_cents * current_date
+        self._daily_total -= daily_fine_cents
+        self._overdue_total -= 1
+        self._overdue_counts[type_code] -= 1
+        self._file_debtor(patron)
+
+    def cap_item_fine(self, patron, last_date_fined, daily_fine_cents, remainder_cents):
+        """
+        records that an overdue item's fine reached its cap, after Patron.cap_item_fine
+        :param patron: the Patron the item is checked out by
+        :param last_date_fined: the last date the item was fined its full daily fine
+        :param daily_fine_cents: the item's fine per day overdue
+        :param remainder_cents: the part of the cap left after the full days, charged once
+        :return: None
+        """
+        self._intercept_total += daily_fine_cents * last_date_fined + remainder_cents
+        self._daily_total -= daily_fine_cents
+        self._file_debtor(patron)
+
+    def _file_debtor(self, patron):
+        """
+        replaces a patron's heap entry after its fine changed. A patron who owes nothing and has nothing overdue
+        cannot come to owe a fine without another change, so it is left out of the heaps.
+        :param patron: Patron object
+        :return: None
+        """
+        intercept = patron.get_fine_cents(0)
+        daily_fine_cents = patron.get_daily_fine_cents()
+        if intercept <= 0 and daily_fine_cents <= 0:
+            self._sequences.pop(patron, None)
+            return
+        self._sequence += 1
+        self._sequences[patron] = self._sequence
+        heap = self._debtor_heaps.get(daily_fine_cents)
+        if heap is None:
+            heap = self._debtor_heaps[daily_fine_cents] = []
+        heapq.heappush(heap, (-intercept, self._sequence, patron))
+        self._entry_count += 1
+        if self._entry_count > 2 * len(self._sequences) + 1024:
+            self._rebuild_heaps()
+
+    def _rebuild_heaps(self):
+        """
+        rebuilds the heaps from the live entries only
+        :return: None
+        """
+        self._debtor_heaps = {}
+        for patron, sequence in self._sequences.items():
+            self._debtor_heaps.setdefault(patron.get_daily_fine_cents(), []).append(
+                (-patron.get_fine_cents(0), sequence, patron))
+        for heap in self._debtor_heaps.values():
+            heapq.heapify(heap)
+        self._entry_count = len(self._sequences)
+
+    def get_total_cents(self, current_date):
+        """
+        returns the total of every patron's fine on a date, in O(1)
+        :param current_date: the date, no earlier than the last change recorded
+        :return: an integer, cents
+        """
+        return self._intercept_total + self._daily_total * current_date
+
+    def get_overdue_count(self, type_code=None):
+        """
+        returns the number of overdue items, in O(1)
+        :param type_code: None for every type, or a type code
+        :return: an integer
+        """
+        return self._overdue_total if type_code is None else self._overdue_counts[type_code]
+
+    def get_top_debtors(self, count, current_date):
+        """
+        returns the patrons who owe the most on a date, taking at most count entries from each heap, so in
+        O(count * log(patrons)) for each distinct daily fine
+        :param count: the greatest number of patrons to return
+        :param current_date: the date, no earlier than the last change recorded
+        :return: a list of (Patron, cents) tuples of patrons who owe a fine, largest fine first and ties by patron id
+        """
+        sequences = self._sequences
+        candidates = []
+        for daily_fine_cents, heap in list(self._debtor_heaps.items()):
+            top = []
+            while heap and len(top) < count:
+                entry = heapq.heappop(heap)
+                if sequences.get(entry[2]) == entry[1]:
+                    top.append(entry)
+                else:
+                    self._entry_count -= 1
+            for entry in top:
+                heapq.heappush(heap, entry)
+                candidates.append((entry[2], daily_fine_cents * current_date - entry[0]))
+            if not heap:
+                del self._debtor_heaps[daily_fine_cents]
+        candidates.sort(key=lambda candidate: (-candidate[1], candidate[0].get_patron_id()))
+        return [candidate for candidate in candidates[:count] if candidate[1] > 0]
+
+
+class Patron:
+    """
+    A class representing a patron of the library. The patron may check out items from the library and
+    accrue fees for keeping items past the return date.
+
+    We have 4 data members:
+    * patron_id, a unique identifier (enforced by Library.add_patron)
+    * name, (of patron) cannot be assumed unique
+    * check_out_items, collection of LibraryItems that a Patron currently has checked out, kept as the keys of an
+      insertion-ordered dictionary so items are added and removed in constant time
+    * fine_amount, how much patron owes in fines, may be negative
+
+    Patrons also keep the holds they are waiting on, a dictionary of LibraryItem to HoldHandle, so their holds can be
+    listed and cancelled without searching every hold queue.
+
+    A patron belongs to a patron class, DEFAULT_PATRON_CLASS unless given, which the library's LoanPolicy may lend to
+    on different terms.
+
+    Fines are kept in integer cents and accrue lazily. fine_cents is the fine as of fine_date, and every day after
+    fine_date adds daily_fine_cents, the sum of the daily fines of the overdue_count items (an item whose fine reached
+    its cap adds nothing). The Library the patron belongs to reports when items become overdue, reach their fine cap
+    or are returned, and its current_date is used to bring the fine up to date when read.
+    """
+
+    __slots__ = ("_patron_id", "_name", "_patron_class", "_checked_out_items", "_fine_cents", "_fine_date",
+                 "_overdue_count", "_daily_fine_cents", "_library", "_holds")
+
+    def __init__(self, patron_id, name, patron_class=DEFAULT_PATRON_CLASS):
+        self._patron_id = patron_id
+        self._name = name
+        self._patron_class = patron_class
+        self._checked_out_items = {}
+        self._fine_cents = 0
+        self._fine_date = 0
+        self._overdue_count = 0
+        self._daily_fine_cents = 0
+        self._library = None
+        self._holds = {}
+
+    def amend_fine(self, amount):
+        """
+        receives as an argument a negative or positive value and changes the fine_amount data member by that amount
+        :param amount: the change in dollars (float or int), rounded to the nearest cent
+        :return: None
+        """
+        cents = round(amount * 100)
+        self._fine_cents += cents
+        if self._library is not None:
+            self._library.record_fine_change(self, cents)
+
+    def get_fine_cents(self, current_date):
+        """
+        returns the fine owed on a date, in cents, without bringing the stored fine up to date. Dates before the fine
+        was last brought up to date give the fine the patron would have owed had its overdue items always been overdue,
+        see FineReport.
+        :param current_date: the date
+        :return: an integer, cents
+        """
+        return self._fine_cents + self._daily_fine_cents * (current_date - self._fine_date)
+
+    def get_fine_amount(self):
+        """
+        returns the current fine amount owed by the patron to the library, including fines accrued on overdue items up
+        to the library's current date. The stored fine is not brought up to date, so reading a fine never changes the
+        patron. In a ConcurrentLibrary a read made while another thread changes the patron's fine may mix the fields
+        from before and after the change; the fine is exact once no change to it is in progress.
+        :return: fine amount, in dollars
+        """
+        if self._library is None:
+            return self._fine_cents / 100
+        return self.get_fine_cents(self._library.get_current_date()) / 100
+
+    def accrue_fines(self, current_date):
+        """
+        brings the fine up to current_date by charging the daily fines of the overdue items for every day since the
+        fine was last brought up to date
+        :param current_date: the date the fine is brought up to
+        :return: None
+        """
+        self._fine_cents += self._daily_fine_cents * (current_date - self._fine_date)
+        self._fine_date = current_date
+
+    def mark_item_overdue(self, last_date_not_overdue, daily_fine_cents=DAILY_FINE_CENTS):
+        """
+        records that one more checked out item is overdue, fines for it are charged for every day after the date passed
+        :param last_date_not_overdue: the last date on which the item was not overdue
+        :param daily_fine_cents: the item's fine per day overdue
+        :return: None
+        """
+        self.accrue_fines(last_date_not_overdue)
+        self._overdue_count += 1
+        self._daily_fine_cents += daily_fine_cents
+
+    def clear_item_overdue(self, current_date, daily_fine_cents=DAILY_FINE_CENTS):
+        """
+        records that an overdue item was returned on current_date, fines for it are charged up to and including that date
+        :param current_date: the date the item was returned
+        :param daily_fine_cents: the item's fine per day overdue, 0 if its fine already reached its cap
+        :return: None
+        """
+        self.accrue_fines(current_date)
+        self._overdue_count -= 1
+        self._daily_fine_cents -= daily_fine_cents
+
+    def cap_item_fine(self, last_date_fined, daily_fine_cents, remainder_cents):
+        """
+        records that an overdue item's fine reached its cap: it is charged its full daily fine up to last_date_fined,
+        then remainder_cents once, then nothing more
+        :param last_date_fined: the last date the item is charged its full daily fine
+        :param daily_fine_cents: the item's fine per day overdue
+        :param remainder_cents: the part of the cap left after the full days
+        :return: None
+        """
+        self.accrue_fines(last_date_fined)
+        self._fine_cents += remainder_cents
+        self._daily_fine_cents -= daily_fine_cents
+
+    def get_daily_fine_cents(self):
+        """
+        returns the fine the patron is charged for each day, the sum of the daily fines of its overdue items
+        :return: an integer, cents
+        """
+        return self._daily_fine_cents
+
+    def get_overdue_count(self):
+        """
+        returns the number of checked out items the patron has overdue
+        :return: an integer, number of overdue items
+        """
+        return self._overdue_count
+
+    def get_library(self):
+        """
+        returns the Library the patron is a member of
+        :return: None or the Library object
+        """
+        return self._library
+
+    def set_library(self, library):
+        """
+        changes the Library the patron is a member of, its current_date is used to bring fines up to date
+        :param library: Library object
+        :return: None
+        """
+        self._library = library
+
+    def get_patron_id(self):
+        """
+        returns the unique patron_id for the patron
+        :return: patron_id
+        """
+        return self._patron_id
+
+    def get_name(self):
+        """
+        returns the name of the library patron
+        :return: a string, patron's name
+        """
+        return self._name
+
+    def set_name(self, new_name):
+        """
+        changes the name of a current library patron
+        :return: None
+        """
+        self._name = new_name
+
+    def get_patron_class(self):
+        """
+        returns the class of the patron, which the library's LoanPolicy may lend to on different terms
+        :return: a string
+        """
+        return self._patron_class
+
+    def set_patron_class(self, patron_class):
+        """
+        changes the class of the patron, items already checked out keep the terms they were lent on
+        :param patron_class: a string
+        :return: None
+        """
+        self._patron_class = patron_class
+
+    def get_checked_out_items(self):
+        """
+        returns the collection of checked_out_items as a read-only view, in the order they were checked out
+        :return: a view of the checked out items, supports len(), iteration and "in"
+        """
+        return self._checked_out_items.keys()
+
+    def add_library_item(self, library_item_being_checked_out):
+        """
+        adds the specified item (passed as parameter) to the collection of checked_out_items
+        :param library_item_being_checked_out: a LibraryItem object or a subclass object (Book, Album, Movie objects)
+        :return: None
+        """
+        self._checked_out_items[library_item_being_checked_out] = None
+
+    def remove_library_item(self, library_item_being_returned):
+        """
+        removes the specified item (passed as parameter) from the collection of checked out items
+        :param library_item_being_returned: a LibraryItem object or a subclass object (Book, Album, Movie objects)
+        :return: none
+        """
+        del self._checked_out_items[library_item_being_returned]
+
+    def get_holds(self):
+        """
+        returns the library items the patron is waiting on, in the order they were requested
+        :return: a read-only view of LibraryItem objects, supports len(), iteration and "in"
+        """
+        return self._holds.keys()
+
+    def get_hold(self, library_item):
+        """
+        returns the patron's hold on a library item
+        :param library_item: a LibraryItem object
+        :return: the HoldHandle of the hold, or None if the patron is not waiting on the item
+        """
+        return self._holds.get(library_item)
+
+    def add_hold(self, library_item, hold_handle):
+        """
+        records that the patron is waiting on a library item
+        :param library_item: a LibraryItem object
+        :param hold_handle: the HoldHandle of the hold in the item's hold queue
+        :return: None
+        """
+        self._holds[library_item] = hold_handle
+
+    def remove_hold(self, library_item):
+        """
+        records that the patron is no longer waiting on a library item, as when the hold is filled or cancelled
+        :param library_item: a LibraryItem object
+        :return: None
+        """
+        del self._holds[library_item]
+
+    def copy(self, library):
+        """
+        returns a copy of the patron as a member of another library, for a forked Library (see Library.fork). The copy
+        has the checked out items and holds of this patron until relink replaces them with their copies.
+        :param library: the Library the copy is a member of
+        :return: a Patron object
+        """
+        patron = _copy_slots(self)
+        patron._checked_out_items = dict(self._checked_out_items)
+        patron._holds = dict(self._holds)
+        patron._library = library
+        return patron
+
+    def relink(self, records):
+        """
+        replaces the patron's checked out items and holds with their copies
+        :param records: a dictionary of each LibraryItem and HoldHandle of the patron to its copy
+        :return: None
+        """
+        self._checked_out_items = {records[library_item]: None for library_item in self._checked_out_items}
+        self._holds = {records[library_item]: records[handle] for library_item, handle in self._holds.items()}
+
+
+class _SharedRecords(Mapping):
+    """
+    The library items or patrons of a forked Library by id (see Library.fork): a dictionary of the records the library
+    owns over a base dictionary shared by every library forked from the same one. Records are only added to or
+    replaced in the owned dictionary, never removed, so the base is not changed once it is shared.
+    """
+
+    __slots__ = ("_owned", "_base", "_added")
+
+    def __init__(self, owned, base):
+        self._owned = owned
+        self._base = base
+        self._added = sum(1 for key in owned if key not in base)  # owned keys the base does not have
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._added += 1
+        self._owned[key] = value
+
+    def __contains__(self, key):
+        return key in self._owned or key in self._base
+
+    def __len__(self):
+        return len(self._base) + self._added
+
+    def __iter__(self):
+        yield from self._base
+        base = self._base
+        yield from (key for key in self._owned if key not in base)
+
+    def get(self, key, default=None):
+        value = self._owned.get(key)
+        return self._base.get(key, default) if value is None else value
+
+    def own(self, key, record):
+        """
+        adds a copy of a shared record to the owned records, unless the library already owns one as when another
+        thread copied it first
+        :param key: an item or patron id
+        :param record: the copy
+        :return: the record the library owns
+        """
+        owned = self._owned.setdefault(key, record)
+        if owned is record and key not in self._base:
+            self._added += 1
+        return owned
+
+    def owns(self, key):
+        """
+        returns whether the library owns the record with a key rather than sharing it
+        :param key: an item or patron id
+        :return: a boolean
+        """
+        return key in self._owned
+
+    def get_owned(self):
+        """
+        returns the records the library owns
+        :return: a dictionary of id to record
+        """
+        return self._owned
+
+    def get_base(self):
+        """
+        returns the records shared with the libraries forked from the same one
+        :return: a dictionary of id to record
+        """
+        return self._base
+
+
+class _ForkBase:
+    """
+    The records a library that is not itself a fork shares with its forks (see Library.fork): frozen copies of the
+    library items and patrons that were idle when the base was made, and the ids of the records the library has used
+    since, whose copies may be out of date. The library's own records are never shared, so it goes on changing them in
+    place; the frozen copies are only read, and a fork copies one before changing it.
+    """
+
+    __slots__ = ("_library_items", "_patrons", "_changed_item_ids", "_changed_patron_ids")
+
+    def __init__(self, library_items, patrons, changed_item_ids, changed_patron_ids):
+        """
+        :param library_items: a dictionary of id to frozen copy of each idle library item
+        :param patrons: a dictionary of id to frozen copy of each idle patron
+        :param changed_item_ids: a set of the ids of the library items that have no frozen copy
+        :param changed_patron_ids: a set of the ids of the patrons that have no frozen copy
+        """
+        self._library_items = library_items
+        self._patrons = patrons
+        self._changed_item_ids = changed_item_ids
+        self._changed_patron_ids = changed_patron_ids
+
+    def change_library_item(self, library_item_id):
+        """
+        records that a library item may have changed since its copy was frozen
+        :param library_item_id: id of the item
+        :return: None
+        """
+        self._changed_item_ids.add(library_item_id)
+
+    def change_patron(self, patron_id):
+        """
+        records that a patron may have changed since its copy was frozen
+        :param patron_id: id of the patron
+        :return: None
+        """
+        self._changed_patron_ids.add(patron_id)
+
+    def get_changed_item_ids(self):
+        """
+        returns the ids of the library items a fork must copy from the library rather than share
+        :return: a list of library item ids
+        """
+        return list(self._changed_item_ids)
+
+    def get_changed_patron_ids(self):
+        """
+        returns the ids of the patrons a fork must copy from the library rather than share
+        :return: a list of patron ids
+        """
+        return list(self._changed_patron_ids)
+
+    def get_library_items(self):
+        """
+        returns the frozen library items
+        :return: a dictionary of id to LibraryItem object
+        """
+        return self._library_items
+
+    def get_patrons(self):
+        """
+        returns the frozen patrons
+        :return: a dictionary of id to Patron object
+        """
+        return self._patrons
+
+    def is_stale(self):
+        """
+        returns whether more records have changed than are frozen, when copying the changed records into each fork
+        costs more than freezing every idle record again
+        :return: a boolean
+        """
+        return (len(self._changed_item_ids) + len(self._changed_patron_ids)
+                > len(self._library_items) + len(self._patrons))
+
+
+class Library:
+    """
+    A class representing a library with a holding of LibraryItem objects that Patrons may check out and return to the
+    Library. Fines will be issued when checked out items go beyond their return date, which is assigned at check out.
+
+    We have three data members:
+    * holdings, a dictionary of LibraryItem objects keyed by library_item_id
+    * members, a dictionary of Patron objects keyed by patron_id
+    * current_date, an integer representing days since Library object was created
+
+    Holdings may also be backed by an item store passed to the init method, such as an ItemStore or the items of a
+    loaded snapshot (see library_persistence.py). Items in the store are not copied into holdings; lookups fall back
+    to the store's get() method.
+
+    Overdue fines are event driven. Each check-out files the item in overdue_buckets under the first date it will be
+    overdue, and overdue_dates is a heap of those dates. Advancing the date only visits the buckets that came due, and
+    the patrons then accrue their fines lazily (see Patron). Loan lengths, daily fines, fine caps, grace days and loan
+    limits come from the library's LoanPolicy; each loan's terms are looked up in the policy's compiled table when the
+    item is checked out and kept in loans until it is returned, so a policy change applies to later loans. An overdue
+    loan whose fine will reach its cap is filed in fine_cap_buckets under the date it does. A FineReport is kept up to
+    date alongside, so the total owed, the overdue items of each type and the top debtors can be read without visiting
+    every patron.
+
+    When a transaction log is set (see library_persistence.WriteAheadLog), every method that changes the library
+    records its call in the log before applying it, except process_batch, which records the transactions it applied.
+
+    Titles and creators are searchable through a SearchIndex kept up to date by add_library_item, and an
+    AvailabilityIndex follows every location change the library makes so the items at each location can be counted
+    and listed by type. Items in the item store, and items added in bulk by add_library_items and
+    add_library_item_rows, are added to both indexes together on the next search or availability query.
+
+    fork returns a copy-on-write copy of the library for what-if scenarios, see fork.
+    """
+
+    def __init__(self, item_store=None):
+        self._holdings = {}
+        self._item_store = item_store
+        self._members = {}
+        self._current_date = 0
+        self._overdue_buckets = {}
+        self._fine_cap_buckets = {}
+        self._overdue_dates = []  # heap of the dates with an overdue or fine cap bucket
+        self._loans = {}  # checked out LibraryItem -> (overdue_date, daily_fine_cents, fine_cap_date, remainder_cents)
+        self._loan_policy = LoanPolicy()
+        self._transaction_log = None
+        self._loan_history = None
+        self._search_index = SearchIndex()
+        self._availability_index = AvailabilityIndex()
+        self._fine_report = FineReport()
+        self._unindexed_items = []  # items added by add_library_items and not yet in the indexes
+        self._indexed_store_rows = 0  # rows of the item store already in the indexes
+        self._fork_base = None  # the _ForkBase shared with forks, once the library has been forked
+
+    def get_transaction_log(self):
+        """
+        returns the transaction log that changes to the library are recorded in
+        :return: None or the transaction log
+        """
+        return self._transaction_log
+
+    def set_transaction_log(self, transaction_log):
+        """
+        changes the transaction log that changes to the library are recorded in
+        :param transaction_log: None, or an object with a record(method_name, *args) method
+        :return: None
+        """
+        self._transaction_log = transaction_log
+
+    def get_loan_history(self):
+        """
+        returns the history that completed loans are recorded in
+        :return: None or the loan history
+        """
+        return self._loan_history
+
+    def set_loan_history(self, loan_history):
+        """
+        changes the history that completed loans are recorded in
+        :param loan_history: None, or an object with a record_loan(patron_id, library_item_id, date_checked_out,
+        date_returned, fine_cents) method such as a LoanHistory
+        :return: None
+        """
+        self._loan_history = loan_history
+
+    def get_loan_policy(self):
+        """
+        returns the rules the library lends by
+        :return: a LoanPolicy object
+        """
+        return self._loan_policy
+
+    def set_loan_policy(self, loan_policy):
+        """
+        changes the rules the library lends by, items already checked out keep the terms they were lent on
+        :param loan_policy: a LoanPolicy object
+        :return: None
+        """
+        self._loan_policy = loan_policy
+
+    def get_library_items(self):
+        """
+        returns every library item in the holdings, including those in the item store
+        :return: an iterator of LibraryItem objects
+        """
+        yield from self._holdings.values()
+        if isinstance(self._item_store, ItemStore) or (self._item_store is not None and type(self._holdings) is dict):
+            yield from self._item_store
+        elif self._item_store is not None:  # a forked library owns copies of some items of the store
+            holdings = self._holdings
+            yield from (library_item for library_item in self._item_store
+                        if library_item.get_library_item_id() not in holdings)
+
+    def get_patrons(self):
+        """
+        returns every patron in the members. A forked library shares the patrons it has not changed, and a library
+        that has been forked shares frozen copies of them, so change a patron through lookup_patron_from_id rather than
+        through this view.
+        :return: a read-only view of the Patron objects
+        """
+        return self._members.values()
+
+    def get_current_date(self):
+        """
+        returns the current date of the library
+        :return: an integer, days since the Library object was created
+        """
+        return self._current_date
+
+    def add_library_item(self, new_library_item):
+        """
+        passes a new library object as a parameter and then adds it to the holdings data member collection, indexed by
+        its library_item_id. An item whose id is already in the holdings is rejected.
+        :param new_library_item: LibraryItem object
+        :return: A string about the result of the add attempt
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("add_library_item", new_library_item)
+        library_item_id = new_library_item.get_library_item_id()
+        if self._get_library_item(library_item_id) is not None:
+            return "item id already in holdings"
+        self._holdings[library_item_id] = new_library_item
+        if self._fork_base is not None:
+            self._fork_base.change_library_item(library_item_id)
+        self._index_library_item(new_library_item)
+        return "add successful"
+
+    def add_patron(self, new_patron):
+        """
+        passes a new patron object as a parameter and then adds it to the 'member' data member collection, indexed by
+        its patron_id. A patron whose id is already in the members is rejected.
+        :param new_patron: Patron object
+        :return: A string about the result of the add attempt
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("add_patron", new_patron)
+        patron_id = new_patron.get_patron_id()
+        if patron_id in self._members:
+            return "patron id already in members"
+        self._members[patron_id] = new_patron
+        if self._fork_base is not None:
+            self._fork_base.change_patron(patron_id)
+        new_patron.set_library(self)
+        self._add_to_fine_report(new_patron)
+        return "add successful"
+
+    def add_library_items(self, new_library_items):
+        """
+        Adds many library items at once, with the same checks as add_library_item. The items are added to the search
+        and availability indexes together on the next search or availability query rather than one at a time.
+        :param new_library_items: an iterable of LibraryItem objects
+        :return: a list of the positions of the items rejected because their id was already in the holdings
+        """
+        return self._add_library_items(new_library_items)
+
+    def _add_library_items(self, new_library_items):
+        """
+        adds many library items, the body of add_library_items shared with add_library_item_rows
+        :param new_library_items: an iterable of LibraryItem objects
+        :return: a list of the positions of the items rejected because their id was already in the holdings
+        """
+        holdings = self._holdings
+        transaction_log = self._transaction_log
+        rejected = []
+        for position, library_item in enumerate(new_library_items):
+            if transaction_log is not None:
+                transaction_log.record("add_library_item", library_item)
+            library_item_id = library_item.get_library_item_id()
+            if self._get_library_item(library_item_id) is not None:
+                rejected.append(position)
+            else:
+                holdings[library_item_id] = library_item
+                self._unindexed_items.append(library_item)
+                if self._fork_base is not None:
+                    self._fork_base.change_library_item(library_item_id)
+        return rejected
+
+    def add_library_item_rows(self, type_codes, library_item_ids, titles, creators):
+        """
+        Adds many library items given as columns, the fast path for bulk imports. A library backed by an ItemStore
+        appends the columns to the store (see ItemStore.extend) without making a LibraryItem object per item; any other
+        library makes Book, Album and Movie objects for add_library_items, as does a library with a transaction log,
+        so every item is recorded. Either way the items are indexed on the next search or availability query.
+        :param type_codes: a sequence of item type codes, indexes into ITEM_TYPES
+        :param library_item_ids: a sequence of unique identifiers
+        :param titles: a sequence of titles
+        :param creators: a sequence of authors, artists and directors
+        :return: a list of the positions of the items rejected because their id was already in the holdings
+        """
+        if not isinstance(self._item_store, ItemStore) or self._transaction_log is not None:
+            return self._add_library_items(map(lambda type_code, library_item_id, title, creator:
+                                               ITEM_TYPES[type_code](library_item_id, title, creator),
+                                               type_codes, library_item_ids, titles, creators))
+        if self._holdings and not self._holdings.keys().isdisjoint(library_item_ids):
+            held = [position for position, library_item_id in enumerate(library_item_ids)
+                    if library_item_id in self._holdings]
+            kept = sorted(set(range(len(library_item_ids))).difference(held))
+            columns = [[column[position] for position in kept]
+                       for column in (type_codes, library_item_ids, titles, creators)]
+            return sorted(held + [kept[position] for position in self._item_store.extend(*columns)])
+        return self._item_store.extend(type_codes, library_item_ids, titles, creators)
+
+    def add_patrons(self, new_patrons):
+        """
+        adds many patrons at once, with the same checks as add_patron
+        :param new_patrons: an iterable of Patron objects
+        :return: a list of the positions of the patrons rejected because their id was already in the members
+        """
+        members = self._members
+        transaction_log = self._transaction_log
+        rejected = []
+        for position, patron in enumerate(new_patrons):
+            if transaction_log is not None:
+                transaction_log.record("add_patron", patron)
+            patron_id = patron.get_patron_id()
+            if patron_id in members:
+                rejected.append(position)
+            else:
+                members[patron_id] = patron
+                if self._fork_base is not None:
+                    self._fork_base.change_patron(patron_id)
+                patron.set_library(self)
+                self._add_to_fine_report(patron)
+        return rejected
+
+    def lookup_library_item_from_id(self, id_request):
+        """
+        finds and returns the LibraryItem object with a library_item_id matching the id_request.
+        Library._holdings looks like: {library_item_id1: LibraryItem1, library_item_id2: LibraryItem2}
+        A forked library copies an item it shares with other libraries into its own holdings first, and a library that
+        has been forked records that its forks are to copy the item from it, see fork.
+        :param id_request: the id that the desired Library item object has
+        :return: the Library item object with matching id, or None if no such item is in the holdings
+        """
+        library_item = self._get_library_item(id_request)
+        if library_item is None or isinstance(library_item, _StoredItem):  # a forked ItemStore copies every row
+            return library_item
+        if type(self._holdings) is dict:
+            if self._fork_base is not None:
+                self._fork_base.change_library_item(id_request)
+            return library_item
+        if self._holdings.owns(id_request):
+            return library_item
+        return self._holdings.own(id_request, library_item.copy({}))
+
+    def _get_library_item(self, id_request):
+        """
+        finds the LibraryItem object with a library_item_id, without copying an item a forked library shares
+        :param id_request: the id that the desired Library item object has
+        :return: the Library item object with matching id, or None if no such item is in the holdings
+        """
+        library_item = self._holdings.get(id_request)
+        if library_item is None and self._item_store is not None:
+            return self._item_store.get(id_request)
+        return library_item
+
+    def _index_library_item(self, library_item):
+        """
+        adds a library item to the search and availability indexes
+        :param library_item: LibraryItem object
+        :return: None
+        """
+        self._search_index.add_library_item(library_item)
+        self._availability_index.add(library_item.get_library_item_id(), get_item_type_code(library_item),
+                                     library_item.get_location_code())
+
+    def _has_pending(self):
+        """
+        returns whether any items are not yet in the search and availability indexes, see _index_pending
+        :return: a boolean
+        """
+        return bool(self._unindexed_items) or (self._item_store is not None
+                                               and self._indexed_store_rows < len(self._item_store))
+
+    def _index_pending(self):
+        """
+        adds the items not yet indexed to the search and availability indexes: the items added in bulk, and the rows
+        added to the item store since it was last indexed. Called by the searches and availability queries, so a bulk
+        load builds its indexes once. Store rows are read with the store's get_rows, so no item is built to index it.
+        :return: None
+        """
+        if self._unindexed_items:
+            self._index_rows((library_item.get_library_item_id(), get_item_type_code(library_item),
+                              library_item.get_location_code(), library_item.get_title(), library_item.get_creator())
+                             for library_item in self._unindexed_items)
+            self._unindexed_items = []
+        item_store = self._item_store
+        if item_store is not None and self._indexed_store_rows < len(item_store):
+            self._index_rows(item_store.get_rows(self._indexed_store_rows))
+            self._indexed_store_rows = len(item_store)
+
+    def _index_rows(self, rows):
+        """
+        adds many items to the search and availability indexes
+        :param rows: an iterable of (library_item_id, type_code, location_code, title, creator) tuples
+        :return: None
+        """
+        rows = list(rows)
+        self._search_index.add_rows((library_item_id, type_code, title, creator)
+                                    for library_item_id, type_code, location_code, title, creator in rows)
+        for library_item_id, type_code, location_code, title, creator in rows:
+            self._availability_index.add(library_item_id, type_code, location_code)
+
+    def _set_location(self, library_item, location):
+        """
+        changes the location of a library item and moves it in the availability index
+        :param library_item: LibraryItem object
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: None
+        """
+        self._availability_index.move(library_item.get_library_item_id(), get_item_type_code(library_item),
+                                      library_item.get_location_code(), LOCATION_CODES[location])
+        library_item.set_location(location)
+
+    def search(self, query, item_type=None, field=None, limit=None, location=None):
+        """
+        finds the library items whose titles and creators match every term of a query, see SearchIndex.search. For
+        example search("yates", Movie, "creator") finds Movies directed by Yates, and adding location="ON_SHELF"
+        finds only those on the shelf.
+        :param query: a string such as "harry potter" or "miya*"
+        :param item_type: None for any item, or Book, Album or Movie
+        :param field: None, "title" or "creator"
+        :param limit: None for every match, or the greatest number of item ids to return
+        :param location: None for any location, or "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: a list of matching library item ids, closest matches first
+        """
+        self._index_pending()
+        return self._search(query, item_type, field, limit, location)
+
+    def _search(self, query, item_type, field, limit, location):
+        """
+        answers a search from the indexes once every item is indexed, see search. Only the index columns are read, no
+        library item is looked up or built.
+        :param query: a string such as "harry potter" or "miya*"
+        :param item_type: None for any item, or Book, Album or Movie
+        :param field: None, "title" or "creator"
+        :param limit: None for every match, or the greatest number of item ids to return
+        :param location: None for any location, or "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: a list of matching library item ids, closest matches first
+        """
+        item_ids = None
+        if location is not None:
+            type_code = None if item_type is None else ITEM_TYPES.index(item_type)
+            item_ids = _ItemsAt(self._availability_index, LOCATION_CODES[location], type_code)
+        return self._search_index.search(query, item_type, field, limit, item_ids)
+
+    def count_library_items(self, location, item_type=None):
+        """
+        counts the library items at a location, such as how many Movies are "CHECKED_OUT"
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an integer
+        """
+        self._index_pending()
+        type_code = None if item_type is None else ITEM_TYPES.index(item_type)
+        return self._availability_index.count(LOCATION_CODES[location], type_code)
+
+    def get_library_item_ids(self, location, item_type=None):
+        """
+        lists the library items at a location, such as which Books are "ON_SHELF"
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an iterator of library item ids
+        """
+        self._index_pending()
+        type_code = None if item_type is None else ITEM_TYPES.index(item_type)
+        return self._availability_index.get_item_ids(LOCATION_CODES[location], type_code)
+
+    def lookup_patron_from_id(self, id_request):
+        """
+        finds and returns the Patron object with a patron_id matching the id_request.
+        Library._members looks like: {patron_id1: Patron1, patron_id2: Patron2}
+        A forked library copies a patron it shares with other libraries into its own members first, and a library that
+        has been forked records that its forks are to copy the patron from it, see fork.
+        :param id_request: the id that the desired Patron has
+        :return: the Patron object with matching id, or None if no such Patron is a member
+        """
+        patron = self._members.get(id_request)
+        if patron is None:
+            return None
+        if type(self._members) is dict:
+            if self._fork_base is not None:
+                self._fork_base.change_patron(id_request)
+            return patron
+        if self._members.owns(id_request):
+            return patron
+        return self._members.own(id_request, patron.copy(self))
+
+    def check_out_library_item(self, patron_id, library_item_id):
+        """
+        takes two parameters for the id of the patron checking out the library item, and for the id of the library item
+        being checked out. Checks if the patron is a member and if the library item is in holdings. Then checks to see
+        if the library item is already checked out or on hold for another patron. If none of the above conditions
+        prevent the book from being checked out, then the library item's checked_out_by, date_checked_out, and location,
+        are updated. If the library_item was on hold for this patron, then this hold is updated. Also updates the
+        patron's checked out items.
+        :param patron_id: id of patron checking out
+        :param library_item_id: id of item being checked out
+        :return: A string about the result of the check-out attempt, either the problem encountered or a success message
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("check_out_library_item", patron_id, library_item_id)
+        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
+        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item is the LibraryItem object
+        if patron == None:
+            return "patron not found"
+        elif library_item == None:
+            return "item not found"
+        else:
+            return self._check_out(patron, library_item)
+
+    def _check_out(self, patron, library_item):
+        """
+        checks out a library item to a patron once both have been found in the library, see check_out_library_item
+        :param patron: Patron object checking out
+        :param library_item: LibraryItem object being checked out
+        :return: A string about the result of the check-out attempt
+        """
+        item_location = library_item.get_location()
+        holding_patron = library_item.get_requested_by()
+        if item_location == "CHECKED_OUT":
+            return "item already checked out"
+        # True if requested by another patron
+        elif item_location == "ON_HOLD_SHELF" and holding_patron.get_patron_id() != patron.get_patron_id():
+            return "item on hold by other patron"
+        max_loans, loan_terms = self._loan_policy.get_table(patron.get_patron_class())
+        if max_loans is not None and len(patron.get_checked_out_items()) >= max_loans:
+            return "loan limit reached"
+        # True if requested by same patron
+        elif item_location == "ON_HOLD_SHELF" and holding_patron.get_patron_id() == patron.get_patron_id():
+            library_item.get_hold_queue().pop()
+            patron.remove_hold(library_item)
+            library_item.set_checked_out_by(patron)
+            library_item.set_date_checked_out(self._current_date)
+            self._set_location(library_item, "CHECKED_OUT")
+            patron.add_library_item(library_item)
+            self._schedule_overdue(library_item, loan_terms[get_item_type_code(library_item)])
+            return "check out successful"
+        else:  # Runs whenever book is available (not checked out or requested)
+            library_item.set_checked_out_by(patron)
+            library_item.set_date_checked_out(self._current_date)
+            self._set_location(library_item, "CHECKED_OUT")
+            patron.add_library_item(library_item)
+            self._schedule_overdue(library_item, loan_terms[get_item_type_code(library_item)])
+            return "check out successful"
+
+    def return_library_item(self, library_item_id):
+        """
+        Takes a parameter for the id of the library item being returned. Checks to see if the item belongs to the
+        library. Ensures that the item was checked out. If all is in order, returns the book and updates the patron's
+        checked out items, the library item's location, and the library item's checked_out_by data member.
+        :param library_item_id: id of the library item being returned
+        :return: A string about the result of the return attempt
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("return_library_item", library_item_id)
+        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item refers to LibraryItem object
+        if library_item == None:
+            return "item not found"
+        else:
+            return self._return(library_item)
+
+    def _return(self, library_item):
+        """
+        returns a library item once it has been found in the library, see return_library_item
+        :param library_item: LibraryItem object being returned
+        :return: A string about the result of the return attempt
+        """
+        if library_item.get_location() != "CHECKED_OUT":  # True if library item on hold or on shelf already
+            return "item already in library"
+        else:
+            patron = library_item.get_checked_out_by()  # patron refers to Patron object
+            if self._loan_history is not None:  # recorded first, a history refusing the loan leaves it checked out
+                self._loan_history.record_loan(patron.get_patron_id(), library_item.get_library_item_id(),
+                                               library_item.get_date_checked_out(), self._current_date,
+                                               self._get_loan_fine_cents(library_item))
+            self._unschedule_overdue(library_item, patron)
+            patron.remove_library_item(library_item)
+            library_item.set_checked_out_by(None)
+            if library_item.get_requested_by() == None:  # Runs when item does not have a request
+                self._set_location(library_item, "ON_SHELF")
+                return "return successful"
+            else:  # Runs when item has a request, it is held for the patron at the front of the hold queue
+                self._set_location(library_item, "ON_HOLD_SHELF")
+                return "return successful"
+
+    def request_library_item(self, patron_id, library_item_id):
+        """
+        Takes the id of the patron and id of the library item as parameters. Checks if the patron is a member of the
+        library and if the library item is in the library's holdings. Checks if the patron is already waiting on the
+        library item. Otherwise, adds the patron to the back of the item's hold queue and, if the item is on the shelf,
+        moves it to "ON_HOLD_SHELF".
+        :param patron_id: id of patron requesting item
+        :param library_item_id: id of library item being requested
+        :return: a string about the result of request
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("request_library_item", patron_id, library_item_id)
+        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
+        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item is the LibraryItem object
+        if patron == None:
+            return "patron not found"
+        elif library_item == None:
+            return "item not found"
+        else:
+            return self._request(patron, library_item)
+
+    def _request(self, patron, library_item):
+        """
+        places a request for a library item once the patron and item have been found in the library, see
+        request_library_item
+        :param patron: Patron object requesting
+        :param library_item: LibraryItem object being requested
+        :return: a string about the result of request
+        """
+        # Runs if the patron is already waiting on the library item
+        if patron.get_hold(library_item) != None:
+            return "item already on hold"
+        else:  # Runs when item and patron are valid, the patron joins the back of the hold queue
+            patron.add_hold(library_item, library_item.add_hold(patron))
+            if library_item.get_location() == "ON_SHELF":
+                self._set_location(library_item, "ON_HOLD_SHELF")
+            return "request successful"
+
+    def cancel_request(self, patron_id, library_item_id):
+        """
+        Takes the id of the patron and id of the library item as parameters and cancels the patron's hold on the item.
+        If the item was on the hold shelf for that patron it is held for the next patron in the queue, or goes back on
+        the shelf if no one else is waiting.
+        :param patron_id: id of patron cancelling
+        :param library_item_id: id of library item requested
+        :return: a string about the result of the cancellation
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("cancel_request", patron_id, library_item_id)
+        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
+        library_item = self.lookup_library_item_from_id(library_item_id)  # library_item is the LibraryItem object
+        if patron == None:
+            return "patron not found"
+        elif library_item == None:
+            return "item not found"
+        hold_handle = patron.get_hold(library_item)
+        if hold_handle == None:
+            return "no request found"
+        library_item.get_hold_queue().cancel(hold_handle)
+        patron.remove_hold(library_item)
+        if library_item.get_location() == "ON_HOLD_SHELF" and library_item.get_requested_by() == None:
+            self._set_location(library_item, "ON_SHELF")
+        return "request cancelled"
+
+    def get_hold_position(self, patron_id, library_item_id):
+        """
+        Takes the id of the patron and id of the library item as parameters and returns the patron's place in the
+        item's hold queue.
+        :param patron_id: id of patron
+        :param library_item_id: id of library item requested
+        :return: 1 for the front of the queue, or None if the patron is not waiting on the item
+        """
+        patron = self.lookup_patron_from_id(patron_id)
+        library_item = self.lookup_library_item_from_id(library_item_id)
+        if patron == None or library_item == None:
+            return None
+        hold_handle = patron.get_hold(library_item)
+        if hold_handle == None:
+            return None
+        return library_item.get_hold_queue().get_position(hold_handle)
+
+    def process_batch(self, transactions, results=None):
+        """
+        Applies a batch of check-out, return and request transactions in order, with the same results as calling
+        check_out_library_item, return_library_item and request_library_item one at a time. The lookups and
+        operations are bound once for the whole batch rather than once per call.
+        :param transactions: an iterable of (operation, patron_id, library_item_id) tuples, where operation is
+        "check_out", "return" or "request". patron_id is ignored for "return".
+        :param results: an array("b") to append the result codes to, None for a new one. If a transaction raises, it
+        holds the codes of the transactions applied before it.
+        :return: an array of result codes, one per transaction, RESULTS[code] is the string the single call returns
+        """
+        if results is None:
+            results = array("b")
+        if self._transaction_log is None:
+            return self._process_batch(transactions, results)
+        transactions = list(transactions)
+        start = len(results)
+        try:
+            return self._process_batch(transactions, results)
+        finally:  # only the transactions applied are logged, a transaction that raised is not replayed
+            if len(results) > start:
+                self._transaction_log.record("process_batch", transactions[:len(results) - start])
+
+    def _process_batch(self, transactions, results):
+        """
+        applies a batch of transactions without logging them, the body of process_batch
+        :param transactions: an iterable of (operation, patron_id, library_item_id) tuples
+        :param results: an array("b") to append the result codes to
+        :return: results
+        """
+        if type(self._members) is dict and self._fork_base is None:
+            find_patron = self._members.get
+            find_item = self._holdings.get if self._item_store is None else self.lookup_library_item_from_id
+        else:  # the lookups keep a fork's shared records, and a forked library's fork base, up to date
+            find_patron = self.lookup_patron_from_id
+            find_item = self.lookup_library_item_from_id
+        operations = {"check_out": self._check_out, "request": self._request}
+        return_item = self._return
+        result_codes = RESULT_CODES
+        append = results.append
+        for operation, patron_id, library_item_id in transactions:
+            library_item = find_item(library_item_id)
+            if operation == "return":
+                append(result_codes["item not found" if library_item is None else return_item(library_item)])
+                continue
+            apply = operations.get(operation)
+            patron = find_patron(patron_id)
+            if apply is None:
+                append(result_codes["unknown operation"])
+            elif patron is None:
+                append(result_codes["patron not found"])
+            elif library_item is None:
+                append(result_codes["item not found"])
+            else:
+                append(result_codes[apply(patron, library_item)])
+        return results
+
+    def pay_fine(self, patron_id, payment_amount):
+        """
+        Takes the patron id and the amount they are paying as parameters. Checks if the patron is a member of the
+        library. If they are a member, the amend_fine() function is used to lower the patron's fine by the amount paid.
+        :param patron_id: id of patron paying
+        :param payment_amount: the amount being paid, in dollars (float or int)
+        :return: A string about the result of payment
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("pay_fine", patron_id, payment_amount)
+        patron = self.lookup_patron_from_id(patron_id)  # patron is the patron object
+        if patron == None:
+            return "patron not found"
+        else:
+            patron.amend_fine(-payment_amount)  # Passes a negative value for payment amount so fine is decreased
+            return "payment successful"
+
+    def _overdue_date(self, library_item):
+        """
+        returns the first date on which a checked out library item is overdue
+        :param library_item: a checked out LibraryItem object
+        :return: an integer, the date
+        """
+        return self._loans[library_item][0]
+
+    def _file_event(self, buckets, date, library_item):
+        """
+        files a library item in the overdue or fine cap buckets under a date
+        :param buckets: the overdue buckets or the fine cap buckets
+        :param date: the date of the event
+        :param library_item: a checked out LibraryItem object
+        :return: None
+        """
+        bucket = buckets.get(date)
+        if bucket is None:
+            bucket = buckets[date] = set()
+            heapq.heappush(self._overdue_dates, date)
+        bucket.add(library_item)
+
+    def _start_loan(self, library_item, loan_terms):
+        """
+        records the terms of a loan
+        :param library_item: a checked out LibraryItem object
+        :param loan_terms: its (loan_days, daily_fine_cents, fine_cap_cents, grace_days) from the loan policy
+        :return: the (overdue_date, daily_fine_cents, fine_cap_date, remainder_cents) of the loan, fine_cap_date is
+        the first date the item is not charged its full daily fine, None if it is not capped
+        """
+        loan_days, daily_fine_cents, fine_cap_cents, grace_days = loan_terms
+        overdue_date = library_item.get_date_checked_out() + loan_days + grace_days + 1
+        if fine_cap_cents is None or daily_fine_cents <= 0:
+            loan = (overdue_date, daily_fine_cents, None, 0)
+        else:
+            full_days, remainder_cents = divmod(fine_cap_cents, daily_fine_cents)
+            loan = (overdue_date, daily_fine_cents, overdue_date + full_days, remainder_cents)
+        self._loans[library_item] = loan
+        return loan
+
+    def _schedule_overdue(self, library_item, loan_terms):
+        """
+        files a library item that was just checked out under the date it will become overdue
+        :param library_item: a checked out LibraryItem object
+        :param loan_terms: its (loan_days, daily_fine_cents, fine_cap_cents, grace_days) from the loan policy
+        :return: None
+        """
+        self._file_event(self._overdue_buckets, self._start_loan(library_item, loan_terms)[0], library_item)
+
+    def _get_loan_fine_cents(self, library_item):
+        """
+        returns the fine a checked out library item's loan has incurred up to and including current_date
+        :param library_item: a checked out LibraryItem object
+        :return: the fine in cents
+        """
+        overdue_date, daily_fine_cents, fine_cap_date, remainder_cents = self._loans[library_item]
+        if overdue_date > self._current_date:
+            return 0
+        if fine_cap_date is not None and fine_cap_date <= self._current_date:
+            return daily_fine_cents * (fine_cap_date - overdue_date) + remainder_cents
+        return daily_fine_cents * (self._current_date - overdue_date + 1)
+
+    def _unschedule_overdue(self, library_item, patron):
+        """
+        settles the overdue state of a library item being returned. An overdue item stops accruing fines for the
+        patron, otherwise the item is taken out of the bucket it was waiting in.
+        :param library_item: a checked out LibraryItem object
+        :param patron: the Patron returning it
+        :return: None
+        """
+        overdue_date, daily_fine_cents, fine_cap_date, remainder_cents = self._loans.pop(library_item)
+        if overdue_date <= self._current_date:
+            if fine_cap_date is not None and fine_cap_date <= self._current_date:
+                daily_fine_cents = 0  # the fine reached its cap, the item is no longer charged
+            elif fine_cap_date is not None:
+                self._fine_cap_buckets[fine_cap_date].discard(library_item)
+            patron.clear_item_overdue(self._current_date, daily_fine_cents)
+            self._fine_report.clear_item_overdue(patron, get_item_type_code(library_item), self._current_date,
+                                                 daily_fine_cents)
+        else:
+            self._overdue_buckets[overdue_date].discard(library_item)
+
+    def restore_loan(self, library_item):
+        """
+        registers a library item that is already checked out, as when a library is rebuilt from saved state, with its
+        patron and with the overdue fine engine, on the terms the loan policy gives today. Fines the patron owed
+        before current_date must already be on the patron, only fines from current_date on are charged for the item.
+        :param library_item: a LibraryItem object whose location, checked_out_by and date_checked_out are set
+        :return: None
+        """
+        patron = library_item.get_checked_out_by()
+        patron.add_library_item(library_item)
+        loan_terms = self._loan_policy.get_table(patron.get_patron_class())[1][get_item_type_code(library_item)]
+        overdue_date, daily_fine_cents, fine_cap_date, remainder_cents = self._start_loan(library_item, loan_terms)
+        if overdue_date <= self._current_date:
+            if fine_cap_date is not None and fine_cap_date <= self._current_date:
+                daily_fine_cents = 0
+            elif fine_cap_date is not None:
+                self._file_event(self._fine_cap_buckets, fine_cap_date, library_item)
+            patron.mark_item_overdue(self._current_date, daily_fine_cents)
+            self._fine_report.mark_item_overdue(patron, get_item_type_code(library_item), self._current_date,
+                                                daily_fine_cents)
+        else:
+            self._file_event(self._overdue_buckets, overdue_date, library_item)
+
+    def advance_date(self, days):
+        """
+        Moves the current date forward by a number of days. Only the items that became overdue or reached their fine
+        cap in that time are visited; patrons then charge the daily fines of their overdue items as their fines are
+        read (see Patron).
+        :param days: number of days to advance, a non-negative integer
+        :return: None
+        """
+        if self._transaction_log is not None:
+            self._transaction_log.record("advance_date", days)
+        new_date = self._current_date + days
+        fine_report = self._fine_report
+        loans = self._loans
+        while self._overdue_dates and self._overdue_dates[0] <= new_date:
+            event_date = heapq.heappop(self._overdue_dates)
+            for item in self._overdue_buckets.pop(event_date, ()):
+                patron = item.get_checked_out_by()
+                overdue_date, daily_fine_cents, fine_cap_date, remainder_cents = loans[item]
+                patron.mark_item_overdue(event_date - 1, daily_fine_cents)
+                fine_report.mark_item_overdue(patron, get_item_type_code(item), event_date - 1, daily_fine_cents)
+                if fine_cap_date is not None:
+                    self._file_event(self._fine_cap_buckets, fine_cap_date, item)
+            for item in self._fine_cap_buckets.pop(event_date, ()):
+                patron = item.get_checked_out_by()
+                overdue_date, daily_fine_cents, fine_cap_date, remainder_cents = loans[item]
+                patron.cap_item_fine(event_date - 1, daily_fine_cents, remainder_cents)
+                fine_report.cap_item_fine(patron, event_date - 1, daily_fine_cents, remainder_cents)
+        self._current_date = new_date
+
+    def increment_current_date(self):
+        """
+        Increments the current day by one and charges each patron the daily fine of each library item they have overdue
+        :return: None
+        """
+        self.advance_date(1)
+
+    def record_fine_change(self, patron, cents):
+        """
+        adds a change to a member's fine to the fine report, called by Patron.amend_fine
+        :param patron: Patron object whose fine changed
+        :param cents: the change in cents
+        :return: None
+        """
+        if self._fork_base is not None:
+            self._fork_base.change_patron(patron.get_patron_id())
+        self._fine_report.amend_fine(patron, cents)
+
+    def _add_to_fine_report(self, patron):
+        """
+        adds a new member's fine to the fine report, called by add_patron and add_patrons
+        :param patron: Patron object just added to the members
+        :return: None
+        """
+        self._fine_report.add_patron(patron)
+
+    def get_total_fines(self):
+        """
+        returns the total of every patron's fine as of the current date, from the fine report rather than by reading
+        each patron's fine
+        :return: the total, in dollars
+        """
+        return self._fine_report.get_total_cents(self._current_date) / 100
+
+    def count_overdue_items(self, item_type=None):
+        """
+        returns the number of checked out items that are overdue, from the fine report
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an integer
+        """
+        return self._fine_report.get_overdue_count(None if item_type is None else ITEM_TYPES.index(item_type))
+
+    def get_top_debtors(self, count=10):
+        """
+        returns the patrons who owe the largest fines as of the current date, see FineReport.get_top_debtors
+        :param count: the greatest number of patrons to return
+        :return: a list of (patron_id, fine in dollars) tuples of patrons who owe a fine, largest fine first
+        """
+        return [(patron.get_patron_id(), cents / 100)
+                for patron, cents in self._fine_report.get_top_debtors(count, self._current_date)]
+
+    def check_fine_report(self, count=10):
+        """
+        checks the fine report against fines and overdue items counted from every patron and checked out item
+        :param count: number of top debtors to compare
+        :return: a list of strings describing each figure that does not match, empty if the report is consistent
+        """
+        problems = []
+        patrons = list(self._members.values())
+        total_cents = sum(patron.get_fine_cents(self._current_date) for patron in patrons)
+        if total_cents != self._fine_report.get_total_cents(self._current_date):
+            problems.append(f"total fines {self._fine_report.get_total_cents(self._current_date)} cents, "
+                            f"recomputed {total_cents} cents")
+        overdue_counts = [0 for item_type in ITEM_TYPES]
+        for patron in patrons:
+            for library_item in patron.get_checked_out_items():
+                if self._overdue_date(library_item) <= self._current_date:
+                    overdue_counts[get_item_type_code(library_item)] += 1
+        for type_code, item_type in enumerate(ITEM_TYPES):
+            if overdue_counts[type_code] != self._fine_report.get_overdue_count(type_code):
+                problems.append(f"{item_type.__name__} overdue count {self._fine_report.get_overdue_count(type_code)}, "
+                                f"recomputed {overdue_counts[type_code]}")
+        fines = [patron.get_fine_cents(self._current_date) for patron in patrons]
+        fines = sorted((cents for cents in fines if cents > 0), reverse=True)[:count]
+        reported = [cents for patron, cents in self._fine_report.get_top_debtors(count, self._current_date)]
+        if reported != fines:
+            problems.append(f"top debtors owe {reported} cents, recomputed {fines} cents")
+        return problems
+
+    def fork(self):
+        """
+        Returns a copy-on-write copy of the library, for what-if scenarios run from the same state such as a change to
+        the loan policy or more patrons. Changes to the fork do not change this library and changes to this library do
+        not change the fork; either may be forked again.
+
+        Library items and patrons that are idle, on the shelf with no one waiting or without checked out items, holds
+        or fines, are shared rather than copied. The first fork of a library freezes copies of its idle records in a
+        base shared by every library forked from it, and the library goes on using its own records; a fork copies a
+        shared record into its own holdings or members the first time it looks it up by id. The records in use, and any
+        the library has looked up or added since the base was frozen, are copied into each fork, with its loans,
+        overdue buckets and fine report, and the base is frozen again once more records have changed than it holds.
+        A record changed other than through the library's methods should be looked up by id before forking, so its
+        change is copied. The search and availability indexes and the item store are forked too, sharing what does not
+        change (see SearchIndex.fork, AvailabilityIndex.fork and ItemStore.fork, an item store of another kind must
+        have a fork method returning its unchanged items); the loan policy is copied. The fork has no transaction log
+        or loan history.
+        :return: a Library of the same class, made by _new_fork
+        """
+        self._index_pending()
+        fork = self._new_fork()
+        if type(self._holdings) is dict:
+            owned_items, owned_patrons, base_items, base_patrons = self._share_records()
+        else:
+            owned_items, owned_patrons = self._holdings.get_owned(), self._members.get_owned()
+            base_items, base_patrons = self._holdings.get_base(), self._members.get_base()
+        records = {}  # each record copied, and each hold handle, to its copy
+        for patron in owned_patrons.values():
+            records[patron] = patron.copy(fork)
+        fork._item_store = self._item_store
+        if isinstance(self._item_store, ItemStore):
+            fork._item_store = self._item_store.fork(records)
+            for patron in owned_patrons.values():
+                for library_item in itertools.chain(patron.get_checked_out_items(), patron.get_holds()):
+                    if isinstance(library_item, _StoredItem):
+                        records[library_item] = fork._item_store.get(library_item.get_library_item_id())
+        elif self._item_store is not None and type(self._holdings) is dict:
+            fork._item_store = self._item_store.fork()
+        for library_item in owned_items.values():
+            records[library_item] = library_item.copy(records)
+        for patron in owned_patrons.values():
+            records[patron].relink(records)
+        fork._holdings = _SharedRecords({library_item_id: records[library_item]
+                                         for library_item_id, library_item in owned_items.items()}, base_items)
+        fork._members = _SharedRecords({patron_id: records[patron] for patron_id, patron in owned_patrons.items()},
+                                       base_patrons)
+        fork._current_date = self._current_date
+        fork._loans = {records[library_item]: loan for library_item, loan in self._loans.items()}
+        fork._overdue_buckets = {date: {records[library_item] for library_item in bucket}
+                                 for date, bucket in self._overdue_buckets.items()}
+        fork._fine_cap_buckets = {date: {records[library_item] for library_item in bucket}
+                                  for date, bucket in self._fine_cap_buckets.items()}
+        fork._overdue_dates = list(self._overdue_dates)
+        fork._loan_policy = self._loan_policy.copy()
+        fork._fine_report = self._fine_report.copy(records)
+        self._search_index, fork._search_index = self._search_index.fork(), self._search_index.fork()
+        self._availability_index, fork._availability_index = (self._availability_index.fork(),
+                                                              self._availability_index.fork())
+        fork._indexed_store_rows = self._indexed_store_rows
+        return fork
+
+    def _new_fork(self):
+        """
+        returns the empty library fork fills in, a subclass taking settings in its init method overrides this to pass
+        them on
+        :return: a Library of the same class
+        """
+        return type(self)()
+
+    def _share_records(self):
+        """
+        splits the records of a library that is not itself a fork into those a fork copies and those it shares. An
+        item is in use when it is checked out or on the hold shelf, and a patron when it has items checked out, holds,
+        a fine or an item overdue; nothing else refers to an idle record, so a frozen copy of it stands for it until
+        the library looks it up again. The fork base of frozen copies is made on the first fork, and again when it is
+        stale (see _ForkBase). Items of an ItemStore are left to ItemStore.fork, and the items of another item store
+        that were never built are left to its fork.
+        :return: a tuple of the library items and the patrons to copy, then the library items and the patrons to
+        share, each a dictionary by id
+        """
+        library_items = list(self._loans)
+        library_items += map(self._get_library_item,
+                             self._availability_index.get_item_ids(LOCATION_CODES["ON_HOLD_SHELF"]))
+        patrons = set(self._fine_report.get_debtors())
+        for library_item in library_items:
+            if library_item.get_checked_out_by() is not None:
+                patrons.add(library_item.get_checked_out_by())
+            if library_item.get_hold_queue() is not None:
+                patrons.update(library_item.get_hold_queue())
+        owned_items = {library_item.get_library_item_id(): library_item for library_item in library_items
+                       if not isinstance(library_item, _StoredItem)}
+        owned_patrons = {patron.get_patron_id(): patron for patron in patrons}
+        fork_base = self._fork_base
+        if fork_base is None or fork_base.is_stale():
+            held_items = self._holdings.values()
+            if self._item_store is not None and not isinstance(self._item_store, ItemStore):
+                held_items = itertools.chain(held_items, self._item_store.get_built_items())
+            fork_base = self._fork_base = _ForkBase(
+                {library_item.get_library_item_id(): library_item.copy({}) for library_item in held_items
+                 if library_item.get_library_item_id() not in owned_items},
+                {patron_id: patron.copy(None) for patron_id, patron in self._members.items()
+                 if patron_id not in owned_patrons},
+                set(owned_items), set(owned_patrons))
+        for library_item_id in fork_base.get_changed_item_ids():
+            if library_item_id not in owned_items:
+                owned_items[library_item_id] = self._get_library_item(library_item_id)
+        for patron_id in fork_base.get_changed_patron_ids():
+            if patron_id not in owned_patrons:
+                owned_patrons[patron_id] = self._members[patron_id]
+        return owned_items, owned_patrons, fork_base.get_library_items(), fork_base.get_patrons()
+
+
+class _ReadWriteLock:
+    """
+    A lock that many readers may hold at once, or one writer alone. A waiting writer keeps new readers out, so a
+    steady stream of readers cannot keep it waiting forever.
+    """
+
+    __slots__ = ("_condition", "_readers", "_writing", "_writers_waiting")
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        """
+        waits until no writer holds or is waiting for the lock, then holds it as one of its readers
+        :return: None
+        """
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        """
+        releases the lock held by acquire_read
+        :return: None
+        """
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        """
+        waits until no reader or writer holds the lock, then holds it alone
+        :return: None
+        """
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+
+    def release_write(self):
+        """
+        releases the lock held by acquire_write
+        :return: None
+        """
+        with self._condition:
+            self._writing = False
+            self._condition.notify_all()
+
+
+class ConcurrentLibrary(Library):
+    """
+    A Library that may be used from many threads at once.
+
+    Patrons and library items are guarded by a fixed set of striped locks, a patron or item id always maps to the
+    same stripe. A transaction takes the stripes of the patron and item it touches in ascending stripe order, so two
+    transactions never wait on each other in a cycle, and transactions on unrelated patrons and items do not wait at
+    all. A return does not know its patron until the item is read, so it reads the patron, takes both stripes, and
+    starts over if the item changed hands in between. The overdue buckets and the availability index are shared by
+    all items and have a lock each, the fine report sharing the overdue bucket lock, and advancing the date takes
+    every stripe since it touches every patron with an item coming due. Adding items and patrons takes a registry
+    lock so duplicate ids are still rejected, and the stripes of the ids added, so a transaction on a new id is
+    recorded in the transaction log after the add it depends on. The search and availability indexes are guarded by a read/write lock:
+    searches and counts read them together, and only indexing new items waits for them and keeps them out.
+    """
+
+    def __init__(self, item_store=None, stripe_count=64):
+        super().__init__(item_store)
+        self._stripes = [threading.Lock() for stripe in range(stripe_count)]
+        self._registry_lock = threading.RLock()  # reentrant, fork indexes pending items while holding it
+        self._overdue_lock = threading.Lock()
+        self._availability_lock = threading.Lock()
+        self._index_lock = _ReadWriteLock()
+
+    def _stripes_for(self, *ids):
+        """
+        returns the stripes guarding some patron and item ids, in the order they must be acquired
+        :param ids: patron and library item ids, None is skipped
+        :return: a sorted list of stripe numbers without repeats
+        """
+        return sorted({hash(library_id) % len(self._stripes) for library_id in ids if library_id is not None})
+
+    def _acquire(self, stripes):
+        """
+        acquires stripes in the order given
+        :param stripes: a list of stripe numbers from _stripes_for
+        :return: None
+        """
+        for stripe in stripes:
+            self._stripes[stripe].acquire()
+
+    def _release(self, stripes):
+        """
+        releases stripes acquired by _acquire
+        :param stripes: a list of stripe numbers from _stripes_for
+        :return: None
+        """
+        for stripe in reversed(stripes):
+            self._stripes[stripe].release()
+
+    def add_library_item(self, new_library_item):
+        """
+        add_library_item holding the registry lock and the item's stripe, see Library.add_library_item
+        :param new_library_item: LibraryItem object
+        :return: A string about the result of the add attempt
+        """
+        stripes = self._stripes_for(new_library_item.get_library_item_id())
+        with self._registry_lock:
+            self._acquire(stripes)
+            try:
+                return super().add_library_item(new_library_item)
+            finally:
+                self._release(stripes)
+
+    def add_patron(self, new_patron):
+        """
+        add_patron holding the registry lock and the patron's stripe, see Library.add_patron
+        :param new_patron: Patron object
+        :return: A string about the result of the add attempt
+        """
+        stripes = self._stripes_for(new_patron.get_patron_id())
+        with self._registry_lock:
+            self._acquire(stripes)
+            try:
+                return super().add_patron(new_patron)
+            finally:
+                self._release(stripes)
+
+    def add_library_items(self, new_library_items):
+        """
+        add_library_items holding the registry lock and every stripe, see Library.add_library_items
+        :param new_library_items: an iterable of LibraryItem objects
+        :return: a list of the positions of the items rejected because their id was already in the holdings
+        """
+        stripes = list(range(len(self._stripes)))
+        with self._registry_lock:
+            self._acquire(stripes)
+            try:
+                return super().add_library_items(new_library_items)
+            finally:
+                self._release(stripes)
+
+    def add_library_item_rows(self, type_codes, library_item_ids, titles, creators):
+        """
+        add_library_item_rows holding the registry lock and every stripe, see Library.add_library_item_rows
+        :param type_codes: a sequence of item type codes, indexes into ITEM_TYPES
+        :param library_item_ids: a sequence of unique identifiers
+        :param titles: a sequence of titles
+        :param creators: a sequence of authors, artists and directors
+        :return: a list of the positions of the items rejected because their id was already in the holdings
+        """
+        stripes = list(range(len(self._stripes)))
+        with self._registry_lock:
+            self._acquire(stripes)
+            try:
+                return super().add_library_item_rows(type_codes, library_item_ids, titles, creators)
+            finally:
+                self._release(stripes)
+
+    def add_patrons(self, new_patrons):
+        """
+        add_patrons holding the registry lock and every stripe, see Library.add_patrons
+        :param new_patrons: an iterable of Patron objects
+        :return: a list of the positions of the patrons rejected because their id was already in the members
+        """
+        stripes = list(range(len(self._stripes)))
+        with self._registry_lock:
+            self._acquire(stripes)
+            try:
+                return super().add_patrons(new_patrons)
+            finally:
+                self._release(stripes)
+
+    def _index_library_item(self, library_item):
+        """
+        _index_library_item holding the index lock for writing and the availability lock
+        :param library_item: LibraryItem object
+        :return: None
+        """
+        self._index_lock.acquire_write()
+        try:
+            with self._availability_lock:
+                super()._index_library_item(library_item)
+        finally:
+            self._index_lock.release_write()
+
+    def _index_pending(self):
+        """
+        _index_pending holding the registry lock, so no items are added while the pending ones are taken, when any
+        items are pending
+        :return: None
+        """
+        if self._has_pending():
+            with self._registry_lock:
+                super()._index_pending()
+
+    def _index_rows(self, rows):
+        """
+        _index_rows holding the index lock for writing and the availability lock
+        :param rows: an iterable of (library_item_id, type_code, location_code, title, creator) tuples
+        :return: None
+        """
+        rows = list(rows)
+        self._index_lock.acquire_write()
+        try:
+            with self._availability_lock:
+                super()._index_rows(rows)
+        finally:
+            self._index_lock.release_write()
+
+    def search(self, query, item_type=None, field=None, limit=None, location=None):
+        """
+        search holding the index lock for reading, so searches run alongside each other and alongside adds that are
+        not indexing
+        :param query: a string such as "harry potter" or "miya*"
+        :param item_type: None for any item, or Book, Album or Movie
+        :param field: None, "title" or "creator"
+        :param limit: None for every match, or the greatest number of item ids to return
+        :param location: None for any location, or "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: a list of matching library item ids, closest matches first
+        """
+        self._index_pending()
+        self._index_lock.acquire_read()
+        try:
+            return self._search(query, item_type, field, limit, location)
+        finally:
+            self._index_lock.release_read()
+
+    def count_library_items(self, location, item_type=None):
+        """
+        count_library_items holding the index lock for reading and the availability lock, see
+        Library.count_library_items
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an integer
+        """
+        self._index_pending()
+        type_code = None if item_type is None else ITEM_TYPES.index(item_type)
+        self._index_lock.acquire_read()
+        try:
+            with self._availability_lock:
+                return self._availability_index.count(LOCATION_CODES[location], type_code)
+        finally:
+            self._index_lock.release_read()
+
+    def get_library_item_ids(self, location, item_type=None):
+        """
+        get_library_item_ids holding the index lock for reading and the availability lock while the ids are listed,
+        see Library.get_library_item_ids
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an iterator of library item ids
+        """
+        self._index_pending()
+        type_code = None if item_type is None else ITEM_TYPES.index(item_type)
+        self._index_lock.acquire_read()
+        try:
+            with self._availability_lock:
+                return iter(list(self._availability_index.get_item_ids(LOCATION_CODES[location], type_code)))
+        finally:
+            self._index_lock.release_read()
+
+    def _set_location(self, library_item, location):
+        """
+        _set_location holding the availability lock, since the availability index is shared by every stripe
+        :param library_item: LibraryItem object
+        :param location: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        :return: None
+        """
+        with self._availability_lock:
+            super()._set_location(library_item, location)
+
+    def check_out_library_item(self, patron_id, library_item_id):
+        """
+        check_out_library_item holding the patron's and the item's stripes
+        :param patron_id: id of patron checking out
+        :param library_item_id: id of item being checked out
+        :return: A string about the result of the check-out attempt
+        """
+        stripes = self._stripes_for(patron_id, library_item_id)
+        self._acquire(stripes)
+        try:
+            return super().check_out_library_item(patron_id, library_item_id)
+        finally:
+            self._release(stripes)
+
+    def return_library_item(self, library_item_id):
+        """
+        return_library_item holding the item's stripe and the stripe of the patron it is checked out by
+        :param library_item_id: id of the library item being returned
+        :return: A string about the result of the return attempt
+        """
+        library_item = self.lookup_library_item_from_id(library_item_id)
+        while True:
+            patron = None if library_item is None else library_item.get_checked_out_by()
+            stripes = self._stripes_for(library_item_id, None if patron is None else patron.get_patron_id())
+            self._acquire(stripes)
+            try:
+                if library_item is None or library_item.get_checked_out_by() is patron:
+                    return super().return_library_item(library_item_id)
+            finally:
+                self._release(stripes)
+
+    def request_library_item(self, patron_id, library_item_id):
+        """
+        request_library_item holding the patron's and the item's stripes
+        :param patron_id: id of patron requesting item
+        :param library_item_id: id of library item being requested
+        :return: a string about the result of request
+        """
+        stripes = self._stripes_for(patron_id, library_item_id)
+        self._acquire(stripes)
+        try:
+            return super().request_library_item(patron_id, library_item_id)
+        finally:
+            self._release(stripes)
+
+    def cancel_request(self, patron_id, library_item_id):
+        """
+        cancel_request holding the patron's and the item's stripes
+        :param patron_id: id of patron cancelling
+        :param library_item_id: id of library item requested
+        :return: a string about the result of the cancellation
+        """
+        stripes = self._stripes_for(patron_id, library_item_id)
+        self._acquire(stripes)
+        try:
+            return super().cancel_request(patron_id, library_item_id)
+        finally:
+            self._release(stripes)
+
+    def process_batch(self, transactions, results=None):
+        """
+        Applies a batch of transactions in order, each one taking its own stripes, see Library.process_batch
+        :param transactions: an iterable of (operation, patron_id, library_item_id) tuples
+        :param results: an array("b") to append the result codes to, None for a new one
+        :return: an array of result codes, one per transaction
+        """
+        calls = {"check_out": self.check_out_library_item, "request": self.request_library_item}
+        if results is None:
+            results = array("b")
+        for operation, patron_id, library_item_id in transactions:
+            if operation == "return":
+                result = self.return_library_item(library_item_id)
+            elif operation in calls:
+                result = calls[operation](patron_id, library_item_id)
+            else:
+                result = "unknown operation"
+            results.append(RESULT_CODES[result])
+        return results
+
+    def pay_fine(self, patron_id, payment_amount):
+        """
+        pay_fine holding the patron's stripe
+        :param patron_id: id of patron paying
+        :param payment_amount: the amount being paid, in dollars (float or int)
+        :return: A string about the result of payment
+        """
+        stripes = self._stripes_for(patron_id)
+        self._acquire(stripes)
+        try:
+            return super().pay_fine(patron_id, payment_amount)
+        finally:
+            self._release(stripes)
+
+    def _schedule_overdue(self, library_item, loan_terms):
+        """
+        _schedule_overdue holding the overdue bucket lock
+        :param library_item: a checked out LibraryItem object
+        :param loan_terms: its (loan_days, daily_fine_cents, fine_cap_cents, grace_days) from the loan policy
+        :return: None
+        """
+        with self._overdue_lock:
+            super()._schedule_overdue(library_item, loan_terms)
+
+    def _unschedule_overdue(self, library_item, patron):
+        """
+        _unschedule_overdue holding the overdue bucket lock
+        :param library_item: a checked out LibraryItem object
+        :param patron: the Patron returning it
+        :return: None
+        """
+        with self._overdue_lock:
+            super()._unschedule_overdue(library_item, patron)
+
+    def advance_date(self, days):
+        """
+        advance_date holding every stripe and the overdue bucket lock
+        :param days: number of days to advance, a non-negative integer
+        :return: None
+        """
+        stripes = list(range(len(self._stripes)))
+        self._acquire(stripes)
+        try:
+            with self._overdue_lock:
+                super().advance_date(days)
+        finally:
+            self._release(stripes)
+
+    def record_fine_change(self, patron, cents):
+        """
+        record_fine_change holding the overdue bucket lock, which also guards the fine report
+        :param patron: Patron object whose fine changed
+        :param cents: the change in cents
+        :return: None
+        """
+        with self._overdue_lock:
+            super().record_fine_change(patron, cents)
+
+    def _add_to_fine_report(self, patron):
+        """
+        _add_to_fine_report holding the overdue bucket lock, which also guards the fine report
+        :param patron: Patron object just added to the members
+        :return: None
+        """
+        with self._overdue_lock:
+            super()._add_to_fine_report(patron)
+
+    def get_total_fines(self):
+        """
+        get_total_fines holding the overdue bucket lock
+        :return: the total, in dollars
+        """
+        with self._overdue_lock:
+            return super().get_total_fines()
+
+    def count_overdue_items(self, item_type=None):
+        """
+        count_overdue_items holding the overdue bucket lock
+        :param item_type: None for every item, or Book, Album or Movie
+        :return: an integer
+        """
+        with self._overdue_lock:
+            return super().count_overdue_items(item_type)
+
+    def get_top_debtors(self, count=10):
+        """
+        get_top_debtors holding the overdue bucket lock
+        :param count: the greatest number of patrons to return
+        :return: a list of (patron_id, fine in dollars) tuples of patrons who owe a fine, largest fine first
+        """
+        with self._overdue_lock:
+            return super().get_top_debtors(count)
+
+    def check_fine_report(self, count=10):
+        """
+        check_fine_report holding every stripe and the overdue bucket lock, so no fine changes while it counts
+        :param count: number of top debtors to compare
+        :return: a list of strings describing each figure that does not match, empty if the report is consistent
+        """
+        stripes = list(range(len(self._stripes)))
+        self._acquire(stripes)
+        try:
+            with self._overdue_lock:
+                return super().check_fine_report(count)
+        finally:
+            self._release(stripes)
+
+    def fork(self):
+        """
+        fork holding the registry lock, every stripe and the overdue bucket lock, see Library.fork
+        :return: a ConcurrentLibrary
+        """
+        with self._registry_lock:
+            stripes = list(range(len(self._stripes)))
+            self._acquire(stripes)
+            try:
+                with self._overdue_lock:
+                    return super().fork()
+            finally:
+                self._release(stripes)
+
+    def _new_fork(self):
+        """
+        returns an empty ConcurrentLibrary with as many stripes as this one, see Library._new_fork
+        :return: a ConcurrentLibrary
+        """
+        return type(self)(stripe_count=len(self._stripes))
@@ -0,0 +1,863 @@
+# Description: Benchmarks for Library.py. Run with "python library_benchmarks.py".
+
+import argparse
+import asyncio
+import copy
+import heapq
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from Library import *
+from library_persistence import *
+from library_simulation import *
+from library_workload import *
+from library_metrics import *
+from library_sharding import *
+from library_load_test import run_load_test
+from library_import import *
+from library_history import *
+
+
+def build_library(item_count, patron_count):
+    """
+    builds a Library with item_count Books and patron_count Patrons, ids are strings of consecutive integers
+    :param item_count: number of Book objects added to the holdings
+    :param patron_count: number of Patron objects added to the members
+    :return: the Library object
+    """
+    lib = Library()
+    for i in range(item_count):
+        lib.add_library_item(Book(str(i), "Title " + str(i), "Author " + str(i)))
+    for i in range(patron_count):
+        lib.add_patron(Patron("p" + str(i), "Patron " + str(i)))
+    return lib
+
+
+def bench_transaction_latency(sizes=(1000, 10000, 100000, 1000000), transactions=10000):
+    """
+    times check-out/return pairs against catalogs of increasing size, the ids used are spread over the whole catalog
+    so lookups cannot benefit from items being near the front of the holdings
+    :param sizes: catalog sizes to measure
+    :param transactions: number of check-out/return pairs timed per size
+    :return: a dictionary of catalog size to mean microseconds per transaction
+    """
+    results = {}
+    for size in sizes:
+        lib = build_library(size, max(size // 10, 1))
+        patron_count = max(size // 10, 1)
+        step = max(size // transactions, 1)
+        start = time.perf_counter()
+        for i in range(transactions):
+            item_id = str((i * step) % size)
+            lib.check_out_library_item("p" + str(i % patron_count), item_id)
+            lib.return_library_item(item_id)
+        elapsed = time.perf_counter() - start
+        results[size] = elapsed / (2 * transactions) * 1e6
+    return results
+
+
+def bench_year_simulation(loan_counts=(1000, 10000, 100000)):
+    """
+    checks out loan_counts items and times 365 calls to increment_current_date, then reads every patron's fine
+    :param loan_counts: numbers of open loans to measure
+    :return: a dictionary of loan count to seconds for the simulated year
+    """
+    results = {}
+    for loans in loan_counts:
+        patron_count = max(loans // 10, 1)
+        lib = build_library(loans, patron_count)
+        for i in range(loans):
+            lib.check_out_library_item("p" + str(i % patron_count), str(i))
+        start = time.perf_counter()
+        for day in range(365):
+            lib.increment_current_date()
+        for i in range(patron_count):
+            lib.lookup_patron_from_id("p" + str(i)).get_fine_amount()
+        results[loans] = time.perf_counter() - start
+    return results
+
+
+def bench_batch_throughput(item_count=100000, transactions=100000):
+    """
+    times the same stream of check-outs, requests and returns applied through the single-call methods and through
+    process_batch, each on a freshly built library
+    :param item_count: number of items in the catalog
+    :param transactions: number of transactions in the stream
+    :return: a dictionary of method to transactions per second
+    """
+    patron_count = max(item_count // 10, 1)
+    stream = []
+    for i in range(transactions):
+        item_id = str((i * 7919) % item_count)
+        stream.append((("check_out", "request", "return")[i % 3], "p" + str(i % patron_count), item_id))
+    results = {}
+
+    lib = build_library(item_count, patron_count)
+    calls = {"check_out": lib.check_out_library_item, "request": lib.request_library_item}
+    start = time.perf_counter()
+    for operation, patron_id, item_id in stream:
+        if operation == "return":
+            lib.return_library_item(item_id)
+        else:
+            calls[operation](patron_id, item_id)
+    results["single calls"] = transactions / (time.perf_counter() - start)
+
+    lib = build_library(item_count, patron_count)
+    start = time.perf_counter()
+    lib.process_batch(stream)
+    results["process_batch"] = transactions / (time.perf_counter() - start)
+    return results
+
+
+def bench_cold_start(item_count=1000000, loan_count=100000):
+    """
+    compares restarting a library by replaying every add and check-out against loading it from a snapshot, then
+    looking up one item that has not been built yet
+    :param item_count: number of items in the catalog
+    :param loan_count: number of items checked out before saving
+    :return: a dictionary of restart method to seconds, and the snapshot size in bytes per item
+    """
+    patron_count = max(item_count // 10, 1)
+    results = {}
+    start = time.perf_counter()
+    lib = build_library(item_count, patron_count)
+    for i in range(loan_count):
+        lib.check_out_library_item("p" + str(i % patron_count), str(i))
+    results["replay"] = time.perf_counter() - start
+
+    path = os.path.join(tempfile.mkdtemp(), "library.snapshot")
+    start = time.perf_counter()
+    save_snapshot(lib, path)
+    results["save"] = time.perf_counter() - start
+    del lib
+    start = time.perf_counter()
+    lib = load_snapshot(path)
+    lib.lookup_library_item_from_id(str(item_count - 1))
+    results["load"] = time.perf_counter() - start
+    results["bytes per item"] = os.path.getsize(path) / item_count
+    os.remove(path)
+    return results
+
+
+def bench_transaction_log(item_count=100000, transactions=100000, group_sizes=(1, 64, 1024)):
+    """
+    times check-outs and returns with a write-ahead log at several group commit sizes, then times replaying the log
+    :param item_count: number of items in the catalog
+    :param transactions: number of logged check-outs and returns
+    :param group_sizes: records per group commit to measure, each with fsync after every group
+    :return: a dictionary of measure to transactions per second, and replayed records per millisecond
+    """
+    patron_count = max(item_count // 10, 1)
+    directory = tempfile.mkdtemp()
+    log_path = os.path.join(directory, "library.log")
+    results = {}
+    for group_size in group_sizes:
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        lib = build_library(item_count, patron_count)
+        transaction_log = WriteAheadLog(log_path, group_size=group_size)
+        lib.set_transaction_log(transaction_log)
+        start = time.perf_counter()
+        for i in range(transactions // 2):
+            item_id = str((i * 7919) % item_count)
+            lib.check_out_library_item("p" + str(i % patron_count), item_id)
+            lib.return_library_item(item_id)
+        transaction_log.close()
+        results["group size " + str(group_size)] = transactions / (time.perf_counter() - start)
+
+    lib = build_library(item_count, patron_count)
+    start = time.perf_counter()
+    replay_log(lib, log_path)
+    results["replay records per ms"] = transactions / ((time.perf_counter() - start) * 1000)
+    os.remove(log_path)
+    return results
+
+
+def bench_concurrent_scaling(item_count=100000, transactions=200000, thread_counts=(1, 2, 4, 8)):
+    """
+    splits the same number of check-out/return pairs across more and more threads on a ConcurrentLibrary, each
+    thread working on its own patrons and items, and counts any item that ends up checked out to two patrons
+    :param item_count: number of items in the catalog
+    :param transactions: total number of check-outs and returns across all threads
+    :param thread_counts: numbers of threads to measure
+    :return: a dictionary of thread count to (transactions per second, number of double loans)
+    """
+    patron_count = max(item_count // 10, 1)
+    results = {}
+    for thread_count in thread_counts:
+        lib = ConcurrentLibrary()
+        for i in range(item_count):
+            lib.add_library_item(Book(str(i), "Title " + str(i), "Author " + str(i)))
+        for i in range(patron_count):
+            lib.add_patron(Patron("p" + str(i), "Patron " + str(i)))
+
+        def work(thread_number):
+            for i in range(thread_number, transactions // 2, thread_count):
+                item_id = str((i * 7919) % item_count)
+                lib.check_out_library_item("p" + str(i % patron_count), item_id)
+                lib.return_library_item(item_id)
+
+        threads = [threading.Thread(target=work, args=(number,)) for number in range(thread_count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        loans = [item for patron in lib.get_patrons() for item in patron.get_checked_out_items()]
+        results[thread_count] = (transactions / elapsed, len(loans) - len(set(loans)))
+    return results
+
+
+def bench_hold_queue(hold_count=10000):
+    """
+    times placing hold_count holds on one title, asking every patron's position, cancelling every other hold, and
+    filling the remaining holds one return and check-out at a time
+    :param hold_count: number of patrons waiting on the title
+    :return: a dictionary of step to microseconds per hold
+    """
+    lib = build_library(1, hold_count + 1)
+    lib.check_out_library_item("p" + str(hold_count), "0")
+    patron_ids = ["p" + str(i) for i in range(hold_count)]
+    results = {}
+    start = time.perf_counter()
+    for patron_id in patron_ids:
+        lib.request_library_item(patron_id, "0")
+    results["request"] = (time.perf_counter() - start) / hold_count * 1e6
+    start = time.perf_counter()
+    for patron_id in patron_ids:
+        lib.get_hold_position(patron_id, "0")
+    results["position"] = (time.perf_counter() - start) / hold_count * 1e6
+    start = time.perf_counter()
+    for patron_id in patron_ids[1::2]:
+        lib.cancel_request(patron_id, "0")
+    results["cancel"] = (time.perf_counter() - start) / (hold_count // 2) * 1e6
+    start = time.perf_counter()
+    for patron_id in patron_ids[::2]:
+        lib.return_library_item("0")
+        lib.check_out_library_item(patron_id, "0")
+    results["fill"] = (time.perf_counter() - start) / (hold_count // 2) * 1e6
+    return results
+
+
+def build_searchable_library(item_count, seed=1):
+    """
+    builds a Library of Books, Albums and Movies whose titles and creators are drawn from a synthetic vocabulary
+    :param item_count: number of items
+    :param seed: seed for the random titles
+    :return: the Library object
+    """
+    rng = random.Random(seed)
+    words = ["w" + str(i) for i in range(20000)]
+    lib = Library()
+    for i in range(item_count):
+        title = " ".join(rng.choice(words) for word in range(rng.randint(1, 5)))
+        creator = rng.choice(words) + " " + rng.choice(words)
+        lib.add_library_item(ITEM_TYPES[i % 3](str(i), title, creator))
+    return lib
+
+
+def bench_search(item_counts=(100000, 1000000), queries=1000):
+    """
+    times term, two-term, prefix and type-filtered searches against catalogs of increasing size
+    :param item_counts: catalog sizes to measure
+    :param queries: number of queries of each kind
+    :return: a dictionary of (catalog size, query kind) to microseconds per query
+    """
+    rng = random.Random(2)
+    results = {}
+    for item_count in item_counts:
+        lib = build_searchable_library(item_count)
+        kinds = {"term": lambda: lib.search("w" + str(rng.randrange(20000))),
+                 "two terms": lambda: lib.search("w%d w%d" % (rng.randrange(20000), rng.randrange(20000))),
+                 "prefix": lambda: lib.search("w%d*" % rng.randrange(1000, 2000), limit=20),
+                 "typed creator": lambda: lib.search("w" + str(rng.randrange(20000)), Movie, "creator")}
+        for kind, query in kinds.items():
+            start = time.perf_counter()
+            for i in range(queries):
+                query()
+            results[(item_count, kind)] = (time.perf_counter() - start) / queries * 1e6
+    return results
+
+
+def bench_availability(item_count=1000000, loan_count=100000):
+    """
+    compares counting and listing the items at a location through the availability index against calling
+    get_location() on every item in the holdings, pass item_count=5000000 for the full catalog size
+    :param item_count: number of items, a third each of Books, Albums and Movies
+    :param loan_count: number of items checked out
+    :return: a dictionary of query to (index microseconds, scan microseconds)
+    """
+    patron_count = max(loan_count // 10, 1)
+    lib = Library()
+    for i in range(item_count):
+        lib.add_library_item(ITEM_TYPES[i % 3](str(i), "Title", "Creator"))
+    for i in range(patron_count):
+        lib.add_patron(Patron("p" + str(i), "Patron"))
+    for i in range(loan_count):
+        lib.check_out_library_item("p" + str(i % patron_count), str(i * (item_count // loan_count)))
+    items = list(lib.get_library_items())
+    queries = {
+        "count checked out Movies": (
+            lambda: lib.count_library_items("CHECKED_OUT", Movie),
+            lambda: sum(1 for item in items if isinstance(item, Movie) and item.get_location() == "CHECKED_OUT")),
+        "list Books on shelf": (
+            lambda: list(lib.get_library_item_ids("ON_SHELF", Book)),
+            lambda: [item.get_library_item_id() for item in items
+                     if isinstance(item, Book) and item.get_location() == "ON_SHELF"]),
+    }
+    results = {}
+    for query, (indexed, scan) in queries.items():
+        start = time.perf_counter()
+        indexed()
+        middle = time.perf_counter()
+        scan()
+        results[query] = ((middle - start) * 1e6, (time.perf_counter() - middle) * 1e6)
+    return results
+
+
+def bench_simulation_engine(item_count=200000, patron_count=20000, days=365, transactions_per_day=1000):
+    """
+    runs the same simulated year through a Library and through the NumPy CirculationEngine and checks they agree
+    :param item_count: number of items
+    :param patron_count: number of patrons
+    :param days: number of simulated days
+    :param transactions_per_day: transactions between date advances
+    :return: a dictionary of model to seconds, and whether every fine agreed
+    """
+    workload = Workload(item_count, patron_count, seed=3)
+    stream = workload.generate_transactions(days, transactions_per_day)
+    items = workload.build_items()
+    patron_ids = workload.get_patron_ids()
+    results = {}
+    lib = Library()
+    for item in items:
+        lib.add_library_item(item)
+    for patron_id in patron_ids:
+        lib.add_patron(Patron(patron_id, "Patron"))
+    start = time.perf_counter()
+    run_library(lib, stream)
+    results["library"] = time.perf_counter() - start
+    if np is None:
+        return results
+    engine = CirculationEngine(items, patron_ids)
+    start = time.perf_counter()
+    engine.run(stream)
+    results["engine"] = time.perf_counter() - start
+    results["fines agree"] = all(engine.get_fine_amount(patron_id) == lib.lookup_patron_from_id(patron_id).get_fine_amount()
+                                 for patron_id in patron_ids)
+    return results
+
+
+def bench_instrumentation(item_count=100000, transactions=100000):
+    """
+    times check-out/return pairs on a plain library, an instrumented one, and an instrumented one under the
+    sampling profiler
+    :param item_count: number of items
+    :param transactions: number of check-out/return pairs
+    :return: a dictionary of setup to mean microseconds per pair
+    """
+    lib = build_library(item_count, item_count // 10)
+    rng = random.Random(14)
+    pairs = [("p" + str(rng.randrange(item_count // 10)), str(rng.randrange(item_count))) for i in range(transactions)]
+
+    def run():
+        start = time.perf_counter()
+        for patron_id, item_id in pairs:
+            lib.check_out_library_item(patron_id, item_id)
+            lib.return_library_item(item_id)
+        return (time.perf_counter() - start) / transactions * 1e6
+
+    results = {"plain": run()}
+    instrument(lib)
+    results["instrumented"] = run()
+    with SamplingProfiler():
+        results["profiled"] = run()
+    uninstrument(lib)
+    return results
+
+
+def bench_sharded_scaling(item_count=100000, patron_count=10000, transactions=200000, batch_size=10000,
+                          shard_counts=None):
+    """
+    measures batch throughput and the time of a 30 day advance over the batch's loans, for one in-process Library
+    and for ShardedLibrary at each shard count. Speedup is bounded by the cores available.
+    :param item_count: number of items
+    :param patron_count: number of patrons
+    :param transactions: number of check-out, return and request transactions
+    :param batch_size: transactions per process_batch call
+    :param shard_counts: shard counts to measure, 1 up to the number of cores if None
+    :return: a dictionary of shard count (0 for the in-process Library) to (transactions per second, advance seconds)
+    """
+    shard_counts = range(1, (os.cpu_count() or 1) + 1) if shard_counts is None else shard_counts
+    workload = Workload(item_count, patron_count, seed=15)
+    items = workload.build_items()
+    patrons = [Patron(patron_id, "Patron") for patron_id in workload.get_patron_ids()]
+    stream = [transaction for transaction in workload.generate_transactions(1, transactions * 21 // 20)
+              if transaction[0] != "pay_fine" and transaction[0] != "advance_date"][:transactions]
+    batches = [stream[i:i + batch_size] for i in range(0, len(stream), batch_size)]
+
+    def run(lib):
+        start = time.perf_counter()
+        for batch in batches:
+            lib.process_batch(batch)
+        middle = time.perf_counter()
+        lib.advance_date(30)
+        return len(stream) / (middle - start), time.perf_counter() - middle
+
+    lib = Library()
+    for item in items:
+        lib.add_library_item(item)
+    for patron in patrons:
+        lib.add_patron(patron)
+    results = {0: run(lib)}
+    for shard_count in shard_counts:
+        with ShardedLibrary(shard_count) as sharded:
+            sharded.add_library_items(items)
+            sharded.add_patrons(patrons)
+            results[shard_count] = run(sharded)
+    return results
+
+
+def bench_server(connection_counts=(100, 1000, 5000), requests=100000, pipeline=4):
+    """
+    runs library_load_test against a local server with increasing numbers of connections, sharing the same number
+    of requests among them
+    :param connection_counts: numbers of simultaneous connections
+    :param requests: requests sent in each run
+    :param pipeline: requests each connection keeps in flight
+    :return: a dictionary of connection count to the load test's results
+    """
+    return {connections: asyncio.run(run_load_test(connections, requests // connections, pipeline))
+            for connections in connection_counts}
+
+
+def bench_import(item_count=1000000):
+    """
+    writes a workload's catalog as CSV and as JSON lines and imports each, into a Library backed by an ItemStore and
+    into a plain Library, timing the import apart from the first search, which builds the indexes
+    :param item_count: number of items in the catalog
+    :return: a dictionary of (format, library) to the rows imported per second and the seconds the first search takes
+    """
+    directory = tempfile.mkdtemp()
+    rows = [(get_item_type(item).__name__, item.get_library_item_id(), item.get_title(), item.get_creator())
+            for item in Workload(item_count, 0, seed=4).build_items()]
+    paths = {"csv": os.path.join(directory, "catalog.csv"), "jsonl": os.path.join(directory, "catalog.jsonl")}
+    with open(paths["csv"], "w") as file:
+        file.write(",".join(ITEM_COLUMNS) + "\n")
+        file.writelines(",".join(row) + "\n" for row in rows)
+    with open(paths["jsonl"], "w") as file:
+        file.writelines(json.dumps(dict(zip(ITEM_COLUMNS, row))) + "\n" for row in rows)
+    del rows
+    results = {}
+    for file_format, path in paths.items():
+        for name, make_library in (("ItemStore", lambda: Library(ItemStore())), ("Library", Library)):
+            library = make_library()
+            start = time.perf_counter()
+            import_library_items(library, path)
+            imported = time.perf_counter()
+            library.search("w0")
+            results[(file_format, name)] = (item_count / (imported - start), time.perf_counter() - imported)
+        os.remove(path)
+    os.rmdir(directory)
+    return results
+
+
+def bench_fine_report(item_count=200000, patron_count=100000, days=30, repeat=20):
+    """
+    times the fine report's total, overdue count and top debtors against reading every patron's fine, after a month
+    of a workload's transactions
+    :param item_count: number of items in the catalog
+    :param patron_count: number of patrons
+    :param days: days of transactions run before timing
+    :param repeat: times each query is run
+    :return: a dictionary of query to the microseconds it takes from the report and by reading every patron
+    """
+    workload = Workload(item_count, patron_count, seed=5)
+    library = workload.build_library()
+    run_library(library, workload.generate_transactions(days, patron_count // 10))
+    patrons = list(library.get_patrons())
+
+    def scan_total():
+        return sum(patron.get_fine_amount() for patron in patrons)
+
+    def scan_overdue():
+        return sum(patron.get_overdue_count() for patron in patrons)
+
+    def scan_top_debtors():
+        return heapq.nlargest(10, ((patron.get_fine_amount(), patron.get_patron_id()) for patron in patrons))
+
+    queries = {"total fines": (library.get_total_fines, scan_total),
+               "overdue items": (library.count_overdue_items, scan_overdue),
+               "top 10 debtors": (library.get_top_debtors, scan_top_debtors)}
+    results = {}
+    for query, methods in queries.items():
+        micros = []
+        for method in methods:
+            start = time.perf_counter()
+            for i in range(repeat):
+                method()
+            micros.append((time.perf_counter() - start) / repeat * 1e6)
+        results[query] = tuple(micros)
+    return results
+
+
+def bench_loan_policy(rule_counts=(0, 10, 1000), item_count=20000, transactions=100000):
+    """
+    times check-outs and returns under loan policies with increasing numbers of rules, which are compiled into a table
+    per patron class rather than read on each loan
+    :param rule_counts: numbers of rules in the policy, spread over item types and ten patron classes
+    :param item_count: number of items in the catalog
+    :param transactions: number of check-outs and returns
+    :return: a dictionary of rule count to microseconds per transaction
+    """
+    workload = Workload(item_count, 1000, seed=7)
+    stream = [transaction for transaction in workload.generate_transactions(1, transactions)
+              if transaction[0] in ("check_out", "return")]
+    results = {}
+    for rule_count in rule_counts:
+        policy = LoanPolicy()
+        for i in range(rule_count):
+            policy.set_rule(ITEM_TYPES[i % 3], "class" + str(i % 10), loan_days=7 + i % 21, fine_cap_cents=500 + i)
+        library = workload.build_library()
+        library.set_loan_policy(policy)
+        for i, patron in enumerate(library.get_patrons()):
+            patron.set_patron_class("class" + str(i % 10))
+            policy.get_table(patron.get_patron_class())  # compile outside the timing
+        start = time.perf_counter()
+        library.process_batch(stream)
+        results[rule_count] = (time.perf_counter() - start) / len(stream) * 1e6
+    return results
+
+
+def bench_loan_history(loan_count=1000000, memory_budget=16 << 20, queries=200):
+    """
+    records a history of completed loans under a memory budget, then times queries for one patron, one item and a
+    month of returns against a scan of every loan
+    :param loan_count: number of loans recorded, 100 returned a day
+    :param memory_budget: bytes of chunk columns the history keeps in memory
+    :param queries: number of queries of each kind timed
+    :return: a dictionary of measure to value, loans recorded per second, memory bytes, and for each query the
+    microseconds from the history and from a scan
+    """
+    rng = random.Random(3)
+    patron_count, item_count = loan_count // 50, loan_count // 10
+    history = LoanHistory(memory_budget=memory_budget)
+    loans = [("p" + str(rng.randrange(patron_count)), "i" + str(rng.randrange(item_count)),
+              i // 100 - rng.randrange(30), i // 100, rng.randrange(50)) for i in range(loan_count)]
+    start = time.perf_counter()
+    for loan in loans:
+        history.record_loan(*loan)
+    history.flush()
+    results = {"loans per second": loan_count / (time.perf_counter() - start),
+               "memory bytes": history.get_stats()["memory bytes"],
+               "spilled chunks": history.get_stats()["spilled chunks"]}
+    last_date = loans[-1][3]
+    for query, make_arguments in [("patron", lambda: (None, None, "p" + str(rng.randrange(patron_count)), None)),
+                                  ("item", lambda: (None, None, None, "i" + str(rng.randrange(item_count)))),
+                                  ("month", lambda: (lambda first: (first, first + 30, None, None))(
+                                      rng.randrange(last_date - 30)))]:
+        argument_lists = [make_arguments() for i in range(queries)]
+        start = time.perf_counter()
+        for argument_list in argument_lists:
+            history.get_loans(*argument_list)
+        indexed = (time.perf_counter() - start) / queries * 1e6
+        start = time.perf_counter()
+        for first, last, patron_id, library_item_id in argument_lists[:5]:
+            [loan for loan in loans if (first is None or loan[3] >= first) and (last is None or loan[2] <= last)
+             and patron_id in (None, loan[0]) and library_item_id in (None, loan[1])]
+        results[query + " query"] = (indexed, (time.perf_counter() - start) / 5 * 1e6)
+    history.close()
+    return results
+
+
+def bench_fork(item_count=100000, patron_count=10000, fork_count=20, scenario_transactions=2000):
+    """
+    times forking a library that has been in use against copying it with copy.deepcopy, and measures the memory each
+    fork adds when taken and after it runs a scenario
+    :param item_count: number of items in the catalog
+    :param patron_count: number of patrons
+    :param fork_count: number of forks taken
+    :param scenario_transactions: transactions each fork runs
+    :return: a dictionary of measure to value, seconds and bytes
+    """
+    workload = Workload(item_count, patron_count, seed=11)
+    library = workload.build_library()
+    run_library(library, workload.generate_transactions(30, 2000))
+    scenario = workload.generate_transactions(10, scenario_transactions // 10)
+    results = {}
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 100000))  # deepcopy recurses along chains of patrons and items
+    tracemalloc.start()
+    start = time.perf_counter()
+    copied = copy.deepcopy(library)
+    results["deepcopy seconds"] = time.perf_counter() - start
+    results["deepcopy bytes"] = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    sys.setrecursionlimit(recursion_limit)
+    del copied
+    start = time.perf_counter()
+    forks = [library.fork()]
+    results["first fork seconds"] = time.perf_counter() - start
+    start = time.perf_counter()
+    forks += [library.fork() for i in range(fork_count - 1)]
+    results["fork seconds"] = (time.perf_counter() - start) / (fork_count - 1)
+    del forks
+    tracemalloc.start()
+    forks = [library.fork() for i in range(fork_count)]
+    results["bytes per fork"] = tracemalloc.get_traced_memory()[0] / fork_count
+    for fork in forks:
+        run_library(fork, scenario)
+    results["bytes per fork after scenario"] = tracemalloc.get_traced_memory()[0] / fork_count
+    tracemalloc.stop()
+    return results
+
+
+def summarize_latencies(latencies):
+    """
+    summarizes the timings of one method
+    :param latencies: nanoseconds taken by each call
+    :return: a dictionary with the number of calls, calls per second, and the median and 99th percentile microseconds
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {"calls": count,
+            "throughput": count / (sum(latencies) / 1e9) if sum(latencies) else float("inf"),
+            "p50_us": latencies[count // 2] / 1000,
+            "p99_us": latencies[min(count - 1, count * 99 // 100)] / 1000}
+
+
+def time_calls(method, argument_lists):
+    """
+    calls a method once per argument list, timing each call on its own
+    :param method: the bound method to call
+    :param argument_lists: an iterable of argument tuples
+    :return: a list of nanoseconds, one per call
+    """
+    clock = time.perf_counter_ns
+    latencies = []
+    for arguments in argument_lists:
+        start = clock()
+        method(*arguments)
+        latencies.append(clock() - start)
+    return latencies
+
+
+def bench_library_methods(sizes=(1000, 10000, 100000), calls=2000, seed=0):
+    """
+    Times every public Library method on workload catalogs of each size, with ten patrons per hundred items and ids
+    drawn with Zipf popularity. Methods that change state are timed in orders that keep them meaningful: check-outs
+    before the returns of the same items, and requests before the hold positions and cancellations of the same holds.
+    Methods that list the whole catalog are called a twentieth as often and their results are read to the end.
+    :param sizes: catalog sizes to measure
+    :param calls: number of calls timed per method and size
+    :param seed: seed for the workload
+    :return: a dictionary of size (as a string, for JSON) to method name to summarize_latencies of its calls
+    """
+    results = {}
+    for size in sizes:
+        workload = Workload(size, max(size // 10, 1), seed)
+        lib = workload.build_library()
+        item_ids = workload.sample_item_ids(calls)
+        patron_ids = workload.sample_patron_ids(calls)
+        pairs = list(zip(patron_ids, item_ids))
+        listing_calls = max(calls // 20, 1)
+        stream = [transaction for transaction in workload.generate_transactions(1, calls * 100)
+                  if transaction[0] in ("check_out", "return", "request")]
+        new_items = [(Book("new" + str(i), "New Title", "New Author"),) for i in range(calls)]
+        new_patrons = [(Patron("newp" + str(i), "New Patron"),) for i in range(calls)]
+        timings = {
+            "add_library_item": lambda: time_calls(lib.add_library_item, new_items),
+            "add_patron": lambda: time_calls(lib.add_patron, new_patrons),
+            "lookup_library_item_from_id": lambda: time_calls(lib.lookup_library_item_from_id,
+                                                              [(item_id,) for item_id in item_ids]),
+            "lookup_patron_from_id": lambda: time_calls(lib.lookup_patron_from_id,
+                                                        [(patron_id,) for patron_id in patron_ids]),
+            "check_out_library_item": lambda: time_calls(lib.check_out_library_item, pairs),
+            "return_library_item": lambda: time_calls(lib.return_library_item, [(item_id,) for item_id in item_ids]),
+            "request_library_item": lambda: time_calls(lib.request_library_item, pairs),
+            "get_hold_position": lambda: time_calls(lib.get_hold_position, pairs),
+            "cancel_request": lambda: time_calls(lib.cancel_request, pairs),
+            "process_batch": lambda: time_calls(lib.process_batch, [(stream[i:i + 100],)
+                                                                    for i in range(0, len(stream), 100)][:calls]),
+            "pay_fine": lambda: time_calls(lib.pay_fine, [(patron_id, 0.5) for patron_id in patron_ids]),
+            "advance_date": lambda: time_calls(lib.advance_date, [(1,)] * calls),
+            "increment_current_date": lambda: time_calls(lib.increment_current_date, [()] * calls),
+            "get_current_date": lambda: time_calls(lib.get_current_date, [()] * calls),
+            "search": lambda: time_calls(lib.search, [(query,) for query in workload.generate_queries(calls)]),
+            "count_library_items": lambda: time_calls(lib.count_library_items,
+                                                      [(LOCATIONS[i % 3], ITEM_TYPES[i % 3]) for i in range(calls)]),
+            "get_library_item_ids": lambda: time_calls(lambda location: list(lib.get_library_item_ids(location)),
+                                                       [(LOCATIONS[i % 3],) for i in range(listing_calls)]),
+            "get_library_items": lambda: time_calls(lambda: list(lib.get_library_items()), [()] * listing_calls),
+            "get_patrons": lambda: time_calls(lambda: list(lib.get_patrons()), [()] * listing_calls),
+        }
+        results[str(size)] = {method: summarize_latencies(timing()) for method, timing in timings.items()}
+    return results
+
+
+def write_results(results, path):
+    """
+    writes benchmark results to a JSON file, with the Python version and platform they were measured on
+    :param results: the dictionary bench_library_methods returns
+    :param path: path of the JSON file
+    :return: None
+    """
+    with open(path, "w") as file:
+        json.dump({"python": platform.python_version(), "platform": platform.platform(), "results": results}, file,
+                  indent=2)
+
+
+def compare_to_baseline(results, baseline_path, tolerance=0.25, slack_us=1.0):
+    """
+    finds the methods whose median or 99th percentile latency has grown by more than a tolerance over a stored
+    baseline written by write_results. Sizes and methods missing from either side are skipped.
+    :param results: the dictionary bench_library_methods returns
+    :param baseline_path: path of the baseline JSON file
+    :param tolerance: allowed growth, 0.25 allows a latency up to 25% above the baseline
+    :param slack_us: allowed growth in microseconds on top of the tolerance, so timer noise on calls of a
+    microsecond or two is not reported
+    :return: a list of (size, method, measure, baseline microseconds, current microseconds), empty if none regressed
+    """
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+    regressions = []
+    for size, methods in results.items():
+        for method, summary in methods.items():
+            old = baseline.get(size, {}).get(method)
+            if old is None:
+                continue
+            for measure in ("p50_us", "p99_us"):
+                if summary[measure] > old[measure] * (1 + tolerance) + slack_us:
+                    regressions.append((size, method, measure, old[measure], summary[measure]))
+    return regressions
+
+
+class DictBook:
+    """
+    A Book laid out the way it was before __slots__ and location codes, one instance dictionary per item
+    """
+
+    def __init__(self, library_item_id, title, author):
+        self._library_item_id = library_item_id
+        self._title = title
+        self._location = "ON_SHELF"
+        self._checked_out_by = None
+        self._requested_by = None
+        self._date_checked_out = None
+        self._author = author
+
+
+def bench_memory_per_item(item_count=100000):
+    """
+    measures the bytes allocated per item for a catalog of Books held in three ways: dictionary-backed objects in a
+    list (the layout before __slots__), slotted Book objects added to a Library, and a Library backed by an ItemStore.
+    The strings for ids, titles and authors are built beforehand so only the storage itself is counted.
+    :param item_count: number of items to build
+    :return: a dictionary of storage kind to bytes per item
+    """
+    ids = [str(i) for i in range(item_count)]
+    titles = ["Title " + item_id for item_id in ids]
+    authors = ["Author " + item_id for item_id in ids]
+    results = {}
+
+    tracemalloc.start()
+    holdings = [DictBook(ids[i], titles[i], authors[i]) for i in range(item_count)]
+    results["dict objects"] = tracemalloc.get_traced_memory()[0] / item_count
+    tracemalloc.stop()
+    del holdings
+
+    tracemalloc.start()
+    lib = Library()
+    for i in range(item_count):
+        lib.add_library_item(Book(ids[i], titles[i], authors[i]))
+    results["slotted objects"] = tracemalloc.get_traced_memory()[0] / item_count
+    tracemalloc.stop()
+    del lib
+
+    tracemalloc.start()
+    store = ItemStore()
+    for i in range(item_count):
+        store.add(Book, ids[i], titles[i], authors[i])
+    lib = Library(store)
+    results["item store"] = tracemalloc.get_traced_memory()[0] / item_count
+    tracemalloc.stop()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for Library.py")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="catalog sizes for the per-method benchmarks")
+    parser.add_argument("--calls", type=int, default=2000, help="calls timed per method and size")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the workload")
+    parser.add_argument("--json", help="write the per-method results to this JSON file")
+    parser.add_argument("--baseline", help="compare the per-method results to this JSON file, exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed latency growth over the baseline")
+    parser.add_argument("--methods-only", action="store_true", help="run only the per-method benchmarks")
+    args = parser.parse_args()
+
+    method_results = bench_library_methods(args.sizes, args.calls, args.seed)
+    for size, methods in method_results.items():
+        for method, summary in methods.items():
+            print(f"{size:>7} items {method:>28}: {summary['throughput']:>12,.0f} calls per second, "
+                  f"p50 {summary['p50_us']:.2f} us, p99 {summary['p99_us']:.2f} us")
+    if args.json:
+        write_results(method_results, args.json)
+    if args.baseline:
+        regressions = compare_to_baseline(method_results, args.baseline, args.tolerance)
+        for size, method, measure, old, new in regressions:
+            print(f"regression: {size} items {method} {measure} {old:.2f} us -> {new:.2f} us")
+        if regressions:
+            sys.exit(1)
+    if args.methods_only:
+        sys.exit(0)
+
+    for size, micros in bench_transaction_latency().items():
+        print(f"{size:>9} items: {micros:.2f} us per transaction")
+    for loans, seconds in bench_year_simulation().items():
+        print(f"{loans:>9} loans: {seconds:.3f} s per simulated year")
+    for method, rate in bench_batch_throughput().items():
+        print(f"{method:>15}: {rate:,.0f} transactions per second")
+    for measure, value in bench_cold_start().items():
+        print(f"{measure:>15}: {value:.3f}")
+    for measure, rate in bench_transaction_log().items():
+        print(f"{measure:>22}: {rate:,.0f}")
+    for thread_count, (rate, double_loans) in bench_concurrent_scaling().items():
+        print(f"{thread_count:>3} threads: {rate:,.0f} transactions per second, {double_loans} double loans")
+    for step, micros in bench_hold_queue().items():
+        print(f"{step:>9} hold: {micros:.2f} us per hold")
+    for (item_count, kind), micros in bench_search().items():
+        print(f"{item_count:>9} items, {kind:>13} search: {micros:.1f} us per query")
+    for query, (indexed, scan) in bench_availability().items():
+        print(f"{query:>25}: {indexed:,.0f} us indexed, {scan:,.0f} us scanning")
+    for shard_count, (rate, advance) in bench_sharded_scaling().items():
+        print(f"{shard_count:>3} shards: {rate:,.0f} transactions per second, {advance:.3f} s to advance 30 days")
+    for connections, load in bench_server().items():
+        print(f"{connections:>6} connections: {load['requests per second']:,.0f} requests per second, "
+              f"p50 {load['p50 ms']:.1f} ms, p99 {load['p99 ms']:.1f} ms, {load['requests per batch']:,.0f} per batch")
+    for (file_format, library), (rate, index_seconds) in bench_import().items():
+        print(f"{file_format:>5} into {library:>9}: {rate:,.0f} rows per second, {index_seconds:.2f} s to index")
+    for query, (report, scan) in bench_fine_report().items():
+        print(f"{query:>15}: {report:,.1f} us from the report, {scan:,.0f} us reading every patron")
+    for rule_count, micros in bench_loan_policy().items():
+        print(f"{rule_count:>5} loan rules: {micros:.2f} us per check-out/return")
+    for measure, value in bench_loan_history().items():
+        if isinstance(value, tuple):
+            print(f"{measure:>16}: {value[0]:,.0f} us from the history, {value[1]:,.0f} us scanning every loan")
+        else:
+            print(f"{measure:>16}: {value:,.0f}")
+    for measure, value in bench_fork().items():
+        print(f"{measure:>29}: {value:,.4f}" if "seconds" in measure else f"{measure:>29}: {value:,.0f}")
+    for setup, micros in bench_instrumentation().items():
+        print(f"{setup:>15}: {micros:.2f} us per check-out/return")
+    for measure, value in bench_simulation_engine().items():
+        print(f"{measure:>15}: {value}")
+    for kind, size in bench_memory_per_item().items():
+        print(f"{kind:>15}: {size:.1f} bytes per item")
@@ -0,0 +1,409 @@
+# Description: A history of completed loans, set on a Library with Library.set_loan_history so every return is
+# recorded with its patron, item, dates and the fine it incurred. Loans are kept in columns, in chunks of a fixed
+# number of loans in the order they were returned, with patron and item ids stored as integer codes. Each chunk has
+# its loans sorted by patron and by item, and the history knows which chunks each patron and item appear in, so
+# queries by date, patron or item read only the chunks that can match. Chunks past a memory budget are written to disk
+# and read back through a memory map, and compact() merges small chunks and drops loans older than a date.
+
+import bisect
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from array import array
+
+CHUNK_MAGIC = b"LIBLOAN1"
+
+# Chunk file layout, all integers little-endian:
+# * header: magic, number of loans, first and last return date
+# * the fines in cents as 8-byte integers, then each 4-byte integer column of _INT_COLUMNS, one after another
+_CHUNK_HEADER = struct.Struct("<8sqqq")
+_INT_COLUMNS = ("patrons", "items", "dates_out", "dates_returned", "patron_order", "patron_sorted", "item_order",
+                "item_sorted")
+
+
+class _Chunk:
+    """
+    A sealed run of loans as columns. patrons and items hold codes, and patron_order lists the rows by patron code
+    (and by row for the same patron), with patron_sorted the codes in that order, so the rows of one patron are found
+    by bisection; item_order and item_sorted do the same for items. The columns are arrays while the chunk is in memory,
+    and memoryviews over a memory mapped file once it is spilled.
+    """
+
+    __slots__ = ("_fines", "_columns", "_path", "_map")
+
+    def __init__(self, patrons, items, dates_out, dates_returned, fines):
+        patron_order = sorted(range(len(patrons)), key=patrons.__getitem__)
+        item_order = sorted(range(len(items)), key=items.__getitem__)
+        self._fines = fines
+        self._columns = {"patrons": patrons, "items": items, "dates_out": dates_out, "dates_returned": dates_returned,
+                         "patron_order": array("i", patron_order),
+                         "patron_sorted": array("i", [patrons[row] for row in patron_order]),
+                         "item_order": array("i", item_order),
+                         "item_sorted": array("i", [items[row] for row in item_order])}
+        self._path = None
+        self._map = None
+
+    def __len__(self):
+        return len(self._fines)
+
+    def get_column(self, name):
+        """
+        returns a column of the chunk
+        :param name: "fines" or one of _INT_COLUMNS
+        :return: an array or memoryview of integers
+        """
+        return self._fines if name == "fines" else self._columns[name]
+
+    def get_date_range(self):
+        """
+        returns the first and last return dates in the chunk
+        :return: a tuple of two integers
+        """
+        dates_returned = self._columns["dates_returned"]
+        return dates_returned[0], dates_returned[-1]
+
+    def get_nbytes(self):
+        """
+        returns the memory the chunk's columns take, 0 once it is spilled
+        :return: an integer, bytes
+        """
+        if self._path is not None:
+            return 0
+        return len(self._fines) * (self._fines.itemsize + sum(column.itemsize for column in self._columns.values()))
+
+    def is_spilled(self):
+        """
+        returns whether the chunk's columns are on disk
+        :return: a boolean
+        """
+        return self._path is not None
+
+    def rows_for(self, field, code):
+        """
+        returns the rows of one patron or item, in the order they were returned
+        :param field: "patron" or "item"
+        :param code: the patron's or item's code
+        :return: a list of row numbers
+        """
+        sorted_codes = self._columns[field + "_sorted"]
+        first = bisect.bisect_left(sorted_codes, code)
+        return list(self._columns[field + "_order"][first:bisect.bisect_right(sorted_codes, code, first)])
+
+    def rows_returned_between(self, start, end):
+        """
+        returns the rows returned from start to end
+        :param start: first return date, None for no limit
+        :param end: last return date, None for no limit
+        :return: a range of row numbers
+        """
+        dates_returned = self._columns["dates_returned"]
+        first = 0 if start is None else bisect.bisect_left(dates_returned, start)
+        return range(first, len(dates_returned) if end is None else bisect.bisect_right(dates_returned, end, first))
+
+    def spill(self, path):
+        """
+        writes the chunk to a file and reads its columns from there from then on
+        :param path: path of the chunk file
+        :return: None
+        """
+        first_date, last_date = self.get_date_range()
+        with open(path, "wb") as chunk_file:
+            chunk_file.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, len(self), first_date, last_date))
+            self._fines.tofile(chunk_file)
+            for name in _INT_COLUMNS:
+                self._columns[name].tofile(chunk_file)
+        with open(path, "rb") as chunk_file:
+            self._map = mmap.mmap(chunk_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        offset = _CHUNK_HEADER.size
+        self._fines = view[offset:offset + 8 * len(self)].cast("q")
+        offset += 8 * len(self)
+        for name in _INT_COLUMNS:
+            self._columns[name] = view[offset:offset + 4 * len(self)].cast("i")
+            offset += 4 * len(self)
+        view.release()
+        self._path = path
+
+    def close(self):
+        """
+        releases a spilled chunk's memory map and removes its file
+        :return: None
+        """
+        if self._path is not None:
+            self._fines.release()
+            for column in self._columns.values():
+                column.release()
+            self._map.close()
+            os.remove(self._path)
+            self._path = None
+
+
+class LoanHistory:
+    """
+    An append-only store of completed loans: patron id, library item id, date checked out, date returned and the fine
+    the loan incurred in cents. Loans must be recorded in order of return date, as a Library does.
+
+    Loans are added to an active chunk of arrays and sealed into a _Chunk every chunk_size loans (or on flush()).
+    The history keeps, for every patron and item code, the numbers of the chunks it appears in, so a query for one
+    patron or item visits only those chunks, and a query by date skips the chunks returned outside the range. When the
+    chunks in memory take more than memory_budget bytes the oldest are spilled to files in directory. Recording and
+    querying are thread safe, for ConcurrentLibrary.
+    """
+
+    def __init__(self, directory=None, memory_budget=64 << 20, chunk_size=1 << 16):
+        """
+        :param directory: directory spilled chunks are written to, a new temporary directory if None
+        :param memory_budget: bytes of chunk columns kept in memory before the oldest chunks are spilled
+        :param chunk_size: loans in a chunk
+        """
+        self._directory = directory
+        self._own_directory = directory is None
+        self._memory_budget = memory_budget
+        self._chunk_size = chunk_size
+        self._patron_ids = []  # code -> patron id
+        self._patron_codes = {}
+        self._item_ids = []  # code -> library item id
+        self._item_codes = {}
+        self._chunks = []
+        self._patron_chunks = {}  # patron code -> array of the numbers of the chunks it appears in
+        self._item_chunks = {}  # item code -> array of the numbers of the chunks it appears in
+        self._memory_bytes = 0  # bytes of the columns of the chunks in memory
+        self._longest_loan = 0  # most days any loan was out, bounds the loans a date range can overlap
+        self._last_date_returned = None
+        self._file_count = 0
+        self._lock = threading.Lock()
+        self._start_active()
+
+    def _start_active(self):
+        """
+        empties the active chunk
+        :return: None
+        """
+        self._active = (array("i"), array("i"), array("i"), array("i"), array("q"))
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self._chunks) + len(self._active[0])
+
+    def _code(self, codes, ids, library_id):
+        """
+        returns the code of a patron or item id, giving it the next code the first time it is seen
+        :param codes: the dictionary of id to code
+        :param ids: the list of code to id
+        :param library_id: a patron id or library item id
+        :return: an integer
+        """
+        code = codes.get(library_id)
+        if code is None:
+            code = codes[library_id] = len(ids)
+            ids.append(library_id)
+        return code
+
+    def record_loan(self, patron_id, library_item_id, date_checked_out, date_returned, fine_cents):
+        """
+        appends a completed loan, called by the Library when an item is returned
+        :param patron_id: id of the patron who had the item
+        :param library_item_id: id of the item
+        :param date_checked_out: date the item was checked out
+        :param date_returned: date the item was returned, no earlier than that of the last loan recorded
+        :param fine_cents: fine the loan incurred, in cents
+        :return: None
+        """
+        with self._lock:
+            if self._last_date_returned is not None and date_returned < self._last_date_returned:
+                raise ValueError("loans must be recorded in order of return date")
+            self._last_date_returned = date_returned
+            patrons, items, dates_out, dates_returned, fines = self._active
+            patrons.append(self._code(self._patron_codes, self._patron_ids, patron_id))
+            items.append(self._code(self._item_codes, self._item_ids, library_item_id))
+            dates_out.append(date_checked_out)
+            dates_returned.append(date_returned)
+            fines.append(fine_cents)
+            self._longest_loan = max(self._longest_loan, date_returned - date_checked_out)
+            if len(patrons) >= self._chunk_size:
+                self._seal()
+
+    def flush(self):
+        """
+        seals the loans in the active chunk into a chunk of their own, so they are indexed and may be spilled
+        :return: None
+        """
+        with self._lock:
+            if self._active[0]:
+                self._seal()
+
+    def _seal(self):
+        """
+        turns the active chunk into a sealed chunk and spills chunks if the memory budget is exceeded
+        :return: None
+        """
+        self._add_chunk(_Chunk(*self._active))
+        self._start_active()
+        self._spill_over_budget()
+
+    def _add_chunk(self, chunk):
+        """
+        appends a sealed chunk and files its number under each patron and item in it
+        :param chunk: a _Chunk object
+        :return: None
+        """
+        number = len(self._chunks)
+        self._chunks.append(chunk)
+        self._memory_bytes += chunk.get_nbytes()
+        for code in set(chunk.get_column("patrons")):
+            self._patron_chunks.setdefault(code, array("i")).append(number)
+        for code in set(chunk.get_column("items")):
+            self._item_chunks.setdefault(code, array("i")).append(number)
+
+    def _spill_over_budget(self):
+        """
+        spills the oldest chunks still in memory until the chunks in memory fit in the memory budget
+        :return: None
+        """
+        for chunk in self._chunks:
+            if self._memory_bytes <= self._memory_budget:
+                break
+            if not chunk.is_spilled():
+                if self._directory is None:
+                    self._directory = tempfile.mkdtemp(prefix="loan-history-")
+                self._memory_bytes -= chunk.get_nbytes()
+                self._file_count += 1
+                chunk.spill(os.path.join(self._directory, f"chunk-{self._file_count}.loans"))
+
+    def _matching_rows(self, start, end, patron_id, library_item_id):
+        """
+        finds the loans that were out at any time from start to end, of a patron and of an item if given
+        :return: an iterator of (chunk or None for the active chunk, row) tuples, in the order the loans were returned
+        """
+        if patron_id is not None and patron_id not in self._patron_codes:
+            return
+        if library_item_id is not None and library_item_id not in self._item_codes:
+            return
+        patron_code = self._patron_codes.get(patron_id)
+        item_code = self._item_codes.get(library_item_id)
+        # a loan out on or before end was returned by end + the longest loan
+        last_return = None if end is None else end + self._longest_loan
+        if patron_code is not None:
+            numbers = self._patron_chunks.get(patron_code, ())
+            if item_code is not None:
+                numbers = sorted(set(numbers).intersection(self._item_chunks.get(item_code, ())))
+        elif item_code is not None:
+            numbers = self._item_chunks.get(item_code, ())
+        else:
+            numbers = range(len(self._chunks))
+        chunks = [self._chunks[number] for number in numbers]
+        for chunk in chunks + [None]:
+            if chunk is None:
+                patrons, items, dates_out, dates_returned, fines = self._active
+                rows = range(len(patrons))
+            else:
+                first_date, last_date = chunk.get_date_range()
+                if (start is not None and last_date < start) or (last_return is not None and first_date > last_return):
+                    continue
+                patrons, items = chunk.get_column("patrons"), chunk.get_column("items")
+                dates_out, dates_returned = chunk.get_column("dates_out"), chunk.get_column("dates_returned")
+                if patron_code is not None:
+                    rows = chunk.rows_for("patron", patron_code)
+                elif item_code is not None:
+                    rows = chunk.rows_for("item", item_code)
+                else:
+                    rows = chunk.rows_returned_between(start, last_return)
+            for row in rows:
+                if ((start is None or dates_returned[row] >= start) and (end is None or dates_out[row] <= end)
+                        and (patron_code is None or patrons[row] == patron_code)
+                        and (item_code is None or items[row] == item_code)):
+                    yield chunk, row
+
+    def get_loans(self, start=None, end=None, patron_id=None, library_item_id=None):
+        """
+        Returns the recorded loans that were out at any time from start to end, for example the loans of patron "p1"
+        during the year from date 365 with get_loans(365, 729, "p1").
+        :param start: first date, None for no limit
+        :param end: last date, None for no limit
+        :param patron_id: None for every patron, or the id of one
+        :param library_item_id: None for every item, or the id of one
+        :return: a list of (patron_id, library_item_id, date_checked_out, date_returned, fine_cents) tuples, in the
+        order the loans were returned
+        """
+        loans = []
+        with self._lock:
+            for chunk, row in self._matching_rows(start, end, patron_id, library_item_id):
+                columns = self._active if chunk is None else [chunk.get_column(name) for name in
+                                                              ("patrons", "items", "dates_out", "dates_returned",
+                                                               "fines")]
+                patrons, items, dates_out, dates_returned, fines = columns
+                loans.append((self._patron_ids[patrons[row]], self._item_ids[items[row]], dates_out[row],
+                              dates_returned[row], fines[row]))
+        return loans
+
+    def get_item_turnover(self, start=None, end=None):
+        """
+        counts the loans of each item that were out at any time from start to end
+        :param start: first date, None for no limit
+        :param end: last date, None for no limit
+        :return: a dictionary of library item id to number of loans, for the items lent in the range
+        """
+        counts = {}
+        with self._lock:
+            for chunk, row in self._matching_rows(start, end, None, None):
+                code = (self._active[1] if chunk is None else chunk.get_column("items"))[row]
+                counts[code] = counts.get(code, 0) + 1
+        return {self._item_ids[code]: count for code, count in counts.items()}
+
+    def compact(self, drop_before=None, chunk_loans=None):
+        """
+        Merges runs of sealed chunks into chunks of up to chunk_loans loans, optionally dropping the loans returned
+        before a date, and rebuilds the chunk numbers of every patron and item. Merged chunks are spilled again if the
+        memory budget is exceeded. The active chunk is left as it is.
+        :param drop_before: loans returned before this date are dropped, None to keep every loan
+        :param chunk_loans: most loans in a merged chunk, 8 times the chunk size if None
+        :return: None
+        """
+        chunk_loans = 8 * self._chunk_size if chunk_loans is None else chunk_loans
+        with self._lock:
+            old_chunks = self._chunks
+            self._chunks = []
+            self._patron_chunks = {}
+            self._item_chunks = {}
+            self._memory_bytes = 0
+            merged = None
+            for chunk in old_chunks:
+                rows = chunk.rows_returned_between(drop_before, None)
+                if merged is not None and len(merged[0]) + len(rows) > chunk_loans:
+                    self._add_chunk(_Chunk(*merged))
+                    merged = None
+                if rows:
+                    if merged is None:
+                        merged = (array("i"), array("i"), array("i"), array("i"), array("q"))
+                    for column, name in zip(merged, ("patrons", "items", "dates_out", "dates_returned", "fines")):
+                        column.extend(chunk.get_column(name)[rows.start:rows.stop])
+                chunk.close()
+            if merged is not None:
+                self._add_chunk(_Chunk(*merged))
+            self._spill_over_budget()
+
+    def get_stats(self):
+        """
+        returns the size of the history
+        :return: a dictionary with the number of loans, chunks and spilled chunks, and the bytes of chunk columns in
+        memory
+        """
+        with self._lock:
+            return {"loans": len(self), "chunks": len(self._chunks),
+                    "spilled chunks": sum(chunk.is_spilled() for chunk in self._chunks),
+                    "memory bytes": self._memory_bytes}
+
+    def close(self):
+        """
+        removes the spilled chunk files, and the directory if the history made it
+        :return: None
+        """
+        with self._lock:
+            for chunk in self._chunks:
+                chunk.close()
+            self._chunks = []
+            if self._own_directory and self._directory is not None:
+                shutil.rmtree(self._directory, ignore_errors=True)
+                self._directory = None
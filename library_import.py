@@ -0,0 +1,267 @@
+# Description: Bulk loading of library items and patrons from CSV and JSON lines files. Files are read in chunks of
+# a few megabytes; a chunk without quoting or blank lines is split into columns with one str.split rather than row by
+# row, and items are added to the library a chunk at a time through Library.add_library_item_rows, so the search and
+# availability indexes are built once when the library is next searched. Repeated ids and malformed rows are
+# reported by line number and skipped rather than stopping the import.
+
+import csv
+import io
+import json
+from itertools import repeat
+from Library import *
+
+ITEM_COLUMNS = ("type", "library_item_id", "title", "creator")  # fields an item row must have
+PATRON_COLUMNS = ("patron_id", "name")  # fields a patron row must have
+
+# the names accepted in an item row's type field, with their item type codes
+ITEM_TYPE_CODES = {name: type_code for type_code, item_type in enumerate(ITEM_TYPES)
+                   for name in (item_type.__name__, item_type.__name__.lower(), item_type.__name__.upper())}
+
+FILE_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}  # file extensions and their formats
+
+CHUNK_SIZE = 1 << 22  # characters read at a time
+
+
+def get_file_format(path):
+    """
+    returns the format of a file from its extension
+    :param path: path of a .csv, .jsonl or .ndjson file
+    :return: "csv" or "jsonl"
+    """
+    for extension, file_format in FILE_FORMATS.items():
+        if path.lower().endswith(extension):
+            return file_format
+    raise ValueError(f"unknown file format for {path}, expected one of {', '.join(FILE_FORMATS)}")
+
+
+def _read_chunks(file, chunk_size):
+    """
+    reads a file in chunks that end at the end of a line, a chunk whose last line is inside a quoted CSV field is
+    extended to the end of the field
+    :param file: a file opened for reading text
+    :param chunk_size: characters read at a time
+    :return: an iterator of strings, each ending in a newline
+    """
+    pending = ""
+    while True:
+        text = file.read(chunk_size)
+        if not text:
+            break
+        text = pending + text
+        end = text.rfind("\n") + 1
+        if end == 0 or text.count('"', 0, end) % 2:
+            pending = text
+            continue
+        pending = text[end:]
+        yield text[:end]
+    if pending:
+        yield pending if pending.endswith("\n") else pending + "\n"
+
+
+def _split_csv_chunk(chunk, width, first_line):
+    """
+    splits a chunk of CSV lines into columns. A chunk without quotes whose every line has width fields is split with
+    one str.split; anything else is read by csv.reader, skipping blank lines and reporting rows with the wrong number
+    of fields.
+    :param chunk: a string of whole lines
+    :param width: number of fields in a row
+    :param first_line: line number of the chunk's first line
+    :return: a tuple of the columns, the line number of each row, and a list of (line number, reason) of bad rows
+    """
+    if '"' not in chunk:
+        chunk_lines = chunk.split("\n")
+        chunk_lines.pop()  # the empty string after the last newline
+        if set(map(str.count, chunk_lines, repeat(","))) == {width - 1} and "" not in chunk_lines:
+            fields = ",".join(chunk_lines).split(",")
+            return [fields[i::width] for i in range(width)], range(first_line, first_line + len(chunk_lines)), []
+    rows, lines, bad_rows = [], [], []
+    reader = csv.reader(io.StringIO(chunk))
+    line = first_line
+    for row in reader:
+        if row and len(row) != width:
+            bad_rows.append((line, f"expected {width} fields, found {len(row)}"))
+        elif row:
+            rows.append(row)
+            lines.append(line)
+        line = first_line + reader.line_num
+    return [list(column) for column in zip(*rows)] or [[] for i in range(width)], lines, bad_rows
+
+
+def _read_csv(file, columns, chunk_size):
+    """
+    reads the named columns of a CSV file with a header row
+    :param file: a file opened for reading text
+    :param columns: names of the columns wanted, each must be in the header
+    :param chunk_size: characters read at a time
+    :return: an iterator of (columns, line numbers, bad rows) tuples, one per chunk
+    """
+    header = next(csv.reader([file.readline()]), [])
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"CSV header is missing the column {', '.join(missing)}")
+    positions = [header.index(column) for column in columns]
+    first_line = 2
+    for chunk in _read_chunks(file, chunk_size):
+        all_columns, lines, bad_rows = _split_csv_chunk(chunk, len(header), first_line)
+        yield [all_columns[position] for position in positions], lines, bad_rows
+        first_line += chunk.count("\n")
+
+
+def _check_record(record, columns):
+    """
+    returns why a parsed JSON line cannot be imported
+    :param record: the parsed line
+    :param columns: names of the fields wanted
+    :return: a string, or None if the record has every field as a string
+    """
+    if not isinstance(record, dict):
+        return "not a JSON object"
+    for column in columns:
+        if column not in record:
+            return f"missing field {column}"
+        if not isinstance(record[column], str):
+            return f"field {column} is not a string"
+    return None
+
+
+def _split_jsonl_chunk(chunk, columns, first_line):
+    """
+    splits a chunk of JSON lines into columns. The lines are parsed as one JSON array when each of them is one object
+    with every field as a string; otherwise they are parsed one at a time, skipping blank lines and reporting bad rows.
+    Lines end at "\n" only, JSON strings may hold the other line separators.
+    :param chunk: a string of whole lines
+    :param columns: names of the fields wanted
+    :param first_line: line number of the chunk's first line
+    :return: a tuple of the columns, the line number of each row, and a list of (line number, reason) of bad rows
+    """
+    text_lines = chunk.split("\n")
+    text_lines.pop()  # the empty string after the last newline
+    try:
+        records = json.loads("[" + ",".join(text_lines) + "]")
+        values = [[record[column] for record in records] for column in columns]
+        if len(records) == len(text_lines) and all(type(value) is str for column in values for value in column):
+            return values, range(first_line, first_line + len(records)), []
+    except (ValueError, KeyError, TypeError):
+        pass
+    values, lines, bad_rows = [[] for column in columns], [], []
+    for line, text in enumerate(text_lines, first_line):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+        except ValueError:
+            bad_rows.append((line, "invalid JSON"))
+            continue
+        reason = _check_record(record, columns)
+        if reason is not None:
+            bad_rows.append((line, reason))
+            continue
+        for column, column_values in zip(columns, values):
+            column_values.append(record[column])
+        lines.append(line)
+    return values, lines, bad_rows
+
+
+def _read_jsonl(file, columns, chunk_size):
+    """
+    reads the named fields of a JSON lines file
+    :param file: a file opened for reading text
+    :param columns: names of the fields wanted, each must be in every line
+    :param chunk_size: characters read at a time
+    :return: an iterator of (columns, line numbers, bad rows) tuples, one per chunk
+    """
+    first_line = 1
+    for chunk in _read_chunks(file, chunk_size):
+        yield _split_jsonl_chunk(chunk, columns, first_line)
+        first_line += chunk.count("\n")
+
+
+def _read_rows(path, file_format, columns, chunk_size):
+    """
+    reads the named columns of a CSV or JSON lines file a chunk at a time
+    :param path: path of the file
+    :param file_format: "csv", "jsonl", or None to tell from the file's extension
+    :param columns: names of the columns wanted
+    :param chunk_size: characters read at a time
+    :return: an iterator of (columns, line numbers, bad rows) tuples, one per chunk
+    """
+    file_format = get_file_format(path) if file_format is None else file_format
+    if file_format not in ("csv", "jsonl"):
+        raise ValueError(f"unknown file format {file_format}, expected csv or jsonl")
+    with open(path, encoding="utf-8-sig") as file:
+        read = _read_csv if file_format == "csv" else _read_jsonl
+        yield from read(file, columns, chunk_size)
+
+
+def _drop_rows(values, lines, bad_positions):
+    """
+    removes rows from columns and their line numbers
+    :param values: a list of columns
+    :param lines: the line number of each row
+    :param bad_positions: a set of positions of the rows to remove
+    :return: a tuple of the remaining columns and line numbers
+    """
+    kept = [position for position in range(len(lines)) if position not in bad_positions]
+    return [[column[position] for position in kept] for column in values], [lines[position] for position in kept]
+
+
+def import_library_items(library, path, file_format=None, chunk_size=CHUNK_SIZE):
+    """
+    Adds the items in a CSV or JSON lines file to a library. Each row has a type (Book, Album or Movie, in any case),
+    a library_item_id, a title and a creator; a CSV file names its columns in a header row and may have others. Rows
+    with an unknown type or an empty id are skipped as bad rows, and rows whose id is already in the library, or
+    earlier in the file, are skipped as duplicates. A library backed by an ItemStore loads fastest, see
+    Library.add_library_item_rows.
+    :param library: the Library to add the items to
+    :param path: path of a .csv, .jsonl or .ndjson file
+    :param file_format: "csv", "jsonl", or None to tell from the file's extension
+    :param chunk_size: characters read at a time
+    :return: a dictionary of the rows read, the items added, the (line number, id) of each duplicate and the
+    (line number, reason) of each bad row
+    """
+    results = {"rows": 0, "added": 0, "duplicates": [], "bad rows": []}
+    for (types, ids, titles, creators), lines, bad_rows in _read_rows(path, file_format, ITEM_COLUMNS, chunk_size):
+        results["rows"] += len(lines) + len(bad_rows)
+        type_codes = list(map(ITEM_TYPE_CODES.get, types))
+        if None in type_codes or "" in ids:
+            bad_positions = set()
+            for position, (type_code, library_item_id) in enumerate(zip(type_codes, ids)):
+                if type_code is None:
+                    bad_rows.append((lines[position], f"unknown item type {types[position]}"))
+                    bad_positions.add(position)
+                elif not library_item_id:
+                    bad_rows.append((lines[position], "empty library_item_id"))
+                    bad_positions.add(position)
+            (type_codes, ids, titles, creators), lines = _drop_rows([type_codes, ids, titles, creators], lines,
+                                                                    bad_positions)
+        rejected = library.add_library_item_rows(type_codes, ids, titles, creators)
+        results["added"] += len(ids) - len(rejected)
+        results["duplicates"] += [(lines[position], ids[position]) for position in rejected]
+        results["bad rows"] += sorted(bad_rows)
+    return results
+
+
+def import_patrons(library, path, file_format=None, chunk_size=CHUNK_SIZE):
+    """
+    Adds the patrons in a CSV or JSON lines file to a library. Each row has a patron_id and a name; a CSV file names
+    its columns in a header row and may have others. Rows with an empty id are skipped as bad rows, and rows whose id
+    is already in the library, or earlier in the file, are skipped as duplicates.
+    :param library: the Library to add the patrons to
+    :param path: path of a .csv, .jsonl or .ndjson file
+    :param file_format: "csv", "jsonl", or None to tell from the file's extension
+    :param chunk_size: characters read at a time
+    :return: a dictionary of the rows read, the patrons added, the (line number, id) of each duplicate and the
+    (line number, reason) of each bad row
+    """
+    results = {"rows": 0, "added": 0, "duplicates": [], "bad rows": []}
+    for (ids, names), lines, bad_rows in _read_rows(path, file_format, PATRON_COLUMNS, chunk_size):
+        results["rows"] += len(lines) + len(bad_rows)
+        if "" in ids:
+            bad_positions = {position for position, patron_id in enumerate(ids) if not patron_id}
+            bad_rows += [(lines[position], "empty patron_id") for position in bad_positions]
+            (ids, names), lines = _drop_rows([ids, names], lines, bad_positions)
+        rejected = library.add_patrons(map(Patron, ids, names))
+        results["added"] += len(ids) - len(rejected)
+        results["duplicates"] += [(lines[position], ids[position]) for position in rejected]
+        results["bad rows"] += sorted(bad_rows)
+    return results
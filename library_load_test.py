@@ -0,0 +1,105 @@
+# Description: A load test for library_server.py. Simulated branch terminals each hold a LibraryClient connection and
+# send a workload's check-outs, returns, requests and payments with a few requests in flight at a time. By default
+# the server runs in the same event loop on a local socket; --port or --unix test a server that is already running.
+# Run with "python library_load_test.py --connections 1000".
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from library_server import *
+from library_workload import *
+
+
+async def _run_terminal(client, transactions, pipeline, latencies):
+    """
+    sends one terminal's transactions, pipeline at a time
+    :param client: the terminal's LibraryClient
+    :param transactions: (operation, patron_id, argument) tuples from Workload.generate_transactions
+    :param pipeline: requests the terminal keeps in flight
+    :param latencies: list the seconds of each request are appended to
+    :return: None
+    """
+    clock = time.perf_counter
+
+    async def send(operation, patron_id, argument):
+        start = clock()
+        if operation == "check_out":
+            await client.check_out_library_item(patron_id, argument)
+        elif operation == "return":
+            await client.return_library_item(argument)
+        elif operation == "request":
+            await client.request_library_item(patron_id, argument)
+        else:
+            await client.pay_fine(patron_id, argument)
+        latencies.append(clock() - start)
+
+    for i in range(0, len(transactions), pipeline):
+        await asyncio.gather(*[send(*transaction) for transaction in transactions[i:i + pipeline]])
+
+
+async def run_load_test(connections=1000, requests_per_connection=100, pipeline=4, item_count=100000,
+                        patron_count=10000, seed=0, host="127.0.0.1", port=None, path=None):
+    """
+    Opens connections to a server and has each send its share of a workload's transactions, then closes them.
+    :param connections: number of simulated terminals, each with its own connection
+    :param requests_per_connection: requests each terminal sends
+    :param pipeline: requests each terminal keeps in flight
+    :param item_count: items in the workload catalog
+    :param patron_count: patrons in the workload
+    :param seed: seed for the workload
+    :param host: address of the server to test
+    :param port: port of the server to test, a local server on a Unix socket is started if port and path are None
+    :param path: Unix socket path of the server to test
+    :return: a dictionary with the requests per second, the p50 and p99 latency in milliseconds, the connections,
+    and for a local server the mean requests per batch
+    """
+    workload = Workload(item_count, patron_count, seed)
+    stream = [transaction for transaction in workload.generate_transactions(1, connections * requests_per_connection)
+              if transaction[0] != "advance_date"]
+    server = None
+    if port is None and path is None:
+        server = LibraryServer(workload.build_library(), max_pipelined=max(pipeline, 64))
+        path = os.path.join(tempfile.mkdtemp(), "library.sock")
+        await server.start_unix(path)
+    clients = []
+    for i in range(0, connections, 500):  # connect in waves so the listen backlog does not overflow
+        clients += await asyncio.gather(*[LibraryClient.connect(host, port, path)
+                                          for j in range(min(500, connections - i))])
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_run_terminal(client, stream[i::connections], pipeline, latencies)
+                           for i, client in enumerate(clients)])
+    seconds = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+    latencies.sort()
+    results = {"connections": connections,
+               "requests per second": len(latencies) / seconds,
+               "p50 ms": latencies[len(latencies) // 2] * 1000,
+               "p99 ms": latencies[len(latencies) * 99 // 100] * 1000}
+    if server is not None:
+        stats = server.get_stats()
+        results["requests per batch"] = stats["requests"] / max(stats["batches"], 1)
+        await server.close()
+        os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for library_server.py")
+    parser.add_argument("--connections", type=int, default=1000, help="simulated terminals")
+    parser.add_argument("--requests", type=int, default=100, help="requests per terminal")
+    parser.add_argument("--pipeline", type=int, default=4, help="requests each terminal keeps in flight")
+    parser.add_argument("--items", type=int, default=100000, help="items in the workload catalog")
+    parser.add_argument("--patrons", type=int, default=10000, help="patrons in the workload")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the workload")
+    parser.add_argument("--host", default="127.0.0.1", help="address of a running server")
+    parser.add_argument("--port", type=int, help="port of a running server, a local server is started if not given")
+    parser.add_argument("--unix", help="Unix socket path of a running server")
+    args = parser.parse_args()
+    results = asyncio.run(run_load_test(args.connections, args.requests, args.pipeline, args.items, args.patrons,
+                                        args.seed, args.host, args.port, args.unix))
+    for measure, value in results.items():
+        print(f"{measure:>20}: {value:,.2f}")
@@ -0,0 +1,370 @@
+# Description: Opt-in instrumentation for Library.py. instrument() makes a library time its methods and count their
+# results into a LibraryMetrics object, which can be read as a snapshot dictionary or exported in the Prometheus text
+# format. SamplingProfiler samples the stacks of running threads to show where time inside Library.py goes.
+
+import bisect
+import os
+import sys
+import threading
+import time
+from array import array
+from Library import *
+
+# upper bounds, in seconds, of the latency histogram buckets, a last bucket (+Inf) takes every slower call
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 1e-2, 1e-1, 1.0)
+
+# the methods instrument() wraps by default, the public operations of a Library. The lookups are left out because
+# every operation calls them, and get_library_items because it is a generator whose work happens after it returns.
+INSTRUMENTED_METHODS = ("add_library_item", "add_patron", "check_out_library_item", "return_library_item",
+                        "request_library_item", "cancel_request", "get_hold_position", "process_batch", "pay_fine",
+                        "advance_date", "increment_current_date", "search", "count_library_items",
+                        "get_library_item_ids")
+
+
+class _MethodTally:
+    """
+    The calls of one method made by one thread: a count per latency bucket (one per LATENCY_BUCKETS bound, then
+    +Inf), the total seconds, the calls that raised, and a dictionary of result string to count
+    """
+
+    __slots__ = ("buckets", "seconds", "errors", "results")
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.seconds = 0.0
+        self.errors = 0
+        self.results = {}
+
+    def add(self, seconds, result):
+        """
+        records one call that returned
+        :param seconds: time the call took
+        :param result: what the call returned, counted if it is a string or an array of result codes
+        :return: None
+        """
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.seconds += seconds
+        results = self.results
+        if type(result) is str:
+            results[result] = results.get(result, 0) + 1
+        elif type(result) is array:
+            for code in result:
+                results[RESULTS[code]] = results.get(RESULTS[code], 0) + 1
+
+
+class LibraryMetrics:
+    """
+    Per-method call counts, latency histograms and result counters for instrumented libraries.
+
+    A result is counted when the method returns a string, or once per code when it returns the result codes of
+    process_batch. Each thread records into its own tally for each method, so recording needs no lock and one
+    LibraryMetrics can be shared by a ConcurrentLibrary's threads or by several libraries; snapshot() adds the
+    threads' tallies together.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()  # held while tallies are added, and by snapshot and reset
+        self._method_tallies = {}  # method name -> {thread id: _MethodTally}
+
+    def get_thread_tallies(self, method):
+        """
+        returns the tallies of a method, adding an empty dictionary for them if it has none yet
+        :param method: name of the method
+        :return: a dictionary of thread id to _MethodTally
+        """
+        thread_tallies = self._method_tallies.get(method)
+        if thread_tallies is None:
+            with self._lock:
+                thread_tallies = self._method_tallies.setdefault(method, {})
+        return thread_tallies
+
+    def get_tally(self, method):
+        """
+        returns the calling thread's tally of a method, adding it if the thread has not recorded the method before
+        :param method: name of the method
+        :return: the _MethodTally object
+        """
+        thread_tallies = self.get_thread_tallies(method)
+        tally = thread_tallies.get(threading.get_ident())
+        if tally is None:
+            with self._lock:
+                tally = thread_tallies.setdefault(threading.get_ident(), _MethodTally())
+        return tally
+
+    def observe(self, method, seconds, result=None, error=False):
+        """
+        records one call of a method
+        :param method: name of the method
+        :param seconds: time the call took
+        :param result: what the call returned
+        :param error: True if the call raised
+        :return: None
+        """
+        tally = self.get_tally(method)
+        if error:
+            tally.errors += 1
+            result = None
+        tally.add(seconds, result)
+
+    def reset(self):
+        """
+        forgets every recorded call
+        :return: None
+        """
+        with self._lock:
+            for thread_tallies in self._method_tallies.values():
+                thread_tallies.clear()
+
+    def snapshot(self):
+        """
+        returns the metrics recorded so far, summed over every thread
+        :return: a dictionary of method name to a dictionary with "calls", "errors", "seconds", "buckets" (a list of
+        (upper bound, cumulative calls) pairs ending with float("inf")) and "results" (result string to count)
+        """
+        snapshot = {}
+        with self._lock:
+            for method, thread_tallies in self._method_tallies.items():
+                if not thread_tallies:
+                    continue
+                buckets, seconds, errors, results = [0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0, {}
+                for tally in thread_tallies.values():
+                    buckets = [old + new for old, new in zip(buckets, tally.buckets)]
+                    seconds += tally.seconds
+                    errors += tally.errors
+                    for result, count in list(tally.results.items()):
+                        results[result] = results.get(result, 0) + count
+                cumulative, calls = [], 0
+                for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                    calls += count
+                    cumulative.append((bound, calls))
+                snapshot[method] = {"calls": calls, "errors": errors, "seconds": seconds, "buckets": cumulative,
+                                    "results": results}
+        return snapshot
+
+    def to_prometheus(self, prefix="library"):
+        """
+        exports the metrics in the Prometheus text exposition format, as library_calls_total,
+        library_call_errors_total, library_call_duration_seconds (a histogram) and library_results_total
+        :param prefix: prefix of the metric names
+        :return: a string
+        """
+        snapshot = self.snapshot()
+        lines = ["# HELP %s_calls_total Calls to Library methods." % prefix,
+                 "# TYPE %s_calls_total counter" % prefix]
+        for method, metrics in snapshot.items():
+            lines.append('%s_calls_total{method="%s"} %d' % (prefix, method, metrics["calls"]))
+        lines += ["# HELP %s_call_errors_total Calls to Library methods that raised." % prefix,
+                  "# TYPE %s_call_errors_total counter" % prefix]
+        for method, metrics in snapshot.items():
+            lines.append('%s_call_errors_total{method="%s"} %d' % (prefix, method, metrics["errors"]))
+        lines += ["# HELP %s_call_duration_seconds Latency of Library methods." % prefix,
+                  "# TYPE %s_call_duration_seconds histogram" % prefix]
+        for method, metrics in snapshot.items():
+            for bound, count in metrics["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_call_duration_seconds_bucket{method="%s",le="%s"} %d' % (prefix, method, le, count))
+            lines.append('%s_call_duration_seconds_sum{method="%s"} %r' % (prefix, method, metrics["seconds"]))
+            lines.append('%s_call_duration_seconds_count{method="%s"} %d' % (prefix, method, metrics["calls"]))
+        lines += ["# HELP %s_results_total Results returned by Library methods." % prefix,
+                  "# TYPE %s_results_total counter" % prefix]
+        for method, metrics in snapshot.items():
+            for result, count in sorted(metrics["results"].items()):
+                lines.append('%s_results_total{method="%s",result="%s"} %d'
+                             % (prefix, method, _escape_label(result), count))
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    """
+    escapes a Prometheus label value
+    :param value: a string
+    :return: the string with backslashes, double quotes and newlines escaped
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _timed(name, method, metrics):
+    """
+    wraps a method so each call is recorded in metrics
+    :param name: name the calls are recorded under
+    :param method: the function to wrap
+    :param metrics: the LibraryMetrics object
+    :return: the wrapping function
+    """
+    clock = time.perf_counter
+    get_ident = threading.get_ident
+    thread_tallies = metrics.get_thread_tallies(name)
+
+    def timed(self, *args, **kwargs):
+        start = clock()
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            metrics.observe(name, clock() - start, error=True)
+            raise
+        seconds = clock() - start
+        tally = thread_tallies.get(get_ident())
+        if tally is None:
+            tally = metrics.get_tally(name)
+        tally.add(seconds, result)
+        return result
+
+    timed.__name__ = method.__name__
+    timed.__doc__ = method.__doc__
+    return timed
+
+
+def instrument(library, metrics=None, methods=INSTRUMENTED_METHODS):
+    """
+    Makes a library record its calls in metrics. The library's class is swapped for a subclass whose methods time
+    and count each call before handing it to the original method, so a library that is not instrumented runs the
+    original class and pays nothing. Calls one instrumented method makes to another (increment_current_date calling
+    advance_date) are recorded for both.
+    :param library: a Library or ConcurrentLibrary object, not already instrumented
+    :param metrics: the LibraryMetrics object to record into, a new one if None
+    :param methods: names of the methods to instrument
+    :return: the LibraryMetrics object
+    """
+    if get_metrics(library) is not None:
+        raise ValueError("library is already instrumented")
+    metrics = LibraryMetrics() if metrics is None else metrics
+    base = type(library)
+    namespace = {"__slots__": (), "_instrumented_metrics": metrics}
+    for name in methods:
+        namespace[name] = _timed(name, getattr(base, name), metrics)
+    library.__class__ = type("Instrumented" + base.__name__, (base,), namespace)
+    return metrics
+
+
+def uninstrument(library):
+    """
+    stops a library recording its calls, giving it back its original class
+    :param library: an instrumented library
+    :return: None
+    """
+    if get_metrics(library) is not None:
+        library.__class__ = type(library).__bases__[0]
+
+
+def get_metrics(library):
+    """
+    returns the metrics an instrumented library records into
+    :param library: a library
+    :return: the LibraryMetrics object, or None if the library is not instrumented
+    """
+    return type(library).__dict__.get("_instrumented_metrics")
+
+
+class SamplingProfiler:
+    """
+    A statistical profiler that samples the stacks of the other threads at a fixed interval from a background
+    thread.
+
+    A sample is kept only when a thread is inside Library.py, and only the frames from the outermost Library.py
+    frame inward are kept, so samples show where time inside the library goes rather than in its callers. Stacks are
+    counted in the collapsed format flame graph tools read: function names joined by ";" from outermost to innermost.
+    Sampling only looks at the threads' frames, so the profiled code runs unchanged, but each sample holds the GIL
+    for as long as it takes to walk the stacks.
+    """
+
+    def __init__(self, interval=0.001, path_filter=None):
+        """
+        :param interval: seconds between samples
+        :param path_filter: only frames from files whose path ends with this are kept, Library.py's path if None
+        """
+        self._interval = interval
+        self._path_filter = os.path.abspath(sys.modules[Library.__module__].__file__) if path_filter is None \
+            else path_filter
+        self._stacks = {}  # collapsed stack -> samples
+        self._samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        starts sampling in a background thread
+        :return: None
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        stops sampling and waits for the background thread to finish
+        :return: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        """
+        takes samples until stopped
+        :return: None
+        """
+        own_id = threading.get_ident()
+        while not self._stop.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.sample(frame)
+
+    def sample(self, frame):
+        """
+        counts the stack of one frame, if it is inside the filtered file
+        :param frame: the innermost frame of a thread
+        :return: None
+        """
+        names = []
+        inside = []  # length of names at each frame from the filtered file
+        while frame is not None:
+            code = frame.f_code
+            names.append(code.co_name)
+            if code.co_filename.endswith(self._path_filter):
+                inside.append(len(names))
+            frame = frame.f_back
+        if inside:
+            key = ";".join(reversed(names[:inside[-1]]))
+            self._stacks[key] = self._stacks.get(key, 0) + 1
+            self._samples += 1
+
+    def get_samples(self):
+        """
+        returns how many samples were kept
+        :return: an integer
+        """
+        return self._samples
+
+    def get_stacks(self):
+        """
+        returns the sampled stacks
+        :return: a dictionary of collapsed stack to the number of samples taken in it
+        """
+        return dict(self._stacks)
+
+    def get_method_samples(self):
+        """
+        totals the samples by the outermost Library.py function they were taken in, such as check_out_library_item
+        :return: a dictionary of function name to samples
+        """
+        totals = {}
+        for stack, count in self._stacks.items():
+            method = stack.split(";", 1)[0]
+            totals[method] = totals.get(method, 0) + count
+        return totals
+
+    def to_collapsed(self):
+        """
+        exports the samples in the collapsed stack format, one "stack count" line per stack, busiest first
+        :return: a string
+        """
+        return "".join("%s %d\n" % (stack, count)
+                       for stack, count in sorted(self._stacks.items(), key=lambda pair: -pair[1]))
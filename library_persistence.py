@@ -0,0 +1,657 @@
+# Description: Saving and loading Library state. A snapshot is a compact binary file written as a stream, and loaded
+# through a memory map so library items are only built when they are first looked up. Changes made between snapshots
+# are kept in a write-ahead log that is replayed on top of the last snapshot to recover after a crash.
+
+import copy
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from Library import *
+
+SNAPSHOT_MAGIC = b"LIBSNAP3"
+
+# Snapshot layout, all integers little-endian:
+# * header: magic, current_date, patron count, item count, sequence number of the last log record in the snapshot
+# * one record per patron: id, name, patron class, fine in cents as of current_date
+# * one record per item: type code, location code, date checked out (-1 for None), row of the patron it is checked
+#   out by (-1 for None), number of holds, then id, title and creator, then the rows of the patrons in its hold queue
+# * an open-addressing hash table of item record offsets keyed by the crc32 of the item id (-1 for an empty slot)
+# * the offsets of the items that are checked out or have holds, these are built when the snapshot is loaded
+# * footer: offset and size of the hash table, offset and count of the active item offsets
+_HEADER = struct.Struct("<8sqqqq")
+_FINE = struct.Struct("<q")
+_ITEM = struct.Struct("<bbiqI")
+_LENGTH = struct.Struct("<I")
+_OFFSET = struct.Struct("<q")
+_FOOTER = struct.Struct("<qqqq")
+
+
+def _write_string(snapshot, string):
+    """
+    writes a length-prefixed UTF-8 string
+    :param snapshot: file object open for binary writing
+    :param string: the string to write
+    :return: None
+    """
+    encoded = string.encode()
+    snapshot.write(_LENGTH.pack(len(encoded)))
+    snapshot.write(encoded)
+
+
+def _write_offsets(snapshot, offsets):
+    """
+    writes an array of offsets or patron rows as little-endian 64-bit integers
+    :param snapshot: file object open for binary writing
+    :param offsets: an array("q")
+    :return: None
+    """
+    if sys.byteorder != "little":
+        offsets = array("q", offsets)
+        offsets.byteswap()
+    offsets.tofile(snapshot)
+
+
+def save_snapshot(library, path, log_sequence=0):
+    """
+    Writes the full state of a library to a snapshot file: the current date, the patrons and their fines, and every
+    library item with its location, loan and request. Records are streamed to the file one at a time, so only the item
+    offsets are held in memory while saving. Ids, titles, names and creators must be strings.
+    :param library: the Library object to save
+    :param path: path of the snapshot file, overwritten if it exists
+    :param log_sequence: sequence number of the last write-ahead log record the library's state includes
+    :return: None
+    """
+    patron_rows = {}
+    item_offsets = array("q")
+    item_hashes = array("L")
+    active_offsets = array("q")
+    with open(path, "wb") as snapshot:
+        snapshot.write(_HEADER.pack(SNAPSHOT_MAGIC, 0, 0, 0, 0))
+        for patron in library.get_patrons():
+            patron_rows[patron] = len(patron_rows)
+            _write_string(snapshot, patron.get_patron_id())
+            _write_string(snapshot, patron.get_name())
+            _write_string(snapshot, patron.get_patron_class())
+            snapshot.write(_FINE.pack(round(patron.get_fine_amount() * 100)))
+
+        for library_item in library.get_library_items():
+            offset = snapshot.tell()
+            date_checked_out = library_item.get_date_checked_out()
+            checked_out_by = library_item.get_checked_out_by()
+            hold_queue = library_item.get_hold_queue()
+            hold_rows = array("q") if hold_queue is None else array("q", (patron_rows[patron] for patron in hold_queue))
+            snapshot.write(_ITEM.pack(ITEM_TYPES.index(get_item_type(library_item)),
+                                      library_item.get_location_code(),
+                                      -1 if date_checked_out is None else date_checked_out,
+                                      -1 if checked_out_by is None else patron_rows[checked_out_by],
+                                      len(hold_rows)))
+            library_item_id = library_item.get_library_item_id()
+            _write_string(snapshot, library_item_id)
+            _write_string(snapshot, library_item.get_title())
+            _write_string(snapshot, library_item.get_creator())
+            _write_offsets(snapshot, hold_rows)
+            item_offsets.append(offset)
+            item_hashes.append(zlib.crc32(library_item_id.encode()))
+            if checked_out_by is not None or hold_rows:
+                active_offsets.append(offset)
+
+        table_size = 1
+        while table_size < 2 * len(item_offsets):
+            table_size *= 2
+        table = array("q", [-1]) * table_size
+        for offset, item_hash in zip(item_offsets, item_hashes):
+            slot = item_hash & (table_size - 1)
+            while table[slot] != -1:
+                slot = (slot + 1) & (table_size - 1)
+            table[slot] = offset
+        table_offset = snapshot.tell()
+        _write_offsets(snapshot, table)
+        active_offset = snapshot.tell()
+        _write_offsets(snapshot, active_offsets)
+        snapshot.write(_FOOTER.pack(table_offset, table_size, active_offset, len(active_offsets)))
+
+        snapshot.seek(0)
+        snapshot.write(_HEADER.pack(SNAPSHOT_MAGIC, library.get_current_date(), len(patron_rows), len(item_offsets),
+                                    log_sequence))
+
+
+class SnapshotItems:
+    """
+    The library items of a snapshot file, read through a memory map. An item is built from its record the first time it
+    is looked up and kept from then on, so changes made through the Library are kept too. Iterating over the items
+    builds those not looked up yet for the iteration only, so saving or scanning the library does not keep the whole
+    catalog; change an item through Library.lookup_library_item_from_id. Used as the item store of the Library
+    returned by load_snapshot.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._current_date, patron_count, self._item_count, self._log_sequence = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != SNAPSHOT_MAGIC:
+            self.close()
+            raise ValueError("not a library snapshot: " + str(path))
+        self._table_offset, self._table_size, self._active_offset, self._active_count = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size)
+        self._patrons = []
+        offset = _HEADER.size
+        for row in range(patron_count):
+            patron_id, offset = self._read_string(offset)
+            name, offset = self._read_string(offset)
+            patron_class, offset = self._read_string(offset)
+            patron = Patron(patron_id, name, patron_class)
+            patron.amend_fine(_FINE.unpack_from(self._map, offset)[0] / 100)
+            offset += _FINE.size
+            self._patrons.append(patron)
+        self._items_offset = offset
+        self._items = {}  # library_item_id -> item built so far
+
+    def __len__(self):
+        return self._item_count
+
+    def __iter__(self):
+        offset = self._items_offset
+        for row in range(self._item_count):
+            library_item_id, end = self._read_string(offset + _ITEM.size)
+            library_item = self._items.get(library_item_id)
+            yield self._read_item(offset) if library_item is None else library_item
+            for field in range(2):  # skip the title and creator
+                end += _LENGTH.unpack_from(self._map, end)[0] + _LENGTH.size
+            offset = end + _ITEM.unpack_from(self._map, offset)[4] * _OFFSET.size  # skip the hold queue
+
+    def get_rows(self, start=0):
+        """
+        returns the items from a row on as rows read from their records, for indexing without building the items. An
+        item that was already built reports its current location, the others the location they were saved in.
+        :param start: the first row
+        :return: an iterator of (library_item_id, type_code, location_code, title, creator) tuples
+        """
+        offset = self._items_offset
+        for row in range(self._item_count):
+            type_code, location_code, date_checked_out, checked_out_by, hold_count = _ITEM.unpack_from(self._map, offset)
+            end = offset + _ITEM.size
+            if row < start:
+                for field in range(3):  # skip the id, title and creator
+                    end += _LENGTH.unpack_from(self._map, end)[0] + _LENGTH.size
+            else:
+                library_item_id, end = self._read_string(end)
+                title, end = self._read_string(end)
+                creator, end = self._read_string(end)
+                library_item = self._items.get(library_item_id)
+                if library_item is not None:
+                    location_code = library_item.get_location_code()
+                yield library_item_id, type_code, location_code, title, creator
+            offset = end + hold_count * _OFFSET.size
+
+    def close(self):
+        """
+        closes the memory map and the snapshot file, items that were not looked up can no longer be read. The items of
+        a fork leave them open for the items they were forked from.
+        :return: None
+        """
+        if self._file is not None:
+            self._map.close()
+            self._file.close()
+
+    def fork(self):
+        """
+        returns the items of the same snapshot for a forked Library (see Library.fork), reading through the same memory
+        map but building items of their own. A fork only builds the items this one had not built when it was forked,
+        which are as they were saved and idle, so its items are not linked to patrons. It can be read while this one
+        is open.
+        :return: a SnapshotItems object
+        """
+        snapshot_items = copy.copy(self)
+        snapshot_items._file = None
+        snapshot_items._patrons = None
+        snapshot_items._items = {}
+        return snapshot_items
+
+    def get_built_items(self):
+        """
+        returns the items built so far, which may have changed since they were saved
+        :return: a list of LibraryItem objects
+        """
+        return list(self._items.values())
+
+    def get_current_date(self):
+        """
+        returns the current date of the library when the snapshot was saved
+        :return: an integer
+        """
+        return self._current_date
+
+    def get_log_sequence(self):
+        """
+        returns the sequence number of the last write-ahead log record included in the snapshot
+        :return: an integer, 0 if the snapshot was not taken from a logged library
+        """
+        return self._log_sequence
+
+    def get_patrons(self):
+        """
+        returns the patrons of the snapshot, with their fines as of the snapshot's current date
+        :return: a list of Patron objects
+        """
+        return self._patrons
+
+    def get_active_items(self):
+        """
+        builds and returns the items that were checked out or had holds when the snapshot was saved
+        :return: a list of LibraryItem objects
+        """
+        active_items = []
+        for row in range(self._active_count):
+            offset = _OFFSET.unpack_from(self._map, self._active_offset + row * _OFFSET.size)[0]
+            library_item_id = self._read_string(offset + _ITEM.size)[0]
+            library_item = self._items.get(library_item_id)
+            if library_item is None:
+                library_item = self._items[library_item_id] = self._read_item(offset)
+            active_items.append(library_item)
+        return active_items
+
+    def get(self, library_item_id):
+        """
+        returns the item with a matching id, building it from its record on the first lookup
+        :param library_item_id: the id of the desired item
+        :return: the LibraryItem object, or None if no such item is in the snapshot
+        """
+        library_item = self._items.get(library_item_id)
+        if library_item is None and isinstance(library_item_id, str):
+            offset = self._find(library_item_id)
+            if offset != -1:
+                library_item = self._items[library_item_id] = self._read_item(offset)
+        return library_item
+
+    def _find(self, library_item_id):
+        """
+        probes the hash table for the record of an item
+        :param library_item_id: the id of the desired item, a string
+        :return: the offset of the item's record, or -1 if it is not in the snapshot
+        """
+        key = library_item_id.encode()
+        mask = self._table_size - 1
+        slot = zlib.crc32(key) & mask
+        while True:
+            offset = _OFFSET.unpack_from(self._map, self._table_offset + slot * _OFFSET.size)[0]
+            if offset == -1:
+                return -1
+            start = offset + _ITEM.size + _LENGTH.size
+            length = _LENGTH.unpack_from(self._map, offset + _ITEM.size)[0]
+            if self._map[start:start + length] == key:
+                return offset
+            slot = (slot + 1) & mask
+
+    def _read_string(self, offset):
+        """
+        reads a length-prefixed UTF-8 string
+        :param offset: offset of the length prefix
+        :return: the string and the offset just past it
+        """
+        length = _LENGTH.unpack_from(self._map, offset)[0]
+        start = offset + _LENGTH.size
+        return self._map[start:start + length].decode(), start + length
+
+    def _read_item(self, offset):
+        """
+        builds a library item from its record
+        :param offset: offset of the item's record
+        :return: a Book, Album or Movie object
+        """
+        type_code, location_code, date_checked_out, checked_out_by, hold_count = _ITEM.unpack_from(self._map, offset)
+        library_item_id, offset = self._read_string(offset + _ITEM.size)
+        title, offset = self._read_string(offset)
+        creator, offset = self._read_string(offset)
+        library_item = ITEM_TYPES[type_code](library_item_id, title, creator)
+        library_item.set_location(LOCATIONS[location_code])
+        if date_checked_out != -1:
+            library_item.set_date_checked_out(date_checked_out)
+        if self._patrons is None:  # a fork's items are idle, see fork
+            return library_item
+        if checked_out_by != -1:
+            library_item.set_checked_out_by(self._patrons[checked_out_by])
+        for hold in range(hold_count):
+            patron = self._patrons[_OFFSET.unpack_from(self._map, offset + hold * _OFFSET.size)[0]]
+            patron.add_hold(library_item, library_item.add_hold(patron))
+        return library_item
+
+
+def load_snapshot(path, snapshot_items=None, loan_policy=None):
+    """
+    Loads a library from a snapshot file. Patrons and the items that are checked out or have holds are built right
+    away; every other item is built the first time it is looked up. The snapshot file stays open while the library is
+    in use. The loan policy is not saved in the snapshot, the loans are restored on the terms of the policy passed.
+    :param path: path of the snapshot file
+    :param snapshot_items: the SnapshotItems of the file if it was already opened, None to open it
+    :param loan_policy: the LoanPolicy the library lends by, None for the default rules
+    :return: a Library object in the state it was saved in
+    """
+    if snapshot_items is None:
+        snapshot_items = SnapshotItems(path)
+    library = Library(snapshot_items)
+    if loan_policy is not None:
+        library.set_loan_policy(loan_policy)
+    library.advance_date(snapshot_items.get_current_date())
+    for patron in snapshot_items.get_patrons():
+        library.add_patron(patron)
+    for library_item in snapshot_items.get_active_items():
+        if library_item.get_location() == "CHECKED_OUT":
+            library.restore_loan(library_item)
+    return library
+
+
+LOG_MAGIC = b"LIBWAL01"
+
+# Write-ahead log layout, all integers little-endian:
+# * header: magic, sequence number of the first record
+# * one record per logged call: operation code, payload length, crc32 of the payload, then the payload. Strings are
+#   length-prefixed UTF-8 with a length of 0xFFFFFFFF for None. A record that is cut short or fails its checksum marks
+#   the end of the log, it was being written when the process stopped.
+_LOG_HEADER = struct.Struct("<8sq")
+_RECORD = struct.Struct("<BII")
+_ITEM_TYPE = struct.Struct("<b")
+_AMOUNT = struct.Struct("<d")
+_DAYS = struct.Struct("<q")
+_COUNT = struct.Struct("<I")
+_NONE_LENGTH = 0xFFFFFFFF
+
+LOG_OPERATIONS = ("add_library_item", "add_patron", "check_out_library_item", "return_library_item",
+                  "request_library_item", "process_batch", "pay_fine", "advance_date", "cancel_request")
+LOG_OPERATION_CODES = {operation: code for code, operation in enumerate(LOG_OPERATIONS)}
+
+
+def _pack_string(string):
+    """
+    encodes a length-prefixed UTF-8 string, or None
+    :param string: a string or None
+    :return: bytes
+    """
+    if string is None:
+        return _LENGTH.pack(_NONE_LENGTH)
+    encoded = string.encode()
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(payload, offset):
+    """
+    decodes a length-prefixed UTF-8 string, or None
+    :param payload: the bytes holding the string
+    :param offset: offset of the length prefix
+    :return: the string (or None) and the offset just past it
+    """
+    length = _LENGTH.unpack_from(payload, offset)[0]
+    offset += _LENGTH.size
+    if length == _NONE_LENGTH:
+        return None, offset
+    return payload[offset:offset + length].decode(), offset + length
+
+
+def _pack_call(operation, args):
+    """
+    encodes the arguments of a logged Library call
+    :param operation: name of the Library method, one of LOG_OPERATIONS
+    :param args: the arguments it was called with
+    :return: the payload bytes
+    """
+    if operation == "add_library_item":
+        library_item = args[0]
+        return b"".join((_ITEM_TYPE.pack(ITEM_TYPES.index(get_item_type(library_item))),
+                         _pack_string(library_item.get_library_item_id()), _pack_string(library_item.get_title()),
+                         _pack_string(library_item.get_creator())))
+    elif operation == "add_patron":
+        return b"".join(_pack_string(field) for field in (args[0].get_patron_id(), args[0].get_name(),
+                                                          args[0].get_patron_class()))
+    elif operation == "pay_fine":
+        return _pack_string(args[0]) + _AMOUNT.pack(args[1])
+    elif operation == "advance_date":
+        return _DAYS.pack(args[0])
+    elif operation == "process_batch":
+        parts = [_COUNT.pack(len(args[0]))]
+        for transaction in args[0]:
+            parts.extend(_pack_string(field) for field in transaction)
+        return b"".join(parts)
+    else:  # check-out, return, request and cancel take only ids
+        return b"".join(_pack_string(library_id) for library_id in args)
+
+
+def _unpack_call(operation, payload):
+    """
+    decodes the arguments of a logged Library call
+    :param operation: name of the Library method, one of LOG_OPERATIONS
+    :param payload: the payload bytes
+    :return: a tuple of arguments to call the method with
+    """
+    if operation == "add_library_item":
+        library_item_id, offset = _unpack_string(payload, _ITEM_TYPE.size)
+        title, offset = _unpack_string(payload, offset)
+        creator = _unpack_string(payload, offset)[0]
+        return (ITEM_TYPES[_ITEM_TYPE.unpack_from(payload, 0)[0]](library_item_id, title, creator),)
+    elif operation == "add_patron":
+        patron_id, offset = _unpack_string(payload, 0)
+        name, offset = _unpack_string(payload, offset)
+        if offset == len(payload):  # logged before patrons had classes
+            return (Patron(patron_id, name),)
+        return (Patron(patron_id, name, _unpack_string(payload, offset)[0]),)
+    elif operation == "pay_fine":
+        patron_id, offset = _unpack_string(payload, 0)
+        return patron_id, _AMOUNT.unpack_from(payload, offset)[0]
+    elif operation == "advance_date":
+        return _DAYS.unpack_from(payload, 0)
+    elif operation == "process_batch":
+        transactions = []
+        offset = _COUNT.size
+        for row in range(_COUNT.unpack_from(payload, 0)[0]):
+            batch_operation, offset = _unpack_string(payload, offset)
+            patron_id, offset = _unpack_string(payload, offset)
+            library_item_id, offset = _unpack_string(payload, offset)
+            transactions.append((batch_operation, patron_id, library_item_id))
+        return (transactions,)
+    else:
+        args = []
+        offset = 0
+        while offset < len(payload):
+            library_id, offset = _unpack_string(payload, offset)
+            args.append(library_id)
+        return tuple(args)
+
+
+def read_log(path):
+    """
+    Reads the records of a write-ahead log, stopping at the first record that is cut short or fails its checksum.
+    :param path: path of the log file
+    :return: the sequence number of the first record, a list of (operation, payload) pairs, and the length of the
+    file up to the end of the last good record
+    """
+    with open(path, "rb") as log_file:
+        data = log_file.read()
+    if len(data) < _LOG_HEADER.size:
+        return 1, [], 0
+    magic, first_sequence = _LOG_HEADER.unpack_from(data, 0)
+    if magic != LOG_MAGIC:
+        raise ValueError("not a library transaction log: " + str(path))
+    records = []
+    offset = _LOG_HEADER.size
+    while offset + _RECORD.size <= len(data):
+        operation_code, length, checksum = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum or operation_code >= len(LOG_OPERATIONS):
+            break
+        records.append((LOG_OPERATIONS[operation_code], payload))
+        offset = start + length
+    return first_sequence, records, offset
+
+
+def replay_log(library, path, after_sequence=0):
+    """
+    Applies the records of a write-ahead log to a library. Records up to and including after_sequence are skipped,
+    they are already part of the snapshot the library was loaded from. Runs of check-out, return and request records
+    are applied together through Library.process_batch.
+    :param library: the Library object, it should not have a transaction log set while replaying
+    :param path: path of the log file
+    :param after_sequence: sequence number of the last record already applied
+    :return: the sequence number of the last record in the log
+    """
+    first_sequence, records, length = read_log(path)
+    batch_operations = {"check_out_library_item": "check_out", "return_library_item": "return",
+                        "request_library_item": "request"}
+    batch = []
+    for operation, payload in records[max(after_sequence - first_sequence + 1, 0):]:
+        args = _unpack_call(operation, payload)
+        if operation in batch_operations:
+            if operation == "return_library_item":
+                batch.append(("return", None, args[0]))
+            else:
+                batch.append((batch_operations[operation], args[0], args[1]))
+            continue
+        if batch:
+            library.process_batch(batch)
+            batch = []
+        getattr(library, operation)(*args)
+    if batch:
+        library.process_batch(batch)
+    return first_sequence + len(records) - 1
+
+
+class WriteAheadLog:
+    """
+    An append-only log of the calls that change a Library, set on the library with Library.set_transaction_log.
+
+    Records are buffered and written as a group once group_size records are waiting (group commit), and the file is
+    fsynced after each group write when fsync is True. Records still in the buffer when the process stops are lost, so
+    group_size trades durability for throughput; commit() writes the buffer right away. Opening an existing log
+    drops a torn record at its end and continues its sequence numbers. compact() checkpoints the library to a snapshot
+    and starts the log over, so the file does not grow forever. Recording is thread safe, for ConcurrentLibrary.
+    """
+
+    def __init__(self, path, group_size=1, fsync=True):
+        self._path = path
+        self._group_size = group_size
+        self._fsync = fsync
+        self._pending = []
+        self._lock = threading.Lock()
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            first_sequence, records, length = read_log(path)
+            self._file = open(path, "r+b")
+            self._file.truncate(length)
+            self._file.seek(length)
+            self._next_sequence = first_sequence + len(records)
+        else:
+            self._file = open(path, "wb")
+            self._start(1)
+
+    def _start(self, first_sequence):
+        """
+        empties the log file and writes its header
+        :param first_sequence: sequence number the next record will get
+        :return: None
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(_LOG_HEADER.pack(LOG_MAGIC, first_sequence))
+        self._next_sequence = first_sequence
+        self._sync()
+
+    def _sync(self):
+        """
+        flushes the file, and fsyncs it if the log was opened with fsync
+        :return: None
+        """
+        self._file.flush()
+        if self._fsync:
+            os.fsync(self._file.fileno())
+
+    def get_last_sequence(self):
+        """
+        returns the sequence number of the last record in the log, including records not yet written
+        :return: an integer
+        """
+        return self._next_sequence - 1
+
+    def record(self, operation, *args):
+        """
+        appends a record of a Library call, called by the Library before it applies the call
+        :param operation: name of the Library method, one of LOG_OPERATIONS
+        :param args: the arguments it was called with
+        :return: None
+        """
+        payload = _pack_call(operation, args)
+        with self._lock:
+            self._pending.append(_RECORD.pack(LOG_OPERATION_CODES[operation], len(payload), zlib.crc32(payload)))
+            self._pending.append(payload)
+            self._next_sequence += 1
+            if len(self._pending) >= 2 * self._group_size:
+                self._write_pending()
+
+    def commit(self):
+        """
+        writes every buffered record to the log file as one group
+        :return: None
+        """
+        with self._lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        """
+        writes the buffered records, called with the lock held
+        :return: None
+        """
+        if self._pending:
+            self._file.write(b"".join(self._pending))
+            self._pending = []
+            self._sync()
+
+    def compact(self, library, snapshot_path):
+        """
+        Checkpoints a library: saves a snapshot of it that includes every record logged so far, then empties the log.
+        The snapshot is written beside snapshot_path and moved over it once complete, so a crash part way through
+        leaves the previous snapshot and the full log in place.
+        :param library: the Library object this log records
+        :param snapshot_path: path of the snapshot file
+        :return: None
+        """
+        self.commit()
+        temporary_path = snapshot_path + ".tmp"
+        save_snapshot(library, temporary_path, self.get_last_sequence())
+        os.replace(temporary_path, snapshot_path)
+        self._start(self._next_sequence)
+
+    def close(self):
+        """
+        writes any buffered records and closes the log file
+        :return: None
+        """
+        self.commit()
+        self._file.close()
+
+
+def recover(snapshot_path, log_path, group_size=1, fsync=True, loan_policy=None):
+    """
+    Rebuilds a library after a restart or crash: loads the last snapshot (or starts from an empty library if there is
+    none), replays the log records made after it, and sets the log on the library so further changes are recorded.
+    The loan policy is not logged, pass the one the library lent by so replayed check-outs get the same terms.
+    :param snapshot_path: path of the snapshot file written by WriteAheadLog.compact
+    :param log_path: path of the write-ahead log file
+    :param group_size: records per group commit for the reopened log
+    :param fsync: whether the reopened log fsyncs after each group
+    :param loan_policy: the LoanPolicy the library lends by, None for the default rules
+    :return: the recovered Library object
+    """
+    if os.path.exists(snapshot_path):
+        snapshot_items = SnapshotItems(snapshot_path)
+        library = load_snapshot(snapshot_path, snapshot_items, loan_policy)
+        after_sequence = snapshot_items.get_log_sequence()
+    else:
+        library = Library()
+        if loan_policy is not None:
+            library.set_loan_policy(loan_policy)
+        after_sequence = 0
+    transaction_log = WriteAheadLog(log_path, group_size, fsync)
+    replay_log(library, log_path, after_sequence)
+    library.set_transaction_log(transaction_log)
+    return library
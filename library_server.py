@@ -0,0 +1,567 @@
+# Description: An asyncio server and client for Library transactions over a local TCP or Unix socket. Clients
+# pipeline requests on one connection, the server coalesces the requests of every connection into batches for the
+# Library, and a connection that sends faster than it reads its replies is paused.
+#
+# Every frame is a 4 byte little-endian length followed by that many bytes. A request is a request id and an
+# operation code (struct "<IB") followed by its arguments: strings are a 2 byte length and UTF-8, payments are
+# integer cents ("<q"). A reply is the request id, a SERVER_RESULTS code and an integer value ("<IBq"), the value
+# being the fine in cents, the hold position or the location code for the queries and 0 otherwise.
+
+import argparse
+import asyncio
+import struct
+from array import array
+from Library import *
+from library_persistence import recover
+
+SERVER_OPERATIONS = ("check_out", "return", "request", "cancel_request", "get_hold_position", "pay_fine",
+                     "get_fine_amount", "get_location")
+SERVER_OPERATION_CODES = {operation: code for code, operation in enumerate(SERVER_OPERATIONS)}
+
+# the arguments of each operation, "s" for a string and "q" for an amount in cents
+_ARGUMENTS = {"check_out": "ss", "return": "s", "request": "ss", "cancel_request": "ss", "get_hold_position": "ss",
+              "pay_fine": "sq", "get_fine_amount": "s", "get_location": "s"}
+
+# results a reply may carry: the process_batch results, then the results of the other operations
+SERVER_RESULTS = RESULTS + ("request cancelled", "no request found", "payment successful", "ok", "server error")
+SERVER_RESULT_CODES = {result: code for code, result in enumerate(SERVER_RESULTS)}
+
+MAX_FRAME_SIZE = 65536  # longest request a server accepts, a longer one closes the connection
+
+_FRAME_LENGTH = struct.Struct("<I")
+_REQUEST_HEADER = struct.Struct("<IB")
+_STRING_LENGTH = struct.Struct("<H")
+_CENTS = struct.Struct("<q")
+_REPLY = struct.Struct("<IIBq")  # frame length, then the reply
+_REPLY_PAYLOAD = struct.Struct("<IBq")
+
+
+def encode_request(request_id, operation, arguments):
+    """
+    encodes a request frame
+    :param request_id: an integer the reply will carry, unique among the connection's pending requests
+    :param operation: a name in SERVER_OPERATIONS
+    :param arguments: the operation's arguments, strings and integer cents as in _ARGUMENTS
+    :return: bytes
+    """
+    parts = [_REQUEST_HEADER.pack(request_id, SERVER_OPERATION_CODES[operation])]
+    for kind, argument in zip(_ARGUMENTS[operation], arguments):
+        if kind == "s":
+            encoded = argument.encode()
+            parts.append(_STRING_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        else:
+            parts.append(_CENTS.pack(argument))
+    payload = b"".join(parts)
+    return _FRAME_LENGTH.pack(len(payload)) + payload
+
+
+def decode_request(payload):
+    """
+    decodes the payload of a request frame
+    :param payload: the bytes after the frame length
+    :return: the request id, the operation (None if the code is unknown) and a list of its arguments
+    """
+    request_id, code = _REQUEST_HEADER.unpack_from(payload, 0)
+    if code >= len(SERVER_OPERATIONS):
+        return request_id, None, []
+    operation = SERVER_OPERATIONS[code]
+    offset = _REQUEST_HEADER.size
+    arguments = []
+    for kind in _ARGUMENTS[operation]:
+        if kind == "s":
+            length = _STRING_LENGTH.unpack_from(payload, offset)[0]
+            offset += _STRING_LENGTH.size
+            arguments.append(payload[offset:offset + length].decode())
+            offset += length
+        else:
+            arguments.append(_CENTS.unpack_from(payload, offset)[0])
+            offset += _CENTS.size
+    return request_id, operation, arguments
+
+
+def _split_frames(buffer, limit=None):
+    """
+    takes the complete frames off the front of a buffer
+    :param buffer: a bytearray of received bytes, the frames taken are removed from it
+    :param limit: the most frames to take, every complete frame if None
+    :return: a list of frame payloads, or None if a frame is longer than MAX_FRAME_SIZE
+    """
+    payloads = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= _FRAME_LENGTH.size and (limit is None or len(payloads) < limit):
+        length = _FRAME_LENGTH.unpack_from(buffer, offset)[0]
+        if length > MAX_FRAME_SIZE:
+            return None
+        if end - offset - _FRAME_LENGTH.size < length:
+            break
+        offset += _FRAME_LENGTH.size
+        payloads.append(bytes(buffer[offset:offset + length]))
+        offset += length
+    del buffer[:offset]
+    return payloads
+
+
+class _ServerConnection(asyncio.Protocol):
+    """
+    One client connection to a LibraryServer. Complete requests are decoded and handed to the server as they arrive,
+    and a request that cannot be decoded closes the connection. At most max_pipelined requests are handed over
+    before their replies are sent, and none while the transport's write buffer is full; the rest wait in the receive
+    buffer and reading is paused, so a client cannot queue unbounded work or replies.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+        self._buffer = bytearray()
+        self._pending = 0  # requests handed to the server and not yet replied to
+        self._writing_paused = False
+        self._reading_paused = False
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._server._connections.add(self)
+
+    def connection_lost(self, exc):
+        self._server._connections.discard(self)
+        self._transport = None
+
+    def data_received(self, data):
+        self._buffer += data
+        self._take_requests()
+
+    def pause_writing(self):
+        self._writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._take_requests()
+
+    def replied(self, reply_count, replies):
+        """
+        sends the replies made for this connection in one batch
+        :param reply_count: number of replies
+        :param replies: the encoded reply frames, joined
+        :return: None
+        """
+        self._pending -= reply_count
+        if self._transport is not None:
+            self._transport.write(replies)
+            self._take_requests()
+
+    def _take_requests(self):
+        """
+        hands the server as many buffered requests as the pipeline has room for, then pauses or resumes reading
+        :return: None
+        """
+        if self._transport is None:
+            return
+        room = self._server._max_pipelined - self._pending
+        if room > 0 and not self._writing_paused:
+            payloads = _split_frames(self._buffer, room)
+            if payloads is None:
+                self._transport.close()
+                return
+            for payload in payloads:
+                try:
+                    request = decode_request(payload)
+                except (struct.error, UnicodeDecodeError):
+                    self._transport.close()
+                    return
+                self._pending += 1
+                self._server._submit(self, request)
+        self._update_reading()
+
+    def _update_reading(self):
+        """
+        pauses reading while the pipeline is full or the write buffer is, and resumes it otherwise
+        :return: None
+        """
+        should_pause = self._writing_paused or self._pending >= self._server._max_pipelined
+        if should_pause and not self._reading_paused:
+            self._transport.pause_reading()
+            self._reading_paused = True
+        elif not should_pause and self._reading_paused:
+            self._transport.resume_reading()
+            self._reading_paused = False
+
+
+class LibraryServer:
+    """
+    Serves a Library to many connections from one event loop.
+
+    Requests from every connection are collected as they are read, and once the event loop has handled the reads that
+    were ready, the collected requests are applied in arrival order as one batch: runs of check-outs, returns and
+    requests go through process_batch, and the other operations are called one at a time. If the library has a
+    transaction log, it is committed once per batch before any reply is sent, so a reply is only seen once its
+    transaction is durable; if the commit fails, every request of the batch is answered "server error". Replies to each
+    connection are written together after the batch.
+
+    The Library is only called from the event loop, so it need not be a ConcurrentLibrary.
+    """
+
+    def __init__(self, library, max_pipelined=64):
+        """
+        :param library: the Library to serve
+        :param max_pipelined: requests a connection may have waiting for replies before reading from it is paused
+        """
+        self._library = library
+        self._max_pipelined = max_pipelined
+        self._servers = []
+        self._connections = set()
+        self._requests = []  # (connection, decoded request) read since the last batch
+        self._batch_scheduled = False
+        self._batch_count = 0
+        self._request_count = 0
+
+    async def start(self, host="127.0.0.1", port=0, backlog=4096):
+        """
+        starts listening on a TCP socket
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        :param backlog: connections the socket may queue before they are accepted
+        :return: the (host, port) the server listens on
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: _ServerConnection(self), host, port, backlog=backlog)
+        self._servers.append(server)
+        return server.sockets[0].getsockname()[:2]
+
+    async def start_unix(self, path, backlog=4096):
+        """
+        starts listening on a Unix socket
+        :param path: path of the socket
+        :param backlog: connections the socket may queue before they are accepted
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        self._servers.append(await loop.create_unix_server(lambda: _ServerConnection(self), path, backlog=backlog))
+
+    async def close(self):
+        """
+        stops listening and closes every connection
+        :return: None
+        """
+        for server in self._servers:
+            server.close()
+        for connection in list(self._connections):
+            if connection._transport is not None:
+                connection._transport.close()
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+
+    def get_connection_count(self):
+        """
+        returns the number of open connections
+        :return: an integer
+        """
+        return len(self._connections)
+
+    def get_stats(self):
+        """
+        returns how many batches and requests the server has applied
+        :return: a dictionary with "batches" and "requests"
+        """
+        return {"batches": self._batch_count, "requests": self._request_count}
+
+    def _submit(self, connection, request):
+        """
+        adds a request to the next batch, scheduling the batch if none is
+        :param connection: the _ServerConnection the request came from
+        :param request: the request id, operation and arguments from decode_request
+        :return: None
+        """
+        self._requests.append((connection, request))
+        if not self._batch_scheduled:
+            self._batch_scheduled = True
+            asyncio.get_running_loop().call_soon(self._apply_batch)
+
+    def _apply_batch(self):
+        """
+        applies every request collected since the last batch and replies to them
+        :return: None
+        """
+        requests = self._requests
+        self._requests = []
+        self._batch_scheduled = False
+        self._batch_count += 1
+        self._request_count += len(requests)
+        results = [None] * len(requests)  # (result code, value) per request
+        decoded = [request for connection, request in requests]
+        run = []  # positions of consecutive check-outs, returns and requests
+        for position, (request_id, operation, arguments) in enumerate(decoded):
+            if operation in ("check_out", "return", "request"):
+                run.append(position)
+                continue
+            if run:
+                self._apply_run(decoded, run, results)
+                run = []
+            try:
+                results[position] = self._apply_one(operation, arguments)
+            except Exception:
+                results[position] = (SERVER_RESULT_CODES["server error"], 0)
+        if run:
+            self._apply_run(decoded, run, results)
+        transaction_log = self._library.get_transaction_log()
+        if transaction_log is not None:
+            try:
+                transaction_log.commit()
+            except Exception:  # none of the batch is durable
+                results = [(SERVER_RESULT_CODES["server error"], 0)] * len(requests)
+        replies = {}
+        for (connection, (request_id, operation, arguments)), (code, value) in zip(requests, results):
+            frames = replies.get(connection)
+            if frames is None:
+                frames = replies[connection] = []
+            frames.append(_REPLY.pack(_REPLY.size - _FRAME_LENGTH.size, request_id, code, value))
+        for connection, frames in replies.items():
+            connection.replied(len(frames), b"".join(frames))
+
+    def _apply_run(self, decoded, run, results):
+        """
+        applies a run of check-outs, returns and requests through process_batch. If a transaction raises, the requests
+        applied before it keep their results and it and the requests after it, which are not applied, are given
+        "server error".
+        :param decoded: every decoded request of the batch
+        :param run: positions in decoded of the run's requests
+        :param results: the batch's results, filled in for the run
+        :return: None
+        """
+        transactions = []
+        for position in run:
+            request_id, operation, arguments = decoded[position]
+            if operation == "return":
+                transactions.append(("return", None, arguments[0]))
+            else:
+                transactions.append((operation, arguments[0], arguments[1]))
+        codes = array("b")
+        try:
+            self._library.process_batch(transactions, codes)
+        except Exception:
+            codes.extend([SERVER_RESULT_CODES["server error"]] * (len(run) - len(codes)))
+        for position, code in zip(run, codes):
+            results[position] = (code, 0)
+
+    def _apply_one(self, operation, arguments):
+        """
+        applies one request that is not a check-out, return or request
+        :param operation: a name in SERVER_OPERATIONS, or None for an unknown operation code
+        :param arguments: the operation's arguments
+        :return: the reply's result code and value
+        """
+        library = self._library
+        if operation == "cancel_request":
+            return SERVER_RESULT_CODES[library.cancel_request(*arguments)], 0
+        if operation == "pay_fine":
+            return SERVER_RESULT_CODES[library.pay_fine(arguments[0], arguments[1] / 100)], 0
+        if operation == "get_hold_position":
+            position = library.get_hold_position(*arguments)
+            return SERVER_RESULT_CODES["ok"], 0 if position is None else position
+        if operation == "get_fine_amount":
+            patron = library.lookup_patron_from_id(arguments[0])
+            if patron is None:
+                return SERVER_RESULT_CODES["patron not found"], 0
+            return SERVER_RESULT_CODES["ok"], round(patron.get_fine_amount() * 100)
+        if operation == "get_location":
+            library_item = library.lookup_library_item_from_id(arguments[0])
+            if library_item is None:
+                return SERVER_RESULT_CODES["item not found"], 0
+            return SERVER_RESULT_CODES["ok"], library_item.get_location_code()
+        return SERVER_RESULT_CODES["unknown operation"], 0
+
+
+class _ClientConnection(asyncio.Protocol):
+    """
+    The client end of a connection, matching replies to the futures of their requests
+    """
+
+    def __init__(self):
+        self._transport = None
+        self._buffer = bytearray()
+        self._waiting = {}  # request id -> future of the (result code, value) reply
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+        self._lost = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def connection_lost(self, exc):
+        self._lost = exc or ConnectionError("connection closed")
+        for future in self._waiting.values():
+            if not future.done():
+                future.set_exception(self._lost)
+        self._waiting.clear()
+        self._can_write.set()
+
+    def data_received(self, data):
+        self._buffer += data
+        for payload in _split_frames(self._buffer):
+            request_id, code, value = _REPLY_PAYLOAD.unpack_from(payload)
+            future = self._waiting.pop(request_id, None)
+            if future is not None and not future.done():
+                future.set_result((code, value))
+
+    def pause_writing(self):
+        self._can_write.clear()
+
+    def resume_writing(self):
+        self._can_write.set()
+
+
+class LibraryClient:
+    """
+    A connection to a LibraryServer. Its methods mirror Library's and may be awaited from many tasks at once; their
+    requests are pipelined on the one connection. Sending waits while the connection's write buffer is full.
+    """
+
+    def __init__(self, transport, connection):
+        """
+        use LibraryClient.connect to make a client
+        """
+        self._transport = transport
+        self._connection = connection
+        self._next_request_id = 0
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=None, path=None):
+        """
+        connects to a LibraryServer
+        :param host: the server's TCP address
+        :param port: the server's TCP port
+        :param path: path of the server's Unix socket, used instead of host and port if given
+        :return: the LibraryClient object
+        """
+        loop = asyncio.get_running_loop()
+        if path is not None:
+            transport, connection = await loop.create_unix_connection(_ClientConnection, path)
+        else:
+            transport, connection = await loop.create_connection(_ClientConnection, host, port)
+        return cls(transport, connection)
+
+    async def close(self):
+        """
+        closes the connection, requests still waiting fail with ConnectionError
+        :return: None
+        """
+        self._transport.close()
+
+    async def _call(self, operation, *arguments):
+        """
+        sends a request and waits for its reply
+        :param operation: a name in SERVER_OPERATIONS
+        :param arguments: the operation's arguments
+        :return: the reply's result string and value
+        """
+        connection = self._connection
+        if connection._lost is not None:
+            raise connection._lost
+        if not connection._can_write.is_set():
+            await connection._can_write.wait()
+        request_id = self._next_request_id
+        self._next_request_id = (request_id + 1) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        connection._waiting[request_id] = future
+        self._transport.write(encode_request(request_id, operation, arguments))
+        code, value = await future
+        return SERVER_RESULTS[code], value
+
+    async def check_out_library_item(self, patron_id, library_item_id):
+        """
+        see Library.check_out_library_item
+        :return: A string about the result of the check-out attempt
+        """
+        return (await self._call("check_out", patron_id, library_item_id))[0]
+
+    async def return_library_item(self, library_item_id):
+        """
+        see Library.return_library_item
+        :return: A string about the result of the return attempt
+        """
+        return (await self._call("return", library_item_id))[0]
+
+    async def request_library_item(self, patron_id, library_item_id):
+        """
+        see Library.request_library_item
+        :return: a string about the result of request
+        """
+        return (await self._call("request", patron_id, library_item_id))[0]
+
+    async def cancel_request(self, patron_id, library_item_id):
+        """
+        see Library.cancel_request
+        :return: a string about the result of the cancellation
+        """
+        return (await self._call("cancel_request", patron_id, library_item_id))[0]
+
+    async def get_hold_position(self, patron_id, library_item_id):
+        """
+        see Library.get_hold_position
+        :return: 1 for the front of the queue, or None if the patron is not waiting on the item
+        """
+        position = (await self._call("get_hold_position", patron_id, library_item_id))[1]
+        return None if position == 0 else position
+
+    async def pay_fine(self, patron_id, payment_amount):
+        """
+        see Library.pay_fine
+        :param payment_amount: the amount being paid, in dollars, sent rounded to the cent
+        :return: A string about the result of payment
+        """
+        return (await self._call("pay_fine", patron_id, round(payment_amount * 100)))[0]
+
+    async def get_fine_amount(self, patron_id):
+        """
+        returns the fine a patron owes
+        :param patron_id: id of the patron
+        :return: fine amount in dollars, or None if the patron is not a member
+        """
+        result, cents = await self._call("get_fine_amount", patron_id)
+        return None if result != "ok" else cents / 100
+
+    async def get_location(self, library_item_id):
+        """
+        returns the location of an item
+        :param library_item_id: id of the item
+        :return: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT", or None if the item is not in the holdings
+        """
+        result, location_code = await self._call("get_location", library_item_id)
+        return None if result != "ok" else LOCATIONS[location_code]
+
+
+async def serve(library, host="127.0.0.1", port=0, path=None):
+    """
+    serves a library until the task is cancelled
+    :param library: the Library to serve
+    :param host: TCP address to listen on
+    :param port: TCP port to listen on
+    :param path: path of a Unix socket to listen on instead of TCP, if given
+    :return: None
+    """
+    server = LibraryServer(library)
+    if path is not None:
+        await server.start_unix(path)
+        print("serving on", path)
+    else:
+        print("serving on %s:%d" % await server.start(host, port))
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a Library recovered from a snapshot and transaction log")
+    parser.add_argument("snapshot", help="path of the snapshot file")
+    parser.add_argument("log", help="path of the write-ahead log file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="serve on this Unix socket path instead of TCP")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(recover(args.snapshot, args.log, group_size=1 << 30), args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
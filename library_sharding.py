@@ -0,0 +1,384 @@
+# Description: A Library partitioned across worker processes. Each shard process runs an ordinary Library holding the
+# items whose ids hash to it, so check-outs, returns, requests and the daily fine pass run on as many cores as there
+# are shards instead of on one core under the GIL.
+
+import multiprocessing
+import threading
+import zlib
+from array import array
+from Library import *
+
+
+def get_shard(key, shard_count):
+    """
+    returns the shard an item id or patron id belongs to. crc32 is used rather than hash() so every process agrees.
+    :param key: a library item id or patron id
+    :param shard_count: number of shards
+    :return: an integer from 0 to shard_count - 1
+    """
+    return zlib.crc32(key.encode()) % shard_count
+
+
+def _add_items(library, item_rows):
+    """
+    adds items sent to a shard as (type code, library_item_id, title, creator) rows
+    :return: a list of the add results
+    """
+    return [library.add_library_item(ITEM_TYPES[type_code](library_item_id, title, creator))
+            for type_code, library_item_id, title, creator in item_rows]
+
+
+def _add_patrons(library, patron_rows):
+    """
+    adds patrons sent to a shard as (patron_id, name, patron_class) rows
+    :return: a list of the add results
+    """
+    return [library.add_patron(Patron(patron_id, name, patron_class)) for patron_id, name, patron_class in patron_rows]
+
+
+def _get_fine_cents(library, patron_id):
+    """
+    returns the fine a patron owes on one shard, in cents, or None if the patron is not a member
+    """
+    patron = library.lookup_patron_from_id(patron_id)
+    return None if patron is None else patron.get_fine_cents(library.get_current_date())
+
+
+def _get_checked_out_item_ids(library, patron_id):
+    """
+    returns the ids of the items a patron has checked out from one shard, or None if the patron is not a member
+    """
+    patron = library.lookup_patron_from_id(patron_id)
+    if patron is None:
+        return None
+    return [library_item.get_library_item_id() for library_item in patron.get_checked_out_items()]
+
+
+def _get_location(library, library_item_id):
+    """
+    returns the location of an item on its shard, or None if it is not in the holdings
+    """
+    library_item = library.lookup_library_item_from_id(library_item_id)
+    return None if library_item is None else library_item.get_location()
+
+
+# operations a shard process runs, by name, besides the Library methods named in _LIBRARY_OPERATIONS
+_SHARD_OPERATIONS = {"add_items": _add_items, "add_patrons": _add_patrons, "get_fine_cents": _get_fine_cents,
+                     "get_checked_out_item_ids": _get_checked_out_item_ids, "get_location": _get_location}
+_LIBRARY_OPERATIONS = ("check_out_library_item", "return_library_item", "request_library_item", "cancel_request",
+                       "get_hold_position", "process_batch", "pay_fine", "advance_date", "get_current_date",
+                       "count_library_items", "set_loan_policy")
+
+
+def _run_shard(connection):
+    """
+    The loop of a shard process. Receives (operation, arguments) messages and sends back (True, result), or
+    (False, exception) if the operation raised, until it receives None.
+    :param connection: the shard's end of a multiprocessing Pipe
+    :return: None
+    """
+    library = Library()
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        operation, arguments = message
+        try:
+            if operation in _SHARD_OPERATIONS:
+                result = _SHARD_OPERATIONS[operation](library, *arguments)
+            elif operation in _LIBRARY_OPERATIONS:
+                result = getattr(library, operation)(*arguments)
+            else:
+                raise ValueError("unknown shard operation " + repr(operation))
+        except Exception as error:
+            connection.send((False, error))
+        else:
+            connection.send((True, result))
+    connection.close()
+
+
+class ShardedLibrary:
+    """
+    A Library whose holdings are partitioned by library_item_id across shard processes.
+
+    Each shard runs a Library holding the items whose ids hash to it (see get_shard). Every shard has a copy of every
+    patron, and a patron's copy on a shard carries the loans, holds and overdue fines of that shard's items; payments
+    are made on the patron's home shard, the shard the patron id hashes to. A patron's fine is the sum of their fines
+    on every shard and their checked-out items are the union of their items on every shard. No Library rule spans
+    two items, so an item's shard can apply each check-out, return and request on its own.
+
+    Each shard's pipe has a lock held for a whole request and reply. Operations on one item lock only its shard;
+    operations that span shards (adding patrons, batches, advancing the date, and reading a patron's fine or items)
+    lock every shard they touch in shard order, as ConcurrentLibrary orders its stripes, so no thread sees another's
+    cross-shard operation half done. Messages to the shards of a cross-shard operation are all sent before any reply
+    is read, so the shards work in parallel: a batch is split by shard, and advancing the date runs every shard's
+    overdue pass at once.
+
+    Library items and patrons live in the shard processes, so there are no lookups returning objects;
+    get_location, get_fine_amount and get_checked_out_item_ids read their state instead.
+    """
+
+    def __init__(self, shard_count, start_method=None):
+        """
+        :param shard_count: number of shard processes to start
+        :param start_method: multiprocessing start method, such as "spawn" or "fork", the platform default if None
+        """
+        context = multiprocessing.get_context(start_method)
+        self._shard_count = shard_count
+        self._connections = []
+        self._processes = []
+        self._locks = [threading.Lock() for shard in range(shard_count)]
+        for shard in range(shard_count):
+            parent_end, shard_end = context.Pipe()
+            process = context.Process(target=_run_shard, args=(shard_end,), daemon=True)
+            process.start()
+            shard_end.close()
+            self._connections.append(parent_end)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        stops the shard processes, their state is lost
+        :return: None
+        """
+        for shard, connection in enumerate(self._connections):
+            with self._locks[shard]:
+                connection.send(None)
+                connection.close()
+        for process in self._processes:
+            process.join()
+        self._connections = []
+
+    def get_shard_count(self):
+        """
+        returns the number of shards
+        :return: an integer
+        """
+        return self._shard_count
+
+    def _call(self, shard, operation, *arguments):
+        """
+        runs an operation on one shard and waits for its result
+        :param shard: the shard number
+        :param operation: a Library method name or a name in _SHARD_OPERATIONS
+        :param arguments: the operation's arguments
+        :return: the operation's result
+        """
+        with self._locks[shard]:
+            self._connections[shard].send((operation, arguments))
+            succeeded, result = self._connections[shard].recv()
+        if not succeeded:
+            raise result
+        return result
+
+    def _call_shards(self, messages):
+        """
+        runs operations on several shards in parallel, holding their locks in shard order
+        :param messages: a dictionary of shard number to (operation, arguments)
+        :return: a dictionary of shard number to result
+        """
+        shards = sorted(messages)
+        for shard in shards:
+            self._locks[shard].acquire()
+        try:
+            for shard in shards:
+                self._connections[shard].send(messages[shard])
+            replies = {shard: self._connections[shard].recv() for shard in shards}
+        finally:
+            for shard in reversed(shards):
+                self._locks[shard].release()
+        for succeeded, result in replies.values():
+            if not succeeded:
+                raise result
+        return {shard: result for shard, (succeeded, result) in replies.items()}
+
+    def _call_all(self, operation, *arguments):
+        """
+        runs the same operation on every shard in parallel
+        :return: a list of results in shard order
+        """
+        results = self._call_shards({shard: (operation, arguments) for shard in range(self._shard_count)})
+        return [results[shard] for shard in range(self._shard_count)]
+
+    def add_library_item(self, new_library_item):
+        """
+        adds a library item to the holdings of its shard, see Library.add_library_item
+        :param new_library_item: a Book, Album or Movie object, only its type, id, title and creator are sent
+        :return: A string about the result of the add attempt
+        """
+        return self.add_library_items([new_library_item])[0]
+
+    def add_library_items(self, new_library_items):
+        """
+        adds library items to their shards, with one message per shard
+        :param new_library_items: an iterable of Book, Album and Movie objects
+        :return: a list of strings about the result of each add attempt, in order
+        """
+        rows = {}
+        order = []
+        for library_item in new_library_items:
+            library_item_id = library_item.get_library_item_id()
+            shard = get_shard(library_item_id, self._shard_count)
+            order.append((shard, len(rows.setdefault(shard, []))))
+            rows[shard].append((get_item_type_code(library_item), library_item_id, library_item.get_title(),
+                                library_item.get_creator()))
+        results = self._call_shards({shard: ("add_items", (shard_rows,)) for shard, shard_rows in rows.items()})
+        return [results[shard][position] for shard, position in order]
+
+    def add_patron(self, new_patron):
+        """
+        adds a patron to every shard, see Library.add_patron
+        :param new_patron: a Patron object, only its id, name and patron class are sent
+        :return: A string about the result of the add attempt
+        """
+        return self.add_patrons([new_patron])[0]
+
+    def add_patrons(self, new_patrons):
+        """
+        adds patrons to every shard, with one message per shard
+        :param new_patrons: an iterable of Patron objects
+        :return: a list of strings about the result of each add attempt, in order
+        """
+        rows = [(patron.get_patron_id(), patron.get_name(), patron.get_patron_class()) for patron in new_patrons]
+        return self._call_all("add_patrons", rows)[0]
+
+    def check_out_library_item(self, patron_id, library_item_id):
+        """
+        checks out an item on its shard, see Library.check_out_library_item
+        :return: A string about the result of the check-out attempt
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "check_out_library_item", patron_id,
+                          library_item_id)
+
+    def return_library_item(self, library_item_id):
+        """
+        returns an item on its shard, see Library.return_library_item
+        :return: A string about the result of the return attempt
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "return_library_item", library_item_id)
+
+    def request_library_item(self, patron_id, library_item_id):
+        """
+        places a hold on an item on its shard, see Library.request_library_item
+        :return: a string about the result of request
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "request_library_item", patron_id,
+                          library_item_id)
+
+    def cancel_request(self, patron_id, library_item_id):
+        """
+        cancels a hold on an item on its shard, see Library.cancel_request
+        :return: a string about the result of the cancellation
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "cancel_request", patron_id,
+                          library_item_id)
+
+    def get_hold_position(self, patron_id, library_item_id):
+        """
+        returns a patron's place in an item's hold queue, see Library.get_hold_position
+        :return: 1 for the front of the queue, or None if the patron is not waiting on the item
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "get_hold_position", patron_id,
+                          library_item_id)
+
+    def get_location(self, library_item_id):
+        """
+        returns the location of an item
+        :param library_item_id: id of the item
+        :return: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT", or None if the item is not in the holdings
+        """
+        return self._call(get_shard(library_item_id, self._shard_count), "get_location", library_item_id)
+
+    def process_batch(self, transactions):
+        """
+        Applies a batch of check-out, return and request transactions, see Library.process_batch. The batch is split
+        by item shard and the shards apply their parts in parallel; each item's transactions keep their order, so the
+        results are the same as applying the batch in order on one Library.
+        :param transactions: an iterable of (operation, patron_id, library_item_id) tuples
+        :return: an array of result codes, one per transaction
+        """
+        shard_count = self._shard_count
+        batches = {}
+        order = []
+        for transaction in transactions:
+            shard = get_shard(transaction[2], shard_count)
+            batch = batches.get(shard)
+            if batch is None:
+                batch = batches[shard] = []
+            order.append((shard, len(batch)))
+            batch.append(transaction)
+        results = self._call_shards({shard: ("process_batch", (batch,)) for shard, batch in batches.items()})
+        return array("b", [results[shard][position] for shard, position in order])
+
+    def pay_fine(self, patron_id, payment_amount):
+        """
+        pays a patron's fine on their home shard, see Library.pay_fine
+        :return: A string about the result of payment
+        """
+        return self._call(get_shard(patron_id, self._shard_count), "pay_fine", patron_id, payment_amount)
+
+    def get_fine_amount(self, patron_id):
+        """
+        returns the fine a patron owes, the sum of their fines on every shard
+        :param patron_id: id of the patron
+        :return: fine amount in dollars, or None if the patron is not a member
+        """
+        fines = self._call_all("get_fine_cents", patron_id)
+        return None if fines[0] is None else sum(fines) / 100
+
+    def get_checked_out_item_ids(self, patron_id):
+        """
+        returns the ids of the items a patron has checked out, from every shard
+        :param patron_id: id of the patron
+        :return: a list of library item ids, or None if the patron is not a member
+        """
+        item_ids = self._call_all("get_checked_out_item_ids", patron_id)
+        return None if item_ids[0] is None else [item_id for shard_ids in item_ids for item_id in shard_ids]
+
+    def count_library_items(self, location, item_type=None):
+        """
+        counts the library items at a location on every shard, see Library.count_library_items
+        :return: an integer
+        """
+        return sum(self._call_all("count_library_items", location, item_type))
+
+    def get_current_date(self):
+        """
+        returns the current date, which every shard shares
+        :return: an integer
+        """
+        return self._call(0, "get_current_date")
+
+    def advance_date(self, days):
+        """
+        moves every shard's date forward at once, so the shards run their overdue passes in parallel
+        :param days: number of days to advance, a non-negative integer
+        :return: None
+        """
+        self._call_all("advance_date", days)
+
+    def increment_current_date(self):
+        """
+        moves every shard's date forward by one day
+        :return: None
+        """
+        self.advance_date(1)
+
+    def set_loan_policy(self, loan_policy):
+        """
+        sends the rules the library lends by to every shard, see Library.set_loan_policy. A shard only sees the loans of
+        the items it holds, so a loan limit would let a patron borrow max_loans items on each shard; a policy with a
+        max_loans rule is refused rather than enforced per shard.
+        :param loan_policy: a LoanPolicy object, without a max_loans rule other than max_loans=None
+        :return: None
+        """
+        for item_type, patron_class, settings in loan_policy.get_rules():
+            if settings.get("max_loans") is not None:
+                raise ValueError("max_loans is not supported by a ShardedLibrary")
+        self._call_all("set_loan_policy", loan_policy)
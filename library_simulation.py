@@ -0,0 +1,238 @@
+# Description: A vectorized circulation engine for long capacity-planning runs. Loans, due dates and fines are kept in
+# NumPy arrays so overdue detection and fine accrual for every loan run as whole-array operations per date advance.
+# Requires NumPy, which Library.py itself does not.
+
+from collections import deque
+from array import array
+from Library import *
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# A transaction stream is a list of (operation, patron_id, argument) tuples, CIRCULATION_OPERATIONS are the ones that
+# report a result code:
+# * ("check_out", patron_id, library_item_id)
+# * ("return", None, library_item_id)
+# * ("request", patron_id, library_item_id)
+# * ("pay_fine", patron_id, payment_amount)
+# * ("advance_date", None, days)
+CIRCULATION_OPERATIONS = ("check_out", "return", "request")
+
+
+class CirculationEngine:
+    """
+    Simulates a library's circulation with items and patrons numbered by row instead of held as objects.
+
+    Per item there is a type code, a check-out length, daily fine and fine cap (from a LoanPolicy's terms for its type,
+    the check-out length including the grace days), a location code, the row of the patron it is checked out by (-1 for
+    none) and its date checked out; per patron there is a fine in integer cents and a count of loans. Every patron is
+    lent to on the terms of one patron class. Advancing the date charges every open loan at once: a loan is charged its
+    daily fine for each day in the advance after its due date, up to its cap, summed per patron with a bincount. Hold
+    queues are kept only for requested items, as deques of patron rows. Check-outs, returns, requests and payments
+    follow the same rules as Library, so the engine and a Library fed the same transaction stream end with the same
+    fines and locations.
+    """
+
+    def __init__(self, library_items, patron_ids, loan_policy=None, patron_class=DEFAULT_PATRON_CLASS):
+        """
+        :param library_items: Book, Album and Movie objects, their ids and types are copied
+        :param patron_ids: ids of the patrons
+        :param loan_policy: the LoanPolicy to lend by, None for the default rules
+        :param patron_class: the patron class whose terms every patron is lent on
+        """
+        if np is None:
+            raise ImportError("CirculationEngine requires NumPy")
+        library_items = list(library_items)
+        self._item_rows = {item.get_library_item_id(): row for row, item in enumerate(library_items)}
+        self._patron_rows = {patron_id: row for row, patron_id in enumerate(patron_ids)}
+        self._types = np.array([get_item_type_code(item) for item in library_items], dtype=np.int8)
+        loan_policy = LoanPolicy() if loan_policy is None else loan_policy
+        self._max_loans, loan_terms = loan_policy.get_table(patron_class)
+        # columns of each type's (loan days + grace days, daily fine, fine cap), indexed by the item type codes
+        loan_days, daily_fines, fine_caps = (np.array(column, dtype=np.int64) for column in zip(
+            *[(days + grace, daily, np.iinfo(np.int64).max if cap is None else cap)
+              for days, daily, cap, grace in loan_terms]))
+        self._loan_lengths = loan_days[self._types]
+        self._daily_fines = daily_fines[self._types]
+        self._fine_caps = fine_caps[self._types]
+        self._locations = np.zeros(len(library_items), dtype=np.int8)
+        self._checked_out_by = np.full(len(library_items), -1, dtype=np.int64)
+        self._dates_checked_out = np.zeros(len(library_items), dtype=np.int64)
+        self._fine_cents = np.zeros(len(self._patron_rows), dtype=np.int64)
+        self._loan_counts = [0] * len(self._patron_rows)
+        self._hold_queues = {}  # item row -> deque of patron rows
+        self._holds = set()  # (patron row, item row) of every waiting hold
+        self._current_date = 0
+        # memoryviews over the same buffers, indexing one is cheaper than indexing a NumPy array for single rows
+        self._location_view = memoryview(self._locations)
+        self._checked_out_view = memoryview(self._checked_out_by)
+        self._date_view = memoryview(self._dates_checked_out)
+
+    def get_current_date(self):
+        """
+        returns the current date of the simulation
+        :return: an integer
+        """
+        return self._current_date
+
+    def get_fine_amount(self, patron_id):
+        """
+        returns the fine a patron owes
+        :param patron_id: id of the patron
+        :return: fine amount, in dollars
+        """
+        return int(self._fine_cents[self._patron_rows[patron_id]]) / 100
+
+    def get_location(self, library_item_id):
+        """
+        returns the location of an item
+        :param library_item_id: id of the item
+        :return: "ON_SHELF", "ON_HOLD_SHELF", or "CHECKED_OUT"
+        """
+        return LOCATIONS[self._locations[self._item_rows[library_item_id]]]
+
+    def count_overdue(self):
+        """
+        counts the open loans that are overdue on the current date, by item type
+        :return: a dictionary of Book, Album and Movie to the number of overdue loans
+        """
+        overdue = (self._checked_out_by >= 0) & (self._dates_checked_out + self._loan_lengths < self._current_date)
+        counts = np.bincount(self._types[overdue], minlength=len(ITEM_TYPES))
+        return {item_type: int(counts[code]) for code, item_type in enumerate(ITEM_TYPES)}
+
+    def advance_date(self, days):
+        """
+        Moves the date forward and charges each open loan its daily fine for every day of the advance it spends past its
+        due date, up to its fine cap, for all loans at once.
+        :param days: number of days to advance, a non-negative integer
+        :return: None
+        """
+        new_date = self._current_date + days
+        loans = np.flatnonzero(self._checked_out_by >= 0)
+        if len(loans):
+            due_dates = self._dates_checked_out[loans] + self._loan_lengths[loans]
+            daily_fines, fine_caps = self._daily_fines[loans], self._fine_caps[loans]
+            fined_before = np.minimum(daily_fines * np.clip(self._current_date - due_dates, 0, None), fine_caps)
+            fined_after = np.minimum(daily_fines * np.clip(new_date - due_dates, 0, None), fine_caps)
+            self._fine_cents += np.bincount(self._checked_out_by[loans], weights=fined_after - fined_before,
+                                            minlength=len(self._fine_cents)).astype(np.int64)
+        self._current_date = new_date
+
+    def pay_fine(self, patron_id, payment_amount):
+        """
+        lowers a patron's fine by the amount paid, see Library.pay_fine
+        :param patron_id: id of patron paying
+        :param payment_amount: the amount being paid, in dollars
+        :return: A string about the result of payment
+        """
+        patron = self._patron_rows.get(patron_id)
+        if patron is None:
+            return "patron not found"
+        self._fine_cents[patron] -= round(payment_amount * 100)
+        return "payment successful"
+
+    def _check_out(self, patron, item):
+        """
+        checks out an item row to a patron row, see Library._check_out
+        :return: A string about the result of the check-out attempt
+        """
+        location = self._location_view[item]
+        if location == 2:
+            return "item already checked out"
+        if location == 1 and self._hold_queues[item][0] != patron:
+            return "item on hold by other patron"
+        if self._max_loans is not None and self._loan_counts[patron] >= self._max_loans:
+            return "loan limit reached"
+        if location == 1:
+            self._hold_queues[item].popleft()
+            self._holds.discard((patron, item))
+        self._loan_counts[patron] += 1
+        self._location_view[item] = 2
+        self._checked_out_view[item] = patron
+        self._date_view[item] = self._current_date
+        return "check out successful"
+
+    def _return(self, item):
+        """
+        returns an item row, see Library._return
+        :return: A string about the result of the return attempt
+        """
+        if self._location_view[item] != 2:
+            return "item already in library"
+        self._loan_counts[self._checked_out_view[item]] -= 1
+        self._checked_out_view[item] = -1
+        self._location_view[item] = 1 if self._hold_queues.get(item) else 0
+        return "return successful"
+
+    def _request(self, patron, item):
+        """
+        places a hold on an item row for a patron row, see Library._request
+        :return: a string about the result of request
+        """
+        if (patron, item) in self._holds:
+            return "item already on hold"
+        self._holds.add((patron, item))
+        self._hold_queues.setdefault(item, deque()).append(patron)
+        if self._location_view[item] == 0:
+            self._location_view[item] = 1
+        return "request successful"
+
+    def run(self, transactions):
+        """
+        Applies a transaction stream in order.
+        :param transactions: a list of (operation, patron_id, argument) tuples, see the top of this file
+        :return: an array of result codes for the check-out, return and request transactions, as process_batch
+        """
+        results = array("b")
+        for operation, patron_id, argument in transactions:
+            if operation == "advance_date":
+                self.advance_date(argument)
+            elif operation == "pay_fine":
+                self.pay_fine(patron_id, argument)
+            elif operation == "return":
+                item = self._item_rows.get(argument)
+                results.append(RESULT_CODES["item not found" if item is None else self._return(item)])
+            elif operation in CIRCULATION_OPERATIONS:
+                patron = self._patron_rows.get(patron_id)
+                item = self._item_rows.get(argument)
+                if patron is None:
+                    result = "patron not found"
+                elif item is None:
+                    result = "item not found"
+                elif operation == "check_out":
+                    result = self._check_out(patron, item)
+                else:
+                    result = self._request(patron, item)
+                results.append(RESULT_CODES[result])
+            else:
+                results.append(RESULT_CODES["unknown operation"])
+        return results
+
+
+def run_library(library, transactions):
+    """
+    Applies a transaction stream to a Library, with runs of check-outs, returns and requests going through
+    process_batch. Used to check CirculationEngine against the object model.
+    :param library: the Library object
+    :param transactions: a list of (operation, patron_id, argument) tuples, see the top of this file
+    :return: an array of result codes for the check-out, return and request transactions
+    """
+    results = array("b")
+    batch = []
+    for transaction in transactions:
+        operation = transaction[0]
+        if operation in ("advance_date", "pay_fine"):
+            if batch:
+                results.extend(library.process_batch(batch))
+                batch = []
+            if operation == "advance_date":
+                library.advance_date(transaction[2])
+            else:
+                library.pay_fine(transaction[1], transaction[2])
+        else:
+            batch.append(transaction)
+    if batch:
+        results.extend(library.process_batch(batch))
+    return results
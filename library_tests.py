@@ -1,7 +1,26 @@
 # Unit Test file for Library.py
 
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from Library import *
+from library_persistence import *
+from library_simulation import *
+from library_workload import *
+from library_metrics import *
+from library_sharding import *
+from library_server import *
+from library_import import *
+from library_history import *
 
 b1 = Book("1111", "Phantom Tollbooth", "Juster")
 b2 = Book("1114", "Harry Potter", "Rowling")
@@ -31,7 +50,7 @@ lib.add_patron(p3)
 # Made following tests:
 # 1. test fines for accuracy when multiple patrons are overdue
 # 2. test result when patron requests item that is checked out
-# 3. test result when patron requests item that is checked out and on hold
+# 3. test result when patron requests item that is checked out and on hold (a second patron joins the hold queue)
 # 4. test result when patron tries to check out item that is on hold
 # 5. test pay_fine method
 # 6. test return library item when not requested and returning item not belonging to library
@@ -67,7 +86,9 @@ class library_tests(unittest.TestCase):
         test result when patron requests item that is checked out and on hold
         """
         lib.request_library_item("aac", "1112")
-        self.assertEqual(lib.request_library_item("aab", "1112"), "item already on hold")
+        self.assertEqual(lib.request_library_item("aac", "1112"), "item already on hold")
+        self.assertEqual(lib.request_library_item("aab", "1112"), "request successful")
+        self.assertEqual(lib.get_hold_position("aab", "1112"), 2)
 
     def test_4(self):
         """
@@ -97,3 +118,1556 @@ class library_tests(unittest.TestCase):
         lib.return_library_item("1116")
         self.assertAlmostEqual(p3.get_fine_amount(), 1.30)
         self.assertEqual(m2.get_location(), "ON_SHELF")
+
+
+class library_index_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        self.book = Book("2221", "Phantom Tollbooth", "Juster")
+        self.patron = Patron("bba", "Felicity")
+        self.lib.add_library_item(self.book)
+        self.lib.add_patron(self.patron)
+
+    def test_duplicate_ids(self):
+        """
+        test that items and patrons with ids already in the library are rejected
+        """
+        self.assertEqual(self.lib.add_library_item(Movie("2221", "Laputa", "Miyazaki")), "item id already in holdings")
+        self.assertEqual(self.lib.add_patron(Patron("bba", "Waldo")), "patron id already in members")
+        self.assertIs(self.lib.lookup_library_item_from_id("2221"), self.book)
+        self.assertIs(self.lib.lookup_patron_from_id("bba"), self.patron)
+
+    def test_lookup_missing(self):
+        """
+        test lookups for ids that are not in the library
+        """
+        self.assertIsNone(self.lib.lookup_library_item_from_id("9999"))
+        self.assertIsNone(self.lib.lookup_patron_from_id("zzz"))
+
+
+class library_fine_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        self.patron = Patron("cca", "Felicity")
+        self.lib.add_patron(self.patron)
+        self.lib.add_library_item(Book("3331", "Phantom Tollbooth", "Juster"))
+        self.lib.add_library_item(Album("3332", "...And His Orchestra", "The Fastbacks"))
+        self.lib.check_out_library_item("cca", "3331")
+        self.lib.check_out_library_item("cca", "3332")
+
+    def test_advance_date_matches_increment(self):
+        """
+        test that advancing many days at once charges the same fines as incrementing one day at a time, in exact cents
+        """
+        other = Library()
+        other_patron = Patron("cca", "Felicity")
+        other.add_patron(other_patron)
+        other.add_library_item(Book("3331", "Phantom Tollbooth", "Juster"))
+        other.add_library_item(Album("3332", "...And His Orchestra", "The Fastbacks"))
+        other.check_out_library_item("cca", "3331")
+        other.check_out_library_item("cca", "3332")
+        self.lib.advance_date(365)
+        for i in range(365):
+            other.increment_current_date()
+        self.assertEqual(self.patron.get_fine_amount(), 69.5)
+        self.assertEqual(other_patron.get_fine_amount(), 69.5)
+
+    def test_return_stops_fines(self):
+        """
+        test that returning an overdue item stops its fine and returning before the due date charges nothing
+        """
+        self.lib.advance_date(20)
+        self.lib.return_library_item("3331")
+        self.lib.advance_date(30)
+        self.assertEqual(self.patron.get_fine_amount(), 3.6)
+        self.assertEqual(self.patron.get_overdue_count(), 1)
+        self.lib.return_library_item("3332")
+        self.lib.advance_date(30)
+        self.assertEqual(self.patron.get_fine_amount(), 3.6)
+        self.assertEqual(self.patron.get_overdue_count(), 0)
+
+
+class library_storage_tests(unittest.TestCase):
+
+    def test_location_codes(self):
+        """
+        test that items have no instance dictionary and still report locations as strings
+        """
+        movie = Movie("4441", "Laputa", "Miyazaki")
+        self.assertFalse(hasattr(movie, "__dict__"))
+        self.assertEqual(movie.get_location(), "ON_SHELF")
+        movie.set_location("ON_HOLD_SHELF")
+        self.assertEqual(movie.get_location(), "ON_HOLD_SHELF")
+        self.assertEqual(movie.get_location_code(), LOCATION_CODES["ON_HOLD_SHELF"])
+
+    def test_item_store_views(self):
+        """
+        test that item store views behave like library items when checked out and returned
+        """
+        store = ItemStore()
+        store.add(Album, "4442", "Come Back", "Lil Yachty")
+        self.assertEqual(store.add(Book, "4442", "Harry Potter", "Rowling"), "item id already in store")
+        lib = Library()
+        patron = Patron("dda", "Waldo")
+        lib.add_patron(patron)
+        lib.add_library_item(store.get("4442"))
+        self.assertEqual(lib.check_out_library_item("dda", "4442"), "check out successful")
+        album = store.get("4442")
+        self.assertIsInstance(album, Album)
+        self.assertNotIn("_title", dir(album))  # a view keeps only its store and row
+        self.assertEqual(album.get_artist(), "Lil Yachty")
+        self.assertEqual(album.get_location(), "CHECKED_OUT")
+        self.assertIs(album.get_checked_out_by(), patron)
+        self.assertEqual(lib.return_library_item("4442"), "return successful")
+        self.assertEqual(store.get("4442").get_location(), "ON_SHELF")
+        self.assertEqual(len(patron.get_checked_out_items()), 0)
+
+    def test_store_backed_library(self):
+        """
+        test that a library backed by an item store finds its items and rejects duplicate ids
+        """
+        store = ItemStore()
+        store.add(Movie, "4443", "Laputa", "Miyazaki")
+        lib = Library(store)
+        self.assertEqual(lib.lookup_library_item_from_id("4443").get_director(), "Miyazaki")
+        self.assertEqual(lib.add_library_item(Book("4443", "Harry Potter", "Rowling")), "item id already in holdings")
+
+
+class library_patron_tests(unittest.TestCase):
+
+    def test_checked_out_items(self):
+        """
+        test that checked out items keep their order, are removed by identity and cannot be changed through the getter
+        """
+        lib = Library()
+        patron = Patron("eea", "Ivy")
+        lib.add_patron(patron)
+        items = [Book("555" + str(i), "Harry Potter", "Rowling") for i in range(5)]
+        for item in items:
+            lib.add_library_item(item)
+            lib.check_out_library_item("eea", item.get_library_item_id())
+        lib.return_library_item("5552")
+        self.assertEqual(list(patron.get_checked_out_items()), [items[0], items[1], items[3], items[4]])
+        self.assertIn(items[4], patron.get_checked_out_items())
+        self.assertFalse(hasattr(patron.get_checked_out_items(), "append"))
+        lib.advance_date(22)
+        self.assertEqual(patron.get_overdue_count(), 4)
+
+
+class library_batch_tests(unittest.TestCase):
+
+    def build_library(self):
+        lib = Library()
+        lib.add_library_item(Book("6661", "Phantom Tollbooth", "Juster"))
+        lib.add_library_item(Movie("6662", "Laputa", "Miyazaki"))
+        lib.add_patron(Patron("ffa", "Felicity"))
+        lib.add_patron(Patron("ffb", "Waldo"))
+        return lib
+
+    def test_batch_matches_single_calls(self):
+        """
+        test that a batch gives the same results as the single-call methods applied in the same order
+        """
+        stream = [("check_out", "ffa", "6661"), ("check_out", "ffb", "6661"), ("request", "ffb", "6661"),
+                  ("request", "ffa", "6661"), ("return", None, "6661"), ("check_out", "ffa", "6661"),
+                  ("check_out", "ffb", "6661"), ("return", None, "6662"), ("check_out", "zzz", "6662"),
+                  ("check_out", "ffa", "0000"), ("renew", "ffa", "6662")]
+        single = self.build_library()
+        calls = {"check_out": single.check_out_library_item, "request": single.request_library_item}
+        expected = []
+        for operation, patron_id, item_id in stream:
+            if operation == "return":
+                expected.append(single.return_library_item(item_id))
+            elif operation in calls:
+                expected.append(calls[operation](patron_id, item_id))
+            else:
+                expected.append("unknown operation")
+        batch = self.build_library()
+        self.assertEqual([RESULTS[code] for code in batch.process_batch(stream)], expected)
+        self.assertEqual(batch.lookup_library_item_from_id("6661").get_checked_out_by().get_patron_id(), "ffb")
+
+
+class library_persistence_tests(unittest.TestCase):
+
+    def build_library(self):
+        lib = Library()
+        lib.add_library_item(Book("7771", "Phantom Tollbooth", "Juster"))
+        lib.add_library_item(Album("7772", "...And His Orchestra", "The Fastbacks"))
+        lib.add_library_item(Movie("7773", "Laputa", "Miyazaki"))
+        lib.add_library_item(Movie("7774", "Harry Potter", "David Yates"))
+        lib.add_patron(Patron("gga", "Felicity"))
+        lib.add_patron(Patron("ggb", "Waldo"))
+        lib.check_out_library_item("gga", "7771")
+        lib.check_out_library_item("ggb", "7773")
+        lib.request_library_item("gga", "7773")
+        lib.request_library_item("ggb", "7771")
+        lib.advance_date(10)
+        lib.check_out_library_item("gga", "7772")
+        lib.pay_fine("ggb", 0.05)
+        return lib
+
+    def test_snapshot_round_trip(self):
+        """
+        test that a loaded snapshot has the same state as the saved library and keeps charging the same fines
+        """
+        lib = self.build_library()
+        lib.add_library_item(Book("7775", "Emma", "Jane Austen"))  # never looked up once loaded
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "library.snapshot")
+        save_snapshot(lib, path)
+        snapshot_items = SnapshotItems(path)
+        self.addCleanup(snapshot_items.close)
+        loaded = load_snapshot(path, snapshot_items)
+        self.assertEqual(loaded.get_current_date(), 10)
+        self.assertEqual(loaded.lookup_patron_from_id("ggb").get_fine_amount(), 0.25)
+        movie = loaded.lookup_library_item_from_id("7773")
+        self.assertEqual(movie.get_location(), "CHECKED_OUT")
+        self.assertEqual(movie.get_requested_by().get_patron_id(), "gga")
+        self.assertIs(movie.get_checked_out_by(), loaded.lookup_patron_from_id("ggb"))
+        self.assertEqual(loaded.lookup_library_item_from_id("7774").get_director(), "David Yates")
+        self.assertIsNone(loaded.lookup_library_item_from_id("0000"))
+        self.assertEqual(loaded.add_library_item(Book("7774", "Harry Potter", "Rowling")), "item id already in holdings")
+        for library in (lib, loaded):
+            library.advance_date(40)
+            library.return_library_item("7773")
+        for patron_id in ("gga", "ggb"):
+            self.assertEqual(loaded.lookup_patron_from_id(patron_id).get_fine_amount(),
+                             lib.lookup_patron_from_id(patron_id).get_fine_amount())
+        self.assertEqual(movie.get_location(), "ON_HOLD_SHELF")
+        self.assertEqual(loaded.get_hold_position("ggb", "7771"), 1)
+        built = snapshot_items.get_built_items()
+        self.assertEqual(len(list(loaded.get_library_items())), 5)
+        saved_path = os.path.join(directory, "saved.snapshot")
+        save_snapshot(loaded, saved_path)  # builds the item never looked up for the save only
+        self.assertEqual(snapshot_items.get_built_items(), built)
+        saved_items = SnapshotItems(saved_path)
+        self.addCleanup(saved_items.close)
+        self.assertEqual(load_snapshot(saved_path, saved_items).lookup_library_item_from_id("7775").get_author(),
+                         "Jane Austen")
+
+
+class library_log_tests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(directory, "library.snapshot")
+        self.log_path = os.path.join(directory, "library.log")
+
+    def run_transactions(self, lib):
+        lib.add_library_item(Book("8881", "Phantom Tollbooth", "Juster"))
+        lib.add_library_item(Movie("8882", "Laputa", "Miyazaki"))
+        lib.add_patron(Patron("hha", "Felicity"))
+        lib.add_patron(Patron("hhb", "Waldo"))
+        lib.check_out_library_item("hha", "8881")
+        lib.process_batch([("check_out", "hhb", "8882"), ("request", "hha", "8882")])
+        lib.advance_date(30)
+        lib.return_library_item("8882")
+        lib.cancel_request("hha", "8882")
+        lib.increment_current_date()
+        lib.pay_fine("hha", 0.25)
+
+    def assert_same_state(self, recovered, expected):
+        self.assertEqual(recovered.get_current_date(), expected.get_current_date())
+        for patron_id in ("hha", "hhb"):
+            self.assertEqual(recovered.lookup_patron_from_id(patron_id).get_fine_amount(),
+                             expected.lookup_patron_from_id(patron_id).get_fine_amount())
+        for item_id in ("8881", "8882"):
+            self.assertEqual(recovered.lookup_library_item_from_id(item_id).get_location(),
+                             expected.lookup_library_item_from_id(item_id).get_location())
+
+    def test_recover_from_log(self):
+        """
+        test that replaying the log rebuilds the library and that a torn record at the end of the log is dropped
+        """
+        lib = Library()
+        lib.set_transaction_log(WriteAheadLog(self.log_path))
+        self.run_transactions(lib)
+        with open(self.log_path, "ab") as log_file:
+            log_file.write(b"\x02\x10\x00")  # a record cut short by a crash
+        recovered = recover(self.snapshot_path, self.log_path)
+        expected = Library()
+        self.run_transactions(expected)
+        self.assert_same_state(recovered, expected)
+        self.assertEqual(recovered.get_transaction_log().get_last_sequence(), 11)
+
+    def test_recover_after_compaction(self):
+        """
+        test that records made after a checkpoint are replayed on top of the snapshot and earlier ones are not
+        """
+        lib = Library()
+        transaction_log = WriteAheadLog(self.log_path, group_size=4, fsync=False)
+        lib.set_transaction_log(transaction_log)
+        self.run_transactions(lib)
+        transaction_log.compact(lib, self.snapshot_path)
+        lib.check_out_library_item("hhb", "8881")
+        lib.advance_date(60)
+        transaction_log.close()
+        recovered = recover(self.snapshot_path, self.log_path)
+        self.assert_same_state(recovered, lib)
+        self.assertEqual(len(read_log(self.log_path)[1]), 2)
+
+    def test_batch_logs_only_applied_transactions(self):
+        """
+        test that when a transaction of a batch raises, only the transactions applied before it are logged, so
+        replaying the log gives the state the library was left in
+        """
+        class FailingLibrary(Library):
+            def _request(self, patron, library_item):
+                raise RuntimeError("request failed")
+
+        lib = FailingLibrary()
+        transaction_log = WriteAheadLog(self.log_path, fsync=False)
+        lib.set_transaction_log(transaction_log)
+        lib.add_library_item(Book("8881", "Phantom Tollbooth", "Juster"))
+        lib.add_library_item(Movie("8882", "Laputa", "Miyazaki"))
+        lib.add_patron(Patron("hha", "Felicity"))
+        lib.add_patron(Patron("hhb", "Waldo"))
+        with self.assertRaises(RuntimeError):
+            lib.process_batch([("check_out", "hha", "8881"), ("request", "hhb", "8881"), ("return", None, "8881"),
+                               ("check_out", "hhb", "8882")])
+        transaction_log.close()
+        recovered = recover(self.snapshot_path, self.log_path, fsync=False)
+        recovered.get_transaction_log().close()
+        self.assert_same_state(recovered, lib)
+        self.assertEqual(lib.lookup_library_item_from_id("8881").get_location(), "CHECKED_OUT")
+
+
+class library_concurrency_tests(unittest.TestCase):
+
+    def test_no_double_loans(self):
+        """
+        test that threads competing for the same items never check one item out to two patrons
+        """
+        lib = ConcurrentLibrary(stripe_count=8)
+        item_ids = ["999" + str(i) for i in range(20)]
+        for item_id in item_ids:
+            lib.add_library_item(Movie(item_id, "Laputa", "Miyazaki"))
+        successes = []
+
+        def borrow(patron_id):
+            lib.add_patron(Patron(patron_id, "Patron " + patron_id))
+            for round_number in range(200):
+                for item_id in item_ids:
+                    if lib.check_out_library_item(patron_id, item_id) == "check out successful":
+                        successes.append(item_id)
+                    if round_number % 3 == 0:
+                        lib.return_library_item(item_id)
+
+        threads = [threading.Thread(target=borrow, args=("ii" + str(i),)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loans = [item for patron in lib.get_patrons() for item in patron.get_checked_out_items()]
+        self.assertEqual(len(loans), len(set(loans)))
+        for item in loans:
+            self.assertIn(item, item.get_checked_out_by().get_checked_out_items())
+        self.assertGreater(len(successes), len(item_ids))
+
+    def test_log_keeps_adds_before_their_transactions(self):
+        """
+        test that a check-out racing the add of its item is logged after the add, so the recovered library has every
+        item checked out as the live one does
+        """
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)  # switch threads often, so the check-outs land inside the adds
+        item_ids = ["99a" + str(i) for i in range(300)]
+        for trial in range(10):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            log_path = os.path.join(directory, "library.log")
+            lib = ConcurrentLibrary(stripe_count=8)
+            transaction_log = WriteAheadLog(log_path, group_size=64, fsync=False)
+            lib.set_transaction_log(transaction_log)
+            lib.add_patron(Patron("kk", "Kim"))
+
+            def check_out_all():
+                for item_id in item_ids:
+                    while lib.check_out_library_item("kk", item_id) != "check out successful":
+                        pass
+
+            thread = threading.Thread(target=check_out_all)
+            thread.start()
+            for item_id in item_ids:
+                lib.add_library_item(Book(item_id, "Racing", "Writer"))
+            thread.join()
+            transaction_log.close()
+            recovered = recover(os.path.join(directory, "library.snapshot"), log_path, fsync=False)
+            recovered.get_transaction_log().close()
+            self.assertEqual(recovered.count_library_items("CHECKED_OUT"), 300)
+
+    def test_fine_reads_do_not_lose_payments(self):
+        """
+        test that reading a fine while another thread pays it never loses a payment
+        """
+        lib = ConcurrentLibrary(stripe_count=8)
+        patron = Patron("iia", "Felicity")
+        lib.add_patron(patron)
+        lib.add_library_item(Movie("9990", "Laputa", "Miyazaki"))
+        lib.check_out_library_item("iia", "9990")
+        lib.advance_date(1007)  # 1000 days overdue at 10 cents a day
+        payments = threading.Thread(target=lambda: [lib.pay_fine("iia", 0.01) for payment in range(2000)])
+        payments.start()
+        while payments.is_alive():
+            patron.get_fine_amount()
+        payments.join()
+        self.assertEqual(patron.get_fine_amount(), 80.0)
+        self.assertEqual(lib.check_fine_report(), [])
+
+    def test_adds_do_not_lose_payments(self):
+        """
+        test that adding patrons who owe fines while another thread pays a fine keeps the fine report's totals
+        """
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        for trial in range(50):
+            lib = ConcurrentLibrary(stripe_count=8)
+            payer = Patron("iib", "Payer")
+            lib.add_patron(payer)
+            payer.amend_fine(30.0)
+            new_patrons = [Patron("iic" + str(number), "Debtor") for number in range(3000)]
+            for new_patron in new_patrons:
+                new_patron.amend_fine(0.01)
+            adds = threading.Thread(target=lambda: [lib.add_patron(new_patron) for new_patron in new_patrons])
+            adds.start()
+            for payment in range(3000):
+                lib.pay_fine("iib", 0.01)
+            adds.join()
+            self.assertEqual(lib.get_total_fines(), 30.0)
+            self.assertEqual(lib.check_fine_report(), [])
+
+
+class library_hold_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        self.book = Book("1011", "Harry Potter", "Rowling")
+        self.lib.add_library_item(self.book)
+        for patron_id in ("jja", "jjb", "jjc", "jjd"):
+            self.lib.add_patron(Patron(patron_id, "Patron " + patron_id))
+
+    def test_holds_are_filled_in_order(self):
+        """
+        test that each return puts the item on the hold shelf for the next patron in the queue
+        """
+        self.lib.check_out_library_item("jja", "1011")
+        for patron_id in ("jjb", "jjc", "jjd"):
+            self.assertEqual(self.lib.request_library_item(patron_id, "1011"), "request successful")
+        self.assertEqual(self.lib.get_hold_position("jjd", "1011"), 3)
+        for patron_id in ("jjb", "jjc", "jjd"):
+            self.lib.return_library_item("1011")
+            self.assertEqual(self.book.get_location(), "ON_HOLD_SHELF")
+            self.assertIs(self.book.get_requested_by(), self.lib.lookup_patron_from_id(patron_id))
+            self.assertEqual(self.lib.check_out_library_item("jja", "1011"), "item on hold by other patron")
+            self.assertEqual(self.lib.check_out_library_item(patron_id, "1011"), "check out successful")
+            self.assertEqual(len(self.lib.lookup_patron_from_id(patron_id).get_holds()), 0)
+        self.lib.return_library_item("1011")
+        self.assertEqual(self.book.get_location(), "ON_SHELF")
+
+    def test_cancel_request(self):
+        """
+        test that cancelling moves later holds up and that an item on the shelf goes on hold when requested
+        """
+        self.lib.request_library_item("jjb", "1011")
+        self.assertEqual(self.book.get_location(), "ON_HOLD_SHELF")
+        self.lib.request_library_item("jjc", "1011")
+        self.lib.request_library_item("jjd", "1011")
+        self.assertEqual(self.lib.cancel_request("jjc", "1011"), "request cancelled")
+        self.assertEqual(self.lib.cancel_request("jjc", "1011"), "no request found")
+        self.assertEqual(self.lib.get_hold_position("jjd", "1011"), 2)
+        self.lib.cancel_request("jjb", "1011")
+        self.assertEqual(self.lib.get_hold_position("jjd", "1011"), 1)
+        self.assertIs(self.book.get_requested_by(), self.lib.lookup_patron_from_id("jjd"))
+        self.lib.cancel_request("jjd", "1011")
+        self.assertEqual(self.book.get_location(), "ON_SHELF")
+        self.assertIsNone(self.book.get_requested_by())
+
+    def test_set_requested_by_cancels_holds(self):
+        """
+        test that replacing an item's requests through set_requested_by drops the replaced holds from their patrons,
+        and that positions stay right as holds are cancelled between position queries
+        """
+        for patron_id in ("jja", "jjb", "jjc", "jjd"):
+            self.lib.request_library_item(patron_id, "1011")
+        self.lib.cancel_request("jjb", "1011")
+        self.assertEqual(self.lib.get_hold_position("jjd", "1011"), 3)
+        self.lib.cancel_request("jja", "1011")
+        self.assertEqual(self.lib.get_hold_position("jjd", "1011"), 2)
+        self.assertEqual(self.lib.get_hold_position("jjc", "1011"), 1)
+        waldo = self.lib.lookup_patron_from_id("jjb")
+        self.book.set_requested_by(waldo)
+        self.assertIs(self.book.get_requested_by(), waldo)
+        self.assertEqual(self.lib.get_hold_position("jjb", "1011"), 1)
+        for patron_id in ("jja", "jjc", "jjd"):
+            self.assertEqual(len(self.lib.lookup_patron_from_id(patron_id).get_holds()), 0)
+            self.assertEqual(self.lib.cancel_request(patron_id, "1011"), "no request found")
+        self.book.set_requested_by(None)
+        self.assertEqual(len(waldo.get_holds()), 0)
+        self.assertIsNone(self.book.get_requested_by())
+
+
+class library_search_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        for item in (Book("1211", "Harry Potter", "Rowling"), Movie("1212", "Harry Potter", "David Yates"),
+                     Movie("1213", "Harry Potter and the Goblet of Fire", "Mike Newell"),
+                     Album("1214", "Come Back", "Lil Yachty"), Movie("1215", "Laputa", "Miyazaki")):
+            self.lib.add_library_item(item)
+
+    def test_term_and_type_queries(self):
+        """
+        test that every term must match, that closer matches rank first, and that results can be limited to a type
+        """
+        self.assertEqual(self.lib.search("Harry Potter"), ["1211", "1212", "1213"])
+        self.assertEqual(self.lib.search("harry potter", Movie), ["1212", "1213"])
+        self.assertEqual(self.lib.search("yates", Movie, "creator"), ["1212"])
+        self.assertEqual(self.lib.search("harry rowling", field="title"), [])
+        self.assertEqual(self.lib.search("potter", limit=1), ["1211"])
+
+    def test_prefix_queries(self):
+        """
+        test that prefix terms match every word they begin
+        """
+        self.assertEqual(self.lib.search("ya*"), ["1212", "1214"])
+        self.assertEqual(self.lib.search("harr* gob*"), ["1213"])
+        self.assertEqual(self.lib.search("miya*", Book), [])
+
+    def test_store_items_are_searchable(self):
+        """
+        test that items in the item store are found too
+        """
+        store = ItemStore()
+        store.add(Movie, "1216", "Laputa", "Miyazaki")
+        lib = Library(store)
+        lib.add_library_item(Book("1217", "Phantom Tollbooth", "Juster"))
+        self.assertEqual(lib.search("laputa"), ["1216"])
+        self.assertEqual(lib.search("juster"), ["1217"])
+
+    def test_snapshot_search_builds_no_items(self):
+        """
+        test that searching a library loaded from a snapshot answers from the index without building its items, and
+        that an item moved before the first search is found at its new location
+        """
+        built = []
+
+        class WatchedSnapshotItems(SnapshotItems):
+            def _read_item(self, offset):
+                library_item = super()._read_item(offset)
+                built.append(library_item.get_library_item_id())
+                return library_item
+
+        self.lib.add_patron(Patron("lla", "Felicity"))
+        self.lib.check_out_library_item("lla", "1212")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "library.snapshot")
+        save_snapshot(self.lib, path)
+        snapshot_items = WatchedSnapshotItems(path)
+        self.addCleanup(snapshot_items.close)
+        loaded = load_snapshot(path, snapshot_items)
+        self.assertEqual(built, ["1212"])  # only the item checked out is built when loading
+        loaded.return_library_item("1212")
+        self.assertEqual(loaded.search("harry potter", location="ON_SHELF"), ["1211", "1212", "1213"])
+        self.assertEqual(loaded.search("ya*", Album), ["1214"])
+        self.assertEqual(loaded.count_library_items("ON_SHELF"), 5)
+        self.assertEqual(built, ["1212"])
+
+    def test_concurrent_searches_and_adds(self):
+        """
+        test that a ConcurrentLibrary's searches run while other threads add items, and find every item once added
+        """
+        lib = ConcurrentLibrary(stripe_count=8)
+        found = []
+
+        def add_and_search(thread_number):
+            for i in range(200):
+                lib.add_library_item(Book("12" + str(thread_number) + "_" + str(i), "Laputa " + str(i), "Miyazaki"))
+                found.append(len(lib.search("laputa", location="ON_SHELF")))
+
+        threads = [threading.Thread(target=add_and_search, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(lib.search("laputa miya*")), 800)
+        self.assertEqual(lib.count_library_items("ON_SHELF", Book), 800)
+        self.assertEqual(max(found), 800)
+
+
+class library_availability_tests(unittest.TestCase):
+
+    def test_counts_follow_transactions(self):
+        """
+        test that the items at each location are counted and listed by type as they are checked out, held and returned
+        """
+        lib = Library()
+        for item in (Book("1311", "Harry Potter", "Rowling"), Movie("1312", "Harry Potter", "David Yates"),
+                     Movie("1313", "Laputa", "Miyazaki"), Album("1314", "Come Back", "Lil Yachty")):
+            lib.add_library_item(item)
+        lib.add_patron(Patron("kka", "Felicity"))
+        lib.add_patron(Patron("kkb", "Waldo"))
+        self.assertEqual(lib.count_library_items("ON_SHELF"), 4)
+        lib.check_out_library_item("kka", "1312")
+        lib.request_library_item("kkb", "1313")
+        self.assertEqual(lib.count_library_items("CHECKED_OUT", Movie), 1)
+        self.assertEqual(list(lib.get_library_item_ids("ON_HOLD_SHELF")), ["1313"])
+        self.assertEqual(list(lib.get_library_item_ids("ON_SHELF", Movie)), [])
+        self.assertEqual(lib.search("harry potter", location="ON_SHELF"), ["1311"])
+        lib.return_library_item("1312")
+        lib.cancel_request("kkb", "1313")
+        self.assertEqual(lib.count_library_items("ON_SHELF", Movie), 2)
+        self.assertEqual(lib.count_library_items("CHECKED_OUT"), 0)
+        self.assertEqual(lib.search("harry potter", Movie, location="ON_SHELF"), ["1312"])
+
+
+@unittest.skipIf(np is None, "CirculationEngine requires NumPy")
+class library_simulation_tests(unittest.TestCase):
+
+    def test_engine_matches_library(self):
+        """
+        test that the engine and a Library fed the same random transaction stream agree on every result, fine and
+        location
+        """
+        rng = random.Random(12)
+        items = [ITEM_TYPES[i % 3]("14" + str(i), "Title", "Creator") for i in range(30)]
+        patron_ids = ["ll" + str(i) for i in range(8)]
+        stream = []
+        for day in range(120):
+            for i in range(5):
+                operation = rng.choice(("check_out", "check_out", "return", "request"))
+                stream.append((operation, rng.choice(patron_ids), items[rng.randrange(30)].get_library_item_id()))
+            if day % 17 == 0:
+                stream.append(("pay_fine", rng.choice(patron_ids), 1.5))
+            stream.append(("advance_date", None, rng.choice((1, 1, 3))))
+        lib = Library()
+        for item in items:
+            lib.add_library_item(item)
+        for patron_id in patron_ids:
+            lib.add_patron(Patron(patron_id, "Patron"))
+        engine = CirculationEngine(items, patron_ids)
+        self.assertEqual(list(engine.run(stream)), list(run_library(lib, stream)))
+        for patron_id in patron_ids:
+            self.assertEqual(engine.get_fine_amount(patron_id), lib.lookup_patron_from_id(patron_id).get_fine_amount())
+        for item in items:
+            self.assertEqual(engine.get_location(item.get_library_item_id()), item.get_location())
+
+
+class library_workload_tests(unittest.TestCase):
+
+    def test_same_seed_same_workload(self):
+        """
+        test that two workloads with the same seed build the same catalog and draw the same streams
+        """
+        first, second = Workload(200, 20, seed=5), Workload(200, 20, seed=5)
+        self.assertEqual([(type(item), item.get_title(), item.get_creator()) for item in first.build_items()],
+                         [(type(item), item.get_title(), item.get_creator()) for item in second.build_items()])
+        self.assertEqual(first.generate_transactions(3, 50), second.generate_transactions(3, 50))
+        self.assertEqual(first.generate_queries(20), second.generate_queries(20))
+        self.assertNotEqual(Workload(200, 20, seed=6).generate_transactions(3, 50),
+                            Workload(200, 20, seed=5).generate_transactions(3, 50))
+
+    def test_item_mix_and_popularity(self):
+        """
+        test that the catalog follows the item mix and that a few items take most of the draws
+        """
+        workload = Workload(3000, 10, seed=1, item_mix={Album: 0.5, Movie: 0.5})
+        items = workload.build_items()
+        self.assertEqual({type(item) for item in items}, {Album, Movie})
+        self.assertTrue(1300 < sum(isinstance(item, Album) for item in items) < 1700)
+        counts = {}
+        for item_id in workload.sample_item_ids(10000):
+            counts[item_id] = counts.get(item_id, 0) + 1
+        most_drawn = sorted(counts.values(), reverse=True)
+        self.assertGreater(sum(most_drawn[:30]), 10000 / 3)  # the top 1% of items take over a third of the draws
+        counts = {}
+        for item_id in Workload(3000, 10, seed=1, zipf_exponent=0).sample_item_ids(10000):
+            counts[item_id] = counts.get(item_id, 0) + 1
+        self.assertLess(max(counts.values()), 20)
+
+    def test_stream_runs_against_library(self):
+        """
+        test that a stream advances a day at a time, returns only items it checked out, and runs against a Library
+        """
+        workload = Workload(300, 30, seed=2)
+        lib = workload.build_library()
+        stream = workload.generate_transactions(20, 40)
+        self.assertEqual(sum(transaction[0] == "advance_date" for transaction in stream), 20)
+        self.assertEqual(len(stream), 20 * 41)
+        checked_out = set()
+        for operation, patron_id, argument in stream:
+            if operation == "check_out":
+                checked_out.add(argument)
+            elif operation == "return":
+                self.assertIn(argument, checked_out)
+        results = [RESULTS[code] for code in run_library(lib, stream)]
+        self.assertIn("return successful", results)
+        self.assertIn("check out successful", results)
+        self.assertEqual(lib.get_current_date(), 20)
+
+
+class library_metrics_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        self.lib.add_library_item(Book("15a", "Metrics", "Counter"))
+        self.lib.add_library_item(Movie("15b", "Histogram", "Bucket"))
+        self.lib.add_patron(Patron("mm", "Mia"))
+        self.lib.add_patron(Patron("nn", "Noor"))
+
+    def test_counts_calls_and_results(self):
+        """
+        test that an instrumented library counts its calls, their results and the codes of a batch
+        """
+        metrics = instrument(self.lib)
+        self.assertIs(get_metrics(self.lib), metrics)
+        self.lib.check_out_library_item("mm", "15a")
+        self.lib.check_out_library_item("nn", "15a")
+        self.lib.check_out_library_item("zz", "15a")
+        self.lib.process_batch([("return", None, "15a"), ("return", None, "15a"), ("request", "nn", "15b")])
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["check_out_library_item"]["calls"], 3)
+        self.assertEqual(snapshot["check_out_library_item"]["results"],
+                         {"check out successful": 1, "item already checked out": 1, "patron not found": 1})
+        self.assertEqual(snapshot["process_batch"]["results"],
+                         {"return successful": 1, "item already in library": 1, "request successful": 1})
+        buckets = snapshot["check_out_library_item"]["buckets"]
+        self.assertEqual(buckets[-1], (float("inf"), 3))
+        self.assertEqual([count for bound, count in buckets], sorted(count for bound, count in buckets))
+        self.assertNotIn("search", snapshot)
+
+    def test_uninstrument(self):
+        """
+        test that an uninstrumented library gets its class back and records nothing more
+        """
+        metrics = instrument(self.lib)
+        self.assertRaises(ValueError, instrument, self.lib)
+        self.lib.pay_fine("mm", 1)
+        uninstrument(self.lib)
+        self.assertIs(type(self.lib), Library)
+        self.assertIsNone(get_metrics(self.lib))
+        self.lib.pay_fine("mm", 1)
+        self.assertEqual(metrics.snapshot()["pay_fine"]["calls"], 1)
+        self.assertEqual(self.lib.lookup_patron_from_id("mm").get_fine_amount(), -2)
+
+    def test_prometheus_export(self):
+        """
+        test the Prometheus text format of the metrics, including an escaped result and a counted error
+        """
+        metrics = LibraryMetrics()
+        metrics.observe("pay_fine", 3e-6, 'say "hi"')
+        metrics.observe("pay_fine", 2.0, error=True)
+        text = metrics.to_prometheus()
+        self.assertIn('library_calls_total{method="pay_fine"} 2\n', text)
+        self.assertIn('library_call_errors_total{method="pay_fine"} 1\n', text)
+        self.assertIn('library_call_duration_seconds_bucket{method="pay_fine",le="2.5e-06"} 0\n', text)
+        self.assertIn('library_call_duration_seconds_bucket{method="pay_fine",le="5e-06"} 1\n', text)
+        self.assertIn('library_call_duration_seconds_bucket{method="pay_fine",le="+Inf"} 2\n', text)
+        self.assertIn('library_results_total{method="pay_fine",result="say \\"hi\\""} 1\n', text)
+        self.assertIn("# TYPE library_call_duration_seconds histogram\n", text)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+    def test_sampling_profiler(self):
+        """
+        test that the profiler samples a busy thread and keeps only the Library.py part of its stacks
+        """
+        done = threading.Event()
+
+        def search_until_done():
+            while not done.is_set():
+                self.lib.search("metrics")
+
+        worker = threading.Thread(target=search_until_done)
+        with SamplingProfiler(interval=0.0005) as profiler:
+            worker.start()
+            while profiler.get_samples() < 5:
+                time.sleep(0.001)
+            done.set()
+            worker.join()
+        self.assertEqual(set(profiler.get_method_samples()), {"search"})
+        self.assertEqual(sum(profiler.get_stacks().values()), profiler.get_samples())
+        self.assertTrue(all(line.startswith("search") for line in profiler.to_collapsed().splitlines()))
+
+
+class library_sharding_tests(unittest.TestCase):
+
+    def test_shards_match_library(self):
+        """
+        test that a sharded library and a Library fed the same stream agree on every result, fine, loan and location
+        """
+        workload = Workload(500, 40, seed=9)
+        lib = workload.build_library()
+        stream = workload.generate_transactions(30, 60)
+        with ShardedLibrary(3) as sharded:
+            self.assertEqual(set(sharded.add_library_items(workload.build_items())), {"add successful"})
+            sharded.add_patrons([Patron(patron_id, "Patron") for patron_id in workload.get_patron_ids()])
+            self.assertEqual(sharded.add_patron(Patron("p0", "Again")), "patron id already in members")
+            self.assertEqual(list(run_library(sharded, stream)), list(run_library(lib, stream)))
+            self.assertEqual(sharded.get_current_date(), 30)
+            for patron_id in workload.get_patron_ids():
+                patron = lib.lookup_patron_from_id(patron_id)
+                self.assertEqual(sharded.get_fine_amount(patron_id), patron.get_fine_amount())
+                self.assertEqual(sorted(sharded.get_checked_out_item_ids(patron_id)),
+                                 sorted(item.get_library_item_id() for item in patron.get_checked_out_items()))
+            for item in lib.get_library_items():
+                self.assertEqual(sharded.get_location(item.get_library_item_id()), item.get_location())
+            self.assertEqual(sharded.count_library_items("CHECKED_OUT", Book), lib.count_library_items("CHECKED_OUT", Book))
+
+    def test_single_calls_route_to_item_shard(self):
+        """
+        test single calls, payments on the home shard, and unknown patrons and items
+        """
+        with ShardedLibrary(2) as sharded:
+            sharded.add_library_items([Book("16a", "Shard", "Router"), Album("16b", "Split", "Hash")])
+            sharded.add_patrons([Patron("oo", "Olu"), Patron("qq", "Quinn")])
+            self.assertEqual(sharded.check_out_library_item("oo", "16a"), "check out successful")
+            self.assertEqual(sharded.check_out_library_item("oo", "16b"), "check out successful")
+            self.assertEqual(sharded.request_library_item("qq", "16a"), "request successful")
+            self.assertEqual(sharded.get_hold_position("qq", "16a"), 1)
+            self.assertEqual(sharded.check_out_library_item("zz", "16a"), "patron not found")
+            self.assertEqual(sharded.return_library_item("16z"), "item not found")
+            sharded.advance_date(22)
+            self.assertEqual(sharded.get_fine_amount("oo"), 0.9)  # 1 day late for the Book, 8 for the Album
+            self.assertEqual(sharded.pay_fine("oo", 0.5), "payment successful")
+            self.assertEqual(sharded.get_fine_amount("oo"), 0.4)
+            self.assertEqual(sharded.return_library_item("16a"), "return successful")
+            self.assertEqual(sharded.get_location("16a"), "ON_HOLD_SHELF")
+            self.assertEqual(sharded.get_checked_out_item_ids("oo"), ["16b"])
+            self.assertIsNone(sharded.get_fine_amount("zz"))
+
+    def test_loan_limit_refused(self):
+        """
+        test that a policy limiting loans is refused, since each shard would only count its own items, and that one
+        without a limit is used by every shard
+        """
+        policy = LoanPolicy()
+        policy.set_rule(Book, loan_days=3)
+        policy.set_rule(patron_class="staff", max_loans=None)
+        with ShardedLibrary(2) as sharded:
+            sharded.add_library_items([Book("16a", "Shard", "Router"), Book("16c", "Limit", "Counter")])
+            sharded.add_patron(Patron("oo", "Olu"))
+            sharded.set_loan_policy(policy)
+            policy.set_rule(max_loans=1)
+            self.assertRaises(ValueError, sharded.set_loan_policy, policy)
+            self.assertEqual(sharded.check_out_library_item("oo", "16a"), "check out successful")
+            self.assertEqual(sharded.check_out_library_item("oo", "16c"), "check out successful")
+            sharded.advance_date(4)
+            self.assertEqual(sharded.get_fine_amount("oo"), 0.2)
+
+
+class library_server_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.lib = Library()
+        self.lib.add_library_item(Book("17a", "Socket", "Framer"))
+        self.lib.add_library_item(Album("17b", "Pipeline", "Batcher"))
+        self.lib.add_patron(Patron("rr", "Ravi"))
+        self.lib.add_patron(Patron("ss", "Sasha"))
+
+    def test_client_calls(self):
+        """
+        test every client call against a server on a Unix socket
+        """
+        async def run():
+            server = LibraryServer(self.lib)
+            path = os.path.join(tempfile.mkdtemp(), "library.sock")
+            await server.start_unix(path)
+            client = await LibraryClient.connect(path=path)
+            results = [await client.check_out_library_item("rr", "17a"),
+                       await client.check_out_library_item("ss", "17a"),
+                       await client.request_library_item("ss", "17a"),
+                       await client.get_hold_position("ss", "17a"),
+                       await client.get_hold_position("rr", "17a"),
+                       await client.get_location("17a"),
+                       await client.get_location("17z"),
+                       await client.return_library_item("17a"),
+                       await client.get_location("17a"),
+                       await client.cancel_request("ss", "17a"),
+                       await client.cancel_request("ss", "17a"),
+                       await client.pay_fine("rr", 2.5),
+                       await client.pay_fine("zz", 2.5),
+                       await client.get_fine_amount("rr"),
+                       await client.get_fine_amount("zz")]
+            await client.close()
+            await server.close()
+            return results
+
+        self.assertEqual(asyncio.run(run()), ["check out successful", "item already checked out", "request successful",
+                                              1, None, "CHECKED_OUT", None, "return successful", "ON_HOLD_SHELF",
+                                              "request cancelled", "no request found", "payment successful",
+                                              "patron not found", -2.5, None])
+        self.assertEqual(self.lib.lookup_library_item_from_id("17a").get_location(), "ON_SHELF")
+
+    def test_pipelined_requests_are_batched(self):
+        """
+        test that requests pipelined from many connections are applied in batches, in order for each connection, with
+        each reply going to its own request
+        """
+        for i in range(4):
+            self.lib.add_library_item(Movie("17c" + str(i), "Connection " + str(i), "Terminal"))
+
+        async def run():
+            server = LibraryServer(self.lib)
+            host, port = await server.start()
+            clients = [await LibraryClient.connect(host, port) for i in range(4)]
+            calls = []
+            for i in range(50):  # each connection keeps its order, so each is given its own item
+                client = clients[i % 4]
+                calls.append(client.check_out_library_item("rr", "17c" + str(i % 4)))
+                calls.append(client.return_library_item("17c" + str(i % 4)))
+                calls.append(client.get_location("17c" + str(i % 4)))
+            results = await asyncio.gather(*calls)
+            connections = server.get_connection_count()
+            for client in clients:
+                await client.close()
+            await server.close()
+            return results, server.get_stats(), connections
+
+        results, stats, connections = asyncio.run(run())
+        self.assertEqual(results, ["check out successful", "return successful", "ON_SHELF"] * 50)
+        self.assertEqual(stats["requests"], 150)
+        self.assertLess(stats["batches"], 150)
+        self.assertEqual(connections, 4)
+
+    def test_failed_transaction_keeps_earlier_results(self):
+        """
+        test that when a transaction raises, the requests of its batch applied before it keep their results and only
+        it and the requests after it, which are not applied, get "server error"
+        """
+        class FailingLibrary(Library):
+            def _request(self, patron, library_item):
+                raise RuntimeError("request failed")
+
+        lib = FailingLibrary()
+        lib.add_library_item(Book("17a", "Socket", "Framer"))
+        lib.add_patron(Patron("rr", "Ravi"))
+        lib.add_patron(Patron("ss", "Sasha"))
+
+        async def run():
+            server = LibraryServer(lib)
+            host, port = await server.start()
+            client = await LibraryClient.connect(host, port)
+            results = await asyncio.gather(client.check_out_library_item("rr", "17a"),
+                                           client.request_library_item("ss", "17a"),
+                                           client.return_library_item("17a"),
+                                           client.get_location("17a"))
+            await client.close()
+            await server.close()
+            return results
+
+        self.assertEqual(asyncio.run(run()), ["check out successful", "server error", "server error", "CHECKED_OUT"])
+
+    def test_failed_commit_answers_server_error(self):
+        """
+        test that when the transaction log cannot commit a batch, every request of the batch is answered with "server
+        error" rather than left waiting
+        """
+        class FailingLog:
+            def record(self, *args):
+                pass
+
+            def commit(self):
+                raise OSError("disk full")
+
+        self.lib.set_transaction_log(FailingLog())
+
+        async def run():
+            server = LibraryServer(self.lib)
+            host, port = await server.start()
+            client = await LibraryClient.connect(host, port)
+            results = await asyncio.wait_for(asyncio.gather(client.check_out_library_item("rr", "17a"),
+                                                            client.get_location("17a")), 5)
+            await client.close()
+            await server.close()
+            return results
+
+        self.assertEqual(asyncio.run(run()), ["server error", None])
+
+    def test_backpressure_and_bad_frames(self):
+        """
+        test that a connection which does not read its replies stops being served until it does, and that an
+        oversized frame closes the connection
+        """
+        async def run():
+            server = LibraryServer(self.lib, max_pipelined=8)
+            host, port = await server.start()
+            client_socket = socket.socket()
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)  # small buffers fill quickly
+            client_socket.connect((host, port))
+            client_socket.setblocking(False)
+            reader, writer = await asyncio.open_connection(sock=client_socket)
+            await asyncio.sleep(0.01)
+            server_transport = next(iter(server._connections))._transport
+            server_transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024)
+            server_transport.set_write_buffer_limits(high=1024)
+            writer.write(b"".join(encode_request(i, "get_location", ["17a"]) for i in range(20000)))
+            await asyncio.sleep(0.2)
+            served_before_reading = server.get_stats()["requests"]
+            replies = await reader.readexactly(17 * 20000)
+            writer.write(struct.pack("<I", MAX_FRAME_SIZE + 1))
+            rest = await reader.read()  # end of stream once the server closes the connection
+            writer.close()
+            await server.close()
+            return served_before_reading, replies, rest
+
+        served_before_reading, replies, rest = asyncio.run(run())
+        self.assertLess(served_before_reading, 20000)
+        self.assertEqual(struct.unpack_from("<IIBq", replies), (13, 0, SERVER_RESULT_CODES["ok"], 0))
+        self.assertEqual(struct.unpack_from("<IIBq", replies, 17 * 19999)[1], 19999)
+        self.assertEqual(rest, b"")
+
+    def test_log_is_committed_before_replies(self):
+        """
+        test that a served library's transaction log is written by the time the reply arrives
+        """
+        log_path = os.path.join(tempfile.mkdtemp(), "served.wal")
+        self.lib.set_transaction_log(WriteAheadLog(log_path, group_size=1000, fsync=False))
+
+        async def run():
+            server = LibraryServer(self.lib)
+            host, port = await server.start()
+            client = await LibraryClient.connect(host, port)
+            result = await client.check_out_library_item("ss", "17b")
+            records = read_log(log_path)[1]
+            await client.close()
+            await server.close()
+            return result, records
+
+        result, records = asyncio.run(run())
+        self.assertEqual(result, "check out successful")
+        self.assertEqual([record[0] for record in records], ["process_batch"])
+
+
+class library_import_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as file:
+            file.write(text)
+        return path
+
+    def test_csv_items(self):
+        """
+        test a CSV import across small chunks, with quoted fields, duplicates and bad rows reported by line number
+        """
+        path = self.write("items.csv", "library_item_id,type,title,creator,shelf\n"
+                                       "b1,Book,Fables,Aesop,A\n"
+                                       "a1,album,Blue,Joni Mitchell,B\n"
+                                       "\n"
+                                       'm1,MOVIE,"Run, Lola, Run","Tykwer\nTom",C\n'
+                                       "b1,Book,Fables again,Aesop,A\n"
+                                       "x1,Scroll,Dead Sea,Unknown,D\n"
+                                       ",Book,No Id,Nobody,E\n"
+                                       "b2,Book,Too Few\n"
+                                       "b3,Book,Emma,Jane Austen,F")
+        for lib in (Library(ItemStore()), Library(), ConcurrentLibrary()):
+            lib.add_library_item(Album("a1", "Blue", "Joni Mitchell"))
+            results = import_library_items(lib, path, chunk_size=16)
+            self.assertEqual(results["rows"], 8)
+            self.assertEqual(results["added"], 3)
+            self.assertEqual(results["duplicates"], [(3, "a1"), (7, "b1")])
+            self.assertEqual(results["bad rows"], [(8, "unknown item type Scroll"), (9, "empty library_item_id"),
+                                                   (10, "expected 5 fields, found 3")])
+            self.assertEqual(lib.lookup_library_item_from_id("m1").get_title(), "Run, Lola, Run")
+            self.assertIsInstance(lib.lookup_library_item_from_id("m1"), Movie)
+            self.assertEqual(lib.search("lola"), ["m1"])
+            self.assertEqual(lib.count_library_items("ON_SHELF", Book), 2)
+            self.assertEqual(lib.add_library_item(Book("b3", "Emma", "Jane Austen")), "item id already in holdings")
+
+    def test_csv_rows_of_wrong_width_without_quotes(self):
+        """
+        test that an unquoted chunk whose rows have too many and too few fields, adding up to the right number, has
+        those rows reported and the rows around them kept whole
+        """
+        path = self.write("items.csv", "library_item_id,type,title,creator\n"
+                                       "b1,Book,Fables,Aesop\n"
+                                       "b2,Book,Emma\n"
+                                       "b3,Book,Ivanhoe,Walter,Scott\n"
+                                       "b4,Book,Dracula,Stoker\n")
+        lib = Library()
+        results = import_library_items(lib, path)
+        self.assertEqual(results["added"], 2)
+        self.assertEqual(results["bad rows"], [(3, "expected 4 fields, found 3"), (4, "expected 4 fields, found 5")])
+        self.assertEqual(lib.lookup_library_item_from_id("b4").get_author(), "Stoker")
+        self.assertIsNone(lib.lookup_library_item_from_id("b3"))
+
+    def test_jsonl_lines_end_at_newlines(self):
+        """
+        test that a JSON string holding a line separator other than a newline is imported whole, and that a line
+        holding two objects is reported rather than imported, with the lines after it numbered by newlines
+        """
+        path = self.write("items.jsonl", '{"type": "Book", "library_item_id": "b1", "title": "A\u2028B\u2029C\x85D", '
+                                         '"creator": "Aesop"}\n'
+                                         '{"type": "Book", "library_item_id": "b2", "title": "Emma", "creator": "A"}, '
+                                         '{"type": "Book", "library_item_id": "b3", "title": "Emma", "creator": "A"}\n'
+                                         '{"type": "Book", "library_item_id": "b1", "title": "F", "creator": "A"}\n'
+                                         '{"type": "Book", "library_item_id": "b4", "title": "Dracula", '
+                                         '"creator": "Stoker"}\n')
+        lib = Library()
+        results = import_library_items(lib, path)
+        self.assertEqual((results["rows"], results["added"]), (4, 2))
+        self.assertEqual(results["bad rows"], [(2, "invalid JSON")])
+        self.assertEqual(results["duplicates"], [(3, "b1")])
+        self.assertEqual(lib.lookup_library_item_from_id("b1").get_title(), "A\u2028B\u2029C\x85D")
+        self.assertIsNone(lib.lookup_library_item_from_id("b2"))
+        self.assertEqual(lib.lookup_library_item_from_id("b4").get_author(), "Stoker")
+
+    def test_jsonl_items_and_patrons(self):
+        """
+        test a JSON lines import of items and of patrons, with duplicates and bad rows reported by line number
+        """
+        path = self.write("items.jsonl", '{"type": "Book", "library_item_id": "b1", "title": "Fables", '
+                                         '"creator": "Aesop"}\n'
+                                         '{"type": "Movie", "library_item_id": "m1", "title": "Jaws"}\n'
+                                         'not json\n'
+                                         '["Book", "b2", "Emma", "Austen"]\n'
+                                         '{"type": "Book", "library_item_id": 3, "title": "Emma", "creator": "A"}\n'
+                                         '{"type": "Book", "library_item_id": "b1", "title": "F", "creator": "A"}\n')
+        lib = Library(ItemStore())
+        results = import_library_items(lib, path)
+        self.assertEqual((results["rows"], results["added"]), (6, 1))
+        self.assertEqual(results["duplicates"], [(6, "b1")])
+        self.assertEqual(results["bad rows"], [(2, "missing field creator"), (3, "invalid JSON"),
+                                               (4, "not a JSON object"), (5, "field library_item_id is not a string")])
+        self.assertEqual(lib.search("aesop"), ["b1"])
+        patrons = self.write("patrons.ndjson", "".join(json.dumps({"patron_id": f"p{i % 900}", "name": f"N{i}"}) + "\n"
+                                                       for i in range(1000)))
+        results = import_patrons(lib, patrons, chunk_size=4096)
+        self.assertEqual((results["rows"], results["added"], len(results["duplicates"])), (1000, 900, 100))
+        self.assertEqual(results["duplicates"][0], (901, "p0"))
+        self.assertEqual(lib.lookup_patron_from_id("p5").get_name(), "N5")
+        self.assertEqual(lib.check_out_library_item("p5", "b1"), "check out successful")
+        with self.assertRaises(ValueError):
+            import_patrons(lib, self.write("patrons.txt", "patron_id,name\n"))
+        with self.assertRaises(ValueError):
+            import_patrons(lib, self.write("patrons.csv", "id,name\n"))
+
+
+class library_fine_report_tests(unittest.TestCase):
+
+    def test_report_follows_fines_and_overdue_items(self):
+        """
+        test the totals, overdue counts by type and top debtors, including a debtor overtaking another as days pass
+        """
+        lib = Library()
+        for patron_id in ("fa", "fb", "fc"):
+            lib.add_patron(Patron(patron_id, "Patron " + patron_id))
+        lib.add_library_item(Book("f1", "Emma", "Jane Austen"))
+        lib.add_library_item(Movie("f2", "Jaws", "Steven Spielberg"))
+        lib.lookup_patron_from_id("fa").amend_fine(5)
+        lib.pay_fine("fc", 1)
+        lib.check_out_library_item("fb", "f1")
+        lib.check_out_library_item("fb", "f2")
+        self.assertEqual(lib.get_top_debtors(), [("fa", 5)])
+        lib.advance_date(22)  # the Movie is 15 days overdue, the Book 1
+        self.assertEqual((lib.count_overdue_items(), lib.count_overdue_items(Book), lib.count_overdue_items(Movie)),
+                         (2, 1, 1))
+        self.assertAlmostEqual(lib.get_total_fines(), 5 + 1.6 - 1)
+        self.assertEqual(lib.get_top_debtors(), [("fa", 5), ("fb", 1.6)])
+        lib.advance_date(18)
+        self.assertEqual(lib.get_top_debtors(1), [("fb", 5.2)])
+        lib.return_library_item("f2")
+        lib.pay_fine("fb", 5.2)
+        lib.advance_date(5)
+        self.assertEqual(lib.count_overdue_items(Movie), 0)
+        self.assertEqual(lib.get_top_debtors(), [("fa", 5), ("fb", 0.5)])
+        self.assertAlmostEqual(lib.get_total_fines(), 4.5)
+        self.assertEqual(lib.check_fine_report(), [])
+
+    def test_report_matches_recomputation(self):
+        """
+        test that the report agrees with a full recomputation through a workload stream and a snapshot round trip
+        """
+        workload = Workload(400, 40, seed=6)
+        for lib in (workload.build_library(), workload.build_library(ConcurrentLibrary())):
+            stream = workload.generate_transactions(60, 30, max_payment=2.0)
+            for day in range(0, len(stream), 31 * 10):
+                run_library(lib, stream[day:day + 31 * 10])
+                self.assertEqual(lib.check_fine_report(count=15), [])
+            self.assertGreater(lib.count_overdue_items(), 0)
+            path = os.path.join(tempfile.mkdtemp(), "library.snapshot")
+            save_snapshot(lib, path)
+            loaded = load_snapshot(path)
+            self.assertEqual(loaded.check_fine_report(count=15), [])
+            self.assertEqual(loaded.get_top_debtors(15), lib.get_top_debtors(15))
+            self.assertEqual(loaded.count_overdue_items(Album), lib.count_overdue_items(Album))
+            self.assertAlmostEqual(loaded.get_total_fines(), lib.get_total_fines())
+
+
+class library_loan_policy_tests(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = LoanPolicy()
+        self.policy.set_rule(daily_fine_cents=25, max_loans=3)
+        self.policy.set_rule(Movie, loan_days=2, fine_cap_cents=110)
+        self.policy.set_rule(patron_class="child", daily_fine_cents=5, grace_days=2)
+        self.policy.set_rule(Movie, "child", fine_cap_cents=None)
+        self.policy.set_rule(patron_class="staff", max_loans=None)
+
+    def test_rules_compile_by_specificity(self):
+        """
+        test that more specific rules win, tables are cached until a rule is set, and bad rules are refused
+        """
+        self.assertEqual(self.policy.get_terms(Book), {"loan_days": 21, "daily_fine_cents": 25, "fine_cap_cents": None,
+                                                       "grace_days": 0, "max_loans": 3})
+        self.assertEqual(self.policy.get_terms(Movie, "child"), {"loan_days": 2, "daily_fine_cents": 5,
+                                                                 "fine_cap_cents": None, "grace_days": 2,
+                                                                 "max_loans": 3})
+        self.assertEqual(self.policy.get_terms(Movie)["fine_cap_cents"], 110)
+        self.assertIsNone(self.policy.get_terms(Album, "staff")["max_loans"])
+        self.assertEqual(LoanPolicy().get_terms(Album), {"loan_days": 14, "daily_fine_cents": DAILY_FINE_CENTS,
+                                                         "fine_cap_cents": None, "grace_days": 0, "max_loans": None})
+        table = self.policy.get_table("child")
+        self.assertIs(self.policy.get_table("child"), table)
+        self.policy.set_rule(Book, "child", loan_days=28)
+        self.assertIsNot(self.policy.get_table("child"), table)
+        self.assertEqual(self.policy.get_table("child")[1][0][0], 28)
+        for item_type, settings in ((None, {"loan_length": 3}), (Book, {"max_loans": 2}), (str, {"loan_days": 3})):
+            with self.assertRaises(ValueError):
+                self.policy.set_rule(item_type, **settings)
+
+    def test_library_lends_by_policy(self):
+        """
+        test loan lengths, grace days, daily fines, fine caps and loan limits by patron class, and that a policy change
+        leaves loans already made alone
+        """
+        lib = Library()
+        lib.set_loan_policy(self.policy)
+        lib.add_patron(Patron("ma", "Adult"))
+        lib.add_patron(Patron("mc", "Child", "child"))
+        lib.add_patron(Patron("ms", "Staff", "staff"))
+        for i in range(5):
+            lib.add_library_item(Movie("m" + str(i), "Jaws " + str(i), "Steven Spielberg"))
+            lib.add_library_item(Book("b" + str(i), "Emma " + str(i), "Jane Austen"))
+        self.assertEqual([lib.check_out_library_item("ma", "m" + str(i)) for i in range(4)],
+                         ["check out successful"] * 3 + ["loan limit reached"])
+        self.assertEqual(list(lib.process_batch([("check_out", "ma", "b0"), ("return", None, "m2"),
+                                                 ("check_out", "ma", "b0")])),
+                         [RESULT_CODES["loan limit reached"], RESULT_CODES["return successful"],
+                          RESULT_CODES["check out successful"]])
+        self.assertEqual(lib.check_out_library_item("mc", "m3"), "check out successful")
+        self.assertEqual([lib.check_out_library_item("ms", "b" + str(i)) for i in range(1, 5)],
+                         ["check out successful"] * 4)
+        self.policy.set_rule(Movie, daily_fine_cents=1000)  # later loans only
+        lib.advance_date(4)  # adult Movies 2 days overdue, the child's Movie is within its grace days
+        self.assertEqual(lib.lookup_patron_from_id("ma").get_fine_amount(), 1.0)
+        self.assertEqual(lib.lookup_patron_from_id("mc").get_fine_amount(), 0)
+        self.assertEqual(lib.count_overdue_items(Movie), 2)
+        lib.advance_date(3)  # the adult's fines reach their cap of 1.10 per Movie, the child's Movie is 3 days overdue
+        self.assertEqual(lib.lookup_patron_from_id("ma").get_fine_amount(), 2.2)
+        self.assertEqual(lib.lookup_patron_from_id("mc").get_fine_amount(), 0.15)
+        lib.return_library_item("m0")
+        lib.advance_date(30)
+        self.assertEqual(lib.lookup_patron_from_id("ma").get_fine_amount(), 2.2 + 0.25 * 16)
+        self.assertEqual(lib.lookup_patron_from_id("ms").get_fine_amount(), 0.25 * 4 * 16)
+        self.assertEqual(lib.get_top_debtors(2), [("ms", 16), ("ma", 6.2)])
+        self.assertEqual(lib.check_fine_report(), [])
+
+    def test_policy_in_engine_and_persistence(self):
+        """
+        test that the engine lends by the same policy as a Library, and that patron classes survive a snapshot and a
+        log replay
+        """
+        workload = Workload(200, 20, seed=9)
+        items = workload.build_items()
+        lib = Library()
+        lib.set_loan_policy(self.policy)
+        lib.add_library_items(items)
+        for patron_id in workload.get_patron_ids():
+            lib.add_patron(Patron(patron_id, "Patron"))
+        stream = workload.generate_transactions(40, 20)
+        engine = CirculationEngine(items, workload.get_patron_ids(), self.policy)
+        results = list(run_library(lib, stream))
+        self.assertIn(RESULT_CODES["loan limit reached"], results)
+        self.assertEqual(list(engine.run(stream)), results)
+        for patron_id in workload.get_patron_ids():
+            self.assertEqual(engine.get_fine_amount(patron_id), lib.lookup_patron_from_id(patron_id).get_fine_amount())
+        self.assertEqual(engine.count_overdue()[Movie], lib.count_overdue_items(Movie))
+        self.assertEqual(lib.check_fine_report(), [])
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        lib = Library()
+        lib.set_transaction_log(WriteAheadLog(os.path.join(directory, "library.wal"), fsync=False))
+        lib.add_patron(Patron("mc", "Child", "child"))
+        lib.add_library_item(Movie("m1", "Jaws", "Steven Spielberg"))
+        lib.check_out_library_item("mc", "m1")
+        lib.get_transaction_log().close()
+        recovered = recover(os.path.join(directory, "library.snapshot"), os.path.join(directory, "library.wal"),
+                            fsync=False, loan_policy=self.policy)
+        self.addCleanup(recovered.get_transaction_log().close)
+        self.assertEqual(recovered.lookup_patron_from_id("mc").get_patron_class(), "child")
+        path = os.path.join(directory, "saved.snapshot")
+        save_snapshot(recovered, path)
+        snapshot_items = SnapshotItems(path)
+        self.addCleanup(snapshot_items.close)
+        loaded = load_snapshot(path, snapshot_items, self.policy)
+        loaded.advance_date(10)  # 2 loan days and 2 grace days, then 6 days at 0.05
+        self.assertEqual(loaded.lookup_patron_from_id("mc").get_patron_class(), "child")
+        self.assertEqual(loaded.lookup_patron_from_id("mc").get_fine_amount(), 0.3)
+
+
+class library_history_tests(unittest.TestCase):
+
+    def test_library_records_loans(self):
+        """
+        test that returns are recorded with the fine each loan incurred, capped fines included
+        """
+        lib = Library()
+        policy = LoanPolicy()
+        policy.set_rule(Album, fine_cap_cents=25)
+        lib.set_loan_policy(policy)
+        history = LoanHistory()
+        lib.set_loan_history(history)
+        lib.add_patron(Patron("p1", "Alice"))
+        lib.add_patron(Patron("p2", "Bob"))
+        lib.add_library_item(Movie("m1", "Jaws", "Steven Spielberg"))
+        lib.add_library_item(Album("a1", "Blue", "Joni Mitchell"))
+        lib.check_out_library_item("p1", "m1")
+        lib.check_out_library_item("p2", "a1")
+        lib.advance_date(5)
+        lib.return_library_item("m1")  # returned on time
+        lib.check_out_library_item("p2", "m1")
+        lib.advance_date(15)  # the Album is 6 days overdue, capped at 0.25, the Movie is 8 days overdue
+        lib.return_library_item("a1")
+        lib.return_library_item("m1")
+        self.assertEqual(lib.return_library_item("m1"), "item already in library")
+        self.assertEqual(history.get_loans(), [("p1", "m1", 0, 5, 0), ("p2", "a1", 0, 20, 25),
+                                               ("p2", "m1", 5, 20, 80)])
+        self.assertEqual(sum(loan[4] for loan in history.get_loans(patron_id="p2")) / 100,
+                         lib.lookup_patron_from_id("p2").get_fine_amount())
+        self.assertEqual(history.get_loans(library_item_id="m1", start=6), [("p2", "m1", 5, 20, 80)])
+        self.assertEqual(history.get_loans(end=4, patron_id="p2"), [("p2", "a1", 0, 20, 25)])
+        self.assertEqual(history.get_item_turnover(0, 5), {"m1": 2, "a1": 1})
+        self.assertEqual(history.get_loans(patron_id="p3"), [])
+        history.close()
+
+    def test_refused_loan_leaves_item_checked_out(self):
+        """
+        test that a return the history refuses to record, being dated before the last loan recorded, changes nothing
+        """
+        history = LoanHistory()
+        libraries = [Library(), Library()]
+        for lib in libraries:
+            lib.set_loan_history(history)
+            lib.add_patron(Patron("p1", "Alice"))
+            lib.add_library_item(Movie("m1", "Jaws", "Steven Spielberg"))
+            lib.check_out_library_item("p1", "m1")
+        libraries[0].advance_date(10)
+        libraries[0].return_library_item("m1")
+        lib = libraries[1]
+        lib.advance_date(9)  # 2 days overdue
+        self.assertRaises(ValueError, lib.return_library_item, "m1")
+        patron = lib.lookup_patron_from_id("p1")
+        self.assertEqual(lib.lookup_library_item_from_id("m1").get_location(), "CHECKED_OUT")
+        self.assertEqual([item.get_library_item_id() for item in patron.get_checked_out_items()], ["m1"])
+        self.assertEqual(lib.count_overdue_items(Movie), 1)
+        lib.advance_date(1)
+        self.assertEqual(lib.return_library_item("m1"), "return successful")
+        self.assertEqual(patron.get_fine_amount(), 0.3)
+        self.assertEqual(lib.check_fine_report(), [])
+        self.assertEqual(history.get_loans(), [("p1", "m1", 0, 10, 30), ("p1", "m1", 0, 10, 30)])
+        history.close()
+
+    def test_chunks_spill_and_compact(self):
+        """
+        test that queries over sealed, spilled and active chunks match a scan of every loan, before and after
+        compaction, and that loans must be recorded in order of return date
+        """
+        directory = tempfile.mkdtemp()
+        history = LoanHistory(directory, memory_budget=2000, chunk_size=50)
+        rng = random.Random(4)
+        loans = []
+        for date_returned in range(0, 1000, 2):
+            for i in range(rng.randrange(3)):
+                date_out = date_returned - rng.randrange(40)
+                loan = ("p" + str(rng.randrange(20)), "i" + str(rng.randrange(60)), date_out, date_returned,
+                        rng.randrange(100))
+                history.record_loan(*loan)
+                loans.append(loan)
+        self.assertRaises(ValueError, history.record_loan, "p1", "i1", 0, 10, 0)
+        stats = history.get_stats()
+        self.assertEqual(stats["loans"], len(loans))
+        self.assertGreater(stats["spilled chunks"], 0)
+        self.assertLessEqual(stats["memory bytes"], 2000)
+        self.assertEqual(len(os.listdir(directory)), stats["spilled chunks"])
+
+        def check(loans):
+            for start, end, patron_id, library_item_id in [(None, None, None, None), (100, 300, None, None),
+                                                           (None, 500, "p3", None), (400, None, None, "i7"),
+                                                           (0, 999, "p5", "i9"), (250, 250, None, None)]:
+                self.assertEqual(history.get_loans(start, end, patron_id, library_item_id),
+                                 [loan for loan in loans if (start is None or loan[3] >= start)
+                                  and (end is None or loan[2] <= end) and patron_id in (None, loan[0])
+                                  and library_item_id in (None, loan[1])])
+            turnover = {}
+            for loan in loans:
+                if loan[3] >= 600 and loan[2] <= 700:
+                    turnover[loan[1]] = turnover.get(loan[1], 0) + 1
+            self.assertEqual(history.get_item_turnover(600, 700), turnover)
+
+        check(loans)
+        chunk_count = stats["chunks"]
+        history.compact(drop_before=300, chunk_loans=200)
+        self.assertLess(history.get_stats()["chunks"], chunk_count)
+        check([loan for loan in loans if loan[3] >= 300])
+        history.close()
+        self.assertEqual(os.listdir(directory), [])
+
+
+class library_fork_tests(unittest.TestCase):
+
+    def setUp(self):
+        workload = Workload(300, 40, seed=5)
+        self.rows = [(type(item), item.get_library_item_id(), item.get_title(), item.get_creator())
+                     for item in workload.build_items()]
+        self.patron_ids = workload.get_patron_ids()
+        stream = workload.generate_transactions(60, 30)
+        self.prefix, rest = stream[:len(stream) // 2], stream[len(stream) // 2:]
+        self.scenarios = [rest, random.Random(1).sample(rest, len(rest))]
+
+    def build(self, library, as_rows=False):
+        """
+        adds the workload's items and patrons to a library and applies the first half of the stream, the items are
+        added with add_library_item_rows if as_rows
+        """
+        if as_rows:
+            item_types, library_item_ids, titles, creators = zip(*self.rows)
+            library.add_library_item_rows([ITEM_TYPES.index(item_type) for item_type in item_types], library_item_ids,
+                                          titles, creators)
+        for item_type, library_item_id, title, creator in [] if as_rows else self.rows:
+            library.add_library_item(item_type(library_item_id, title, creator))
+        for patron_id in self.patron_ids:
+            library.add_patron(Patron(patron_id, "Patron " + patron_id))
+        run_library(library, self.prefix)
+        return library
+
+    def state(self, library):
+        """
+        reads everything the transactions may have changed in a library
+        """
+        items = [library.lookup_library_item_from_id(row[1]) for row in self.rows]
+        return ([(item.get_location(), item.get_checked_out_by() and item.get_checked_out_by().get_patron_id(),
+                  item.get_requested_by() and item.get_requested_by().get_patron_id()) for item in items],
+                [library.lookup_patron_from_id(patron_id).get_fine_amount() for patron_id in self.patron_ids],
+                [library.count_library_items(location) for location in LOCATIONS],
+                library.search("w1", location="ON_SHELF"), library.get_total_fines(), library.get_top_debtors(5),
+                library.count_overdue_items())
+
+    def test_forks_match_replay(self):
+        """
+        test that forks taken from one library, and the library itself, each end as a library built from scratch
+        with the same transactions does, and that a fork's loan policy and new patrons are its own
+        """
+        library = self.build(Library())
+        forks = [library.fork(), library.fork()]
+        forks[1].get_loan_policy().set_rule(Movie, loan_days=14)
+        forks[1].add_patrons([Patron("new" + str(i), "New") for i in range(50)])
+        replays = [self.build(Library()), self.build(Library())]
+        replays[1].get_loan_policy().set_rule(Movie, loan_days=14)
+        results = [run_library(fork, scenario) for fork, scenario in zip(forks, self.scenarios)]
+        self.assertEqual(results, [run_library(replay, scenario) for replay, scenario in zip(replays, self.scenarios)])
+        for fork, replay in zip(forks, replays):
+            self.assertEqual(self.state(fork), self.state(replay))
+            self.assertEqual(fork.check_fine_report(), [])
+        self.assertIsNone(library.lookup_patron_from_id("new0"))
+        self.assertEqual(library.get_loan_policy().get_rules(), [])
+        original = self.build(Library())
+        self.assertEqual(self.state(library), self.state(original))
+        run_library(library, self.scenarios[1])  # the parent changes after forking, the forks do not
+        self.assertEqual(self.state(forks[0]), self.state(replays[0]))
+
+    def test_fork_of_item_store_and_concurrent_library(self):
+        """
+        test forks of a fork, of a library backed by an ItemStore and of a ConcurrentLibrary
+        """
+        half = len(self.scenarios[0]) // 2
+        for library, as_rows in ((Library(), False), (Library(ItemStore()), True), (ConcurrentLibrary(), False)):
+            self.build(library, as_rows)
+            fork = library.fork()
+            run_library(fork, self.scenarios[0][:half])
+            fork_of_fork = fork.fork()
+            run_library(fork, self.scenarios[0][half:])
+            run_library(fork_of_fork, self.scenarios[1])
+            replay = self.build(Library())
+            run_library(replay, self.scenarios[0])
+            self.assertEqual(self.state(fork), self.state(replay))
+            replay = self.build(Library())
+            run_library(replay, self.scenarios[0][:half] + self.scenarios[1])
+            self.assertEqual(self.state(fork_of_fork), self.state(replay))
+            self.assertEqual(fork_of_fork.check_fine_report(), [])
+            self.assertEqual(self.state(library), self.state(self.build(Library())))
+            self.assertIs(type(fork_of_fork), type(library))
+        library = ConcurrentLibrary(stripe_count=8)
+        self.assertEqual(len(library.fork().fork()._stripes), 8)
+
+    def test_parent_keeps_its_records(self):
+        """
+        test that forking leaves a library with its own items and patrons, so the objects a caller holds go on being
+        changed by the library, and that forks taken as the library changes each start from its state at the time
+        """
+        library = Library()
+        patron, book = Patron("p1", "Alice"), Book("b1", "Fables", "Aesop")
+        library.add_patron(patron)
+        library.add_library_item(book)
+        fork = library.fork()
+        self.assertEqual(library.check_out_library_item("p1", "b1"), "check out successful")
+        self.assertIs(library.lookup_library_item_from_id("b1"), book)
+        self.assertIs(library.lookup_patron_from_id("p1"), patron)
+        self.assertEqual(book.get_location(), "CHECKED_OUT")
+        self.assertEqual(list(patron.get_checked_out_items()), [book])
+        self.assertEqual(fork.lookup_library_item_from_id("b1").get_location(), "ON_SHELF")
+        second = library.fork()
+        self.assertIs(second.lookup_library_item_from_id("b1").get_checked_out_by(), second.lookup_patron_from_id("p1"))
+
+        for library, as_rows in ((Library(), False), (Library(ItemStore()), True), (ConcurrentLibrary(), False)):
+            self.build(library, as_rows)
+            patrons = [library.lookup_patron_from_id(patron_id) for patron_id in self.patron_ids]
+            items = [] if as_rows else [library.lookup_library_item_from_id(row[1]) for row in self.rows]
+            replay = self.build(Library())
+            forks = []
+            for scenario in self.scenarios + self.scenarios:  # enough changes for the shared records to be refrozen
+                forks.append((library.fork(), self.state(replay)))
+                run_library(library, scenario)
+                run_library(replay, scenario)
+            self.assertEqual(self.state(library), self.state(replay))
+            self.assertEqual(library.check_fine_report(), [])
+            self.assertTrue(all(library.lookup_patron_from_id(patron_id) is patron
+                                for patron_id, patron in zip(self.patron_ids, patrons)))
+            self.assertTrue(all(library.lookup_library_item_from_id(row[1]) is library_item
+                                for row, library_item in zip(self.rows, items)))
+            for fork, state in forks:
+                self.assertEqual(self.state(fork), state)
+                self.assertEqual(fork.check_fine_report(), [])
+
+    def test_fork_of_snapshot(self):
+        """
+        test that a library loaded from a snapshot and its forks, including items the library builds after forking,
+        each end as a library built from scratch with the same transactions does
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "library.snapshot")
+        save_snapshot(self.build(Library()), path)
+        snapshot_items = SnapshotItems(path)
+        self.addCleanup(snapshot_items.close)
+        library = load_snapshot(path, snapshot_items)
+        fork = library.fork()
+        run_library(library, self.scenarios[0])
+        fork_of_fork = fork.fork()
+        run_library(fork, self.scenarios[1])
+        run_library(fork_of_fork, self.scenarios[0])
+        for forked, scenario in ((library, self.scenarios[0]), (fork, self.scenarios[1]),
+                                 (fork_of_fork, self.scenarios[0])):
+            replay = self.build(Library())
+            run_library(replay, scenario)
+            self.assertEqual(self.state(forked), self.state(replay))
+            self.assertEqual(forked.check_fine_report(), [])
@@ -0,0 +1,166 @@
+# Description: A seeded generator of synthetic catalogs and transaction streams for benchmarking Library.py.
+# Catalogs mix Books, Albums and Movies with titles and creators drawn from a fixed vocabulary, and item popularity
+# follows a Zipf distribution so a few items take most of the check-outs and requests, as in a real collection.
+
+import itertools
+import random
+from Library import *
+
+DEFAULT_ITEM_MIX = {Book: 0.6, Album: 0.25, Movie: 0.15}  # share of the catalog of each item type
+
+# share of the non-advance transactions of each operation, see library_simulation for the stream format
+DEFAULT_OPERATION_MIX = {"check_out": 0.45, "return": 0.35, "request": 0.15, "pay_fine": 0.05}
+
+
+def zipf_cumulative_weights(count, exponent=1.0):
+    """
+    returns the cumulative weights of a Zipf distribution over count ranks, rank r is drawn with probability
+    proportional to 1 / (r + 1) ** exponent
+    :param count: number of ranks
+    :param exponent: the Zipf exponent, 0 gives a uniform distribution
+    :return: a list of count floats, the last being the total weight
+    """
+    return list(itertools.accumulate(1 / (rank + 1) ** exponent for rank in range(count)))
+
+
+class Workload:
+    """
+    A synthetic catalog and patron list with a seeded random source for transaction streams over them.
+
+    Items are ranked by popularity in a random order, so the most popular items are spread over the catalog rather
+    than being the first ids. Each stream drawn keeps the loans it has made, so returns are of items it checked out
+    rather than of random ids that are mostly already in the library.
+    """
+
+    def __init__(self, item_count, patron_count, seed=0, item_mix=None, zipf_exponent=1.0, vocabulary_size=20000):
+        """
+        :param item_count: number of items in the catalog, ids are "0" to str(item_count - 1)
+        :param patron_count: number of patrons, ids are "p0" onward
+        :param seed: seed for the catalog and every stream drawn from it
+        :param item_mix: a dictionary of Book, Album and Movie to their share of the catalog, DEFAULT_ITEM_MIX if None
+        :param zipf_exponent: skew of item popularity, 0 makes every item equally popular
+        :param vocabulary_size: number of distinct words titles and creators are made from
+        """
+        self._rng = random.Random(seed)
+        item_mix = DEFAULT_ITEM_MIX if item_mix is None else item_mix
+        self._item_types = self._rng.choices(list(item_mix), weights=list(item_mix.values()), k=item_count)
+        self._item_ids = [str(i) for i in range(item_count)]
+        self._patron_ids = ["p" + str(i) for i in range(patron_count)]
+        self._words = ["w" + str(i) for i in range(vocabulary_size)]
+        self._word_weights = zipf_cumulative_weights(vocabulary_size)
+        self._by_popularity = self._item_ids[:]
+        self._rng.shuffle(self._by_popularity)
+        self._popularity_weights = zipf_cumulative_weights(item_count, zipf_exponent)
+
+    def get_item_ids(self):
+        """
+        returns the ids of the catalog's items
+        :return: a list of strings
+        """
+        return self._item_ids
+
+    def get_patron_ids(self):
+        """
+        returns the ids of the workload's patrons
+        :return: a list of strings
+        """
+        return self._patron_ids
+
+    def get_words(self):
+        """
+        returns the vocabulary titles and creators are drawn from, most frequent first
+        :return: a list of strings
+        """
+        return self._words
+
+    def build_items(self):
+        """
+        builds the catalog's items, titles have one to five words and creators two, drawn with Zipf frequency
+        :return: a list of Book, Album and Movie objects, one per item id
+        """
+        rng = random.Random(self._rng.random())
+        words, weights = self._words, self._word_weights
+        items = []
+        for item_id, item_type in zip(self._item_ids, self._item_types):
+            title = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(1, 5)))
+            creator = " ".join(rng.choices(words, cum_weights=weights, k=2))
+            items.append(item_type(item_id, title, creator))
+        return items
+
+    def build_library(self, library=None):
+        """
+        adds the catalog's items and patrons to a library
+        :param library: the Library (or ConcurrentLibrary) to fill, a new Library if None
+        :return: the Library object
+        """
+        library = Library() if library is None else library
+        for item in self.build_items():
+            library.add_library_item(item)
+        for patron_id in self._patron_ids:
+            library.add_patron(Patron(patron_id, "Patron " + patron_id))
+        return library
+
+    def sample_item_ids(self, count):
+        """
+        draws item ids with Zipf popularity
+        :param count: number of ids to draw
+        :return: a list of strings
+        """
+        return self._rng.choices(self._by_popularity, cum_weights=self._popularity_weights, k=count)
+
+    def sample_patron_ids(self, count):
+        """
+        draws patron ids uniformly
+        :param count: number of ids to draw
+        :return: a list of strings
+        """
+        return self._rng.choices(self._patron_ids, k=count)
+
+    def generate_transactions(self, days, transactions_per_day, operation_mix=None, max_payment=5.0):
+        """
+        Draws a stream of check-outs, returns, requests and fine payments with a one day advance after each day's
+        transactions, in the (operation, patron_id, argument) form of library_simulation. A return is of an item the
+        stream checked out (a check-out stands in when there is none).
+        :param days: number of days in the stream
+        :param transactions_per_day: transactions between date advances
+        :param operation_mix: a dictionary of operation to its share of the transactions, DEFAULT_OPERATION_MIX if None
+        :param max_payment: largest fine payment drawn, in dollars
+        :return: a list of (operation, patron_id, argument) tuples
+        """
+        rng = self._rng
+        operation_mix = DEFAULT_OPERATION_MIX if operation_mix is None else operation_mix
+        operations = list(operation_mix)
+        operation_weights = list(itertools.accumulate(operation_mix.values()))
+        loans = []  # (patron_id, item_id) checked out by this stream and not yet returned
+        stream = []
+        for day in range(days):
+            for operation in rng.choices(operations, cum_weights=operation_weights, k=transactions_per_day):
+                if operation == "return" and loans:
+                    stream.append(("return", None, loans.pop(rng.randrange(len(loans)))[1]))
+                elif operation == "pay_fine":
+                    stream.append(("pay_fine", rng.choice(self._patron_ids), round(rng.uniform(0, max_payment), 2)))
+                else:
+                    operation = "check_out" if operation == "return" else operation
+                    patron_id = rng.choice(self._patron_ids)
+                    item_id = rng.choices(self._by_popularity, cum_weights=self._popularity_weights)[0]
+                    if operation == "check_out":
+                        loans.append((patron_id, item_id))
+                    stream.append((operation, patron_id, item_id))
+            stream.append(("advance_date", None, 1))
+        return stream
+
+    def generate_queries(self, count, prefix_share=0.2):
+        """
+        draws search queries of one or two words with Zipf frequency, some ending in a prefix term
+        :param count: number of queries
+        :param prefix_share: share of the queries whose last word is cut to a prefix and given a trailing "*"
+        :return: a list of strings
+        """
+        rng = self._rng
+        queries = []
+        for i in range(count):
+            words = rng.choices(self._words, cum_weights=self._word_weights, k=rng.randint(1, 2))
+            if rng.random() < prefix_share:
+                words[-1] = words[-1][:max(2, len(words[-1]) - 1)] + "*"
+            queries.append(" ".join(words))
+        return queries